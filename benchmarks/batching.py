@@ -0,0 +1,147 @@
+"""
+Batching benchmark: sustained delivery rate with and without BATCH frames.
+
+Starts a SackServer in a separate process and connects many receivers.
+Bots in another process send TEXT messages one send call at a time, as
+fast as the server takes them, so they reach the server spread over many
+loop iterations. Reports delivered messages/sec, read calls per thousand
+delivered messages (a stand-in for packets) and the delivery latency of a
+single message sent once the server is idle again, each the median of
+--rounds runs.
+
+On loopback the two come out within run to run noise of each other: the
+outbox already writes every queued frame with one sendmsg, so BATCH saves
+little beyond what the flush window costs in latency. Servers leave
+batching off unless given a BatchPolicy.
+
+    python benchmarks/batching.py --receivers 200 --messages 2000 --max-delay 0.005 --rounds 3
+"""
+
+import time
+import socket
+import asyncio
+import statistics
+import multiprocessing
+
+from argparse import ArgumentParser
+from multiprocessing.synchronize import Event
+
+from sack.models import SackServer, BatchPolicy, HistoryPolicy
+from sack.models.protocol import PROTOCOL_VERSION, SackMessage, SackMessageDecoder, encode_hello
+
+
+def serve(port: int, max_delay: float | None, max_bytes: int) -> None:
+    policy = BatchPolicy(max_delay, max_bytes) if max_delay else None
+    with SackServer("127.0.0.1", port, batch_policy=policy, history_policy=HistoryPolicy(replay=0)) as server:
+        server.serve()
+
+
+def send(port: int, username: str, messages: int, size: int, done: Event) -> None:
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(encode_hello(PROTOCOL_VERSION))
+    version = sock.recv(3)[1]
+    sock.sendall(SackMessage("CONNECT", username).to_bytes(version))
+    frame = SackMessage("TEXT", username, "x" * size).to_bytes(version)
+    for _ in range(messages):
+        sock.sendall(frame)
+    # closing early would drop the frames the server has not read yet
+    done.wait()
+    sock.close()
+
+
+class Receiver:
+    def __init__(self, reader: asyncio.StreamReader, decoder: SackMessageDecoder) -> None:
+        self.reader = reader
+        self.decoder = decoder
+        self.reads = 0
+        self.received = 0
+
+    async def receive(self, count: int, text: str | None = None) -> None:
+        while self.received < count:
+            data = await self.reader.read(1 << 16)
+            if not data:
+                raise ConnectionError
+            self.reads += 1
+            self.decoder.feed(data)
+            for message in self.decoder.messages():
+                if message.type == "TEXT":
+                    self.received += 1
+                    if message.text == text:
+                        return
+
+
+async def join(port: int, username: str) -> tuple[asyncio.StreamWriter, Receiver]:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    writer.write(encode_hello(PROTOCOL_VERSION))
+    hello = await reader.readexactly(3)
+    writer.write(SackMessage("CONNECT", username).to_bytes(hello[1]))
+    assert await reader.readexactly(2) == b"OK"
+    return writer, Receiver(reader, SackMessageDecoder(version=hello[1]))
+
+
+async def run(port: int, senders: int, receivers: int, messages: int, size: int) -> tuple[float, float, float]:
+    listeners = [await join(port, f"user{i}") for i in range(receivers)]
+    await asyncio.sleep(0.2)
+
+    total = messages * senders
+    done = multiprocessing.Event()
+    bots = [
+        multiprocessing.Process(target=send, args=(port, f"bot{i}", messages, size, done), daemon=True)
+        for i in range(senders)
+    ]
+    started = time.perf_counter()
+    for bot in bots:
+        bot.start()
+    await asyncio.gather(*(receiver.receive(total) for _, receiver in listeners))
+    elapsed = time.perf_counter() - started
+    reads = sum(receiver.reads for _, receiver in listeners)
+    done.set()
+    for bot in bots:
+        bot.join()
+
+    await asyncio.sleep(0.2)
+    sender, _ = await join(port, "idle")
+    latencies = []
+    for i in range(20):
+        sent = time.perf_counter()
+        sender.write(SackMessage("TEXT", "idle", f"idle {i}").to_bytes(PROTOCOL_VERSION))
+        await listeners[0][1].receive(total + 10_000, f"idle {i}")
+        latencies.append(time.perf_counter() - sent)
+        await asyncio.sleep(0.1)
+    for writer, _ in [(sender, None), *listeners]:
+        writer.close()
+    return total * receivers / elapsed, reads / (total * receivers) * 1000, statistics.median(latencies)
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--senders", type=int, default=4)
+    parser.add_argument("--receivers", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--max-delay", type=float, default=0.005)
+    parser.add_argument("--max-bytes", type=int, default=64 * 1024)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--port", type=int, default=9600)
+    args = parser.parse_args()
+
+    # the two servers take turns, so drift on the machine hits both alike
+    configs = (("unbatched", None, args.port), ("batched", args.max_delay, args.port + 1))
+    results: dict[str, list[tuple[float, float, float]]] = {label: [] for label, _, _ in configs}
+    for _ in range(args.rounds):
+        for label, max_delay, port in configs:
+            server = multiprocessing.Process(target=serve, args=(port, max_delay, args.max_bytes), daemon=True)
+            server.start()
+            time.sleep(0.3)
+            results[label].append(asyncio.run(run(port, args.senders, args.receivers, args.messages, args.size)))
+            server.terminate()
+            server.join()
+    for label, rounds in results.items():
+        rate, reads, idle = (statistics.median(values) for values in zip(*rounds, strict=True))
+        print(f"{label:>10}: {rate:,.0f} deliveries/s, {reads:.1f} reads per 1000, idle latency {idle * 1e6:.0f} us")
+
+
+if __name__ == "__main__":
+    main()
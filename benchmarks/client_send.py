@@ -0,0 +1,69 @@
+"""
+Client send benchmark: burst throughput of the AsyncSackClient send path.
+
+Starts a SackServer in a separate process and pushes bursts of TEXT
+messages from a bot client, alone in its room, in three ways: draining
+after every message (what send_text used to do), queued send_text calls
+coalesced by the flusher task, and send_many. Reports messages/sec until
+the last one is handed to the socket and until the server answers a
+request sent after the burst.
+
+    python benchmarks/client_send.py --messages 50000 --size 200
+"""
+
+import time
+import asyncio
+import multiprocessing
+
+from argparse import ArgumentParser
+
+from sack.models import SackServer, HistoryPolicy, AsyncSackClient
+
+
+def serve(port: int) -> None:
+    with SackServer("127.0.0.1", port, history_policy=HistoryPolicy(replay=0)) as server:
+        server.serve()
+
+
+async def run(port: int, messages: int, size: int) -> None:
+    texts = [f"{i} " + "x" * size for i in range(messages)]
+    for mode in ("drain each", "queued", "send_many"):
+        bot = AsyncSackClient(host="127.0.0.1", port=port, username=f"bot-{mode.replace(' ', '-')}")
+        await bot.connect()
+        await bot.join_request()
+        started = time.perf_counter()
+        if mode == "send_many":
+            await bot.send_many(texts)
+        else:
+            for text in texts:
+                await bot.send_text(text)
+                if mode == "drain each":
+                    await bot.flush()
+        await bot.flush()
+        sent = time.perf_counter() - started
+        # the server answers in order, so the answer comes after the whole burst
+        await bot.request_nicknames()
+        async for message in bot.messages():
+            if message.type == "GETNICKNAMES":
+                break
+        elapsed = time.perf_counter() - started
+        print(f"{mode:>10}: {messages / sent:>11,.0f} sent/s, {messages / elapsed:>11,.0f} taken by the server/s")
+        await bot.disconnect()
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--messages", type=int, default=50_000)
+    parser.add_argument("--size", type=int, default=200)
+    parser.add_argument("--port", type=int, default=9700)
+    args = parser.parse_args()
+
+    server = multiprocessing.Process(target=serve, args=(args.port,), daemon=True)
+    server.start()
+    time.sleep(0.3)
+    asyncio.run(run(args.port, args.messages, args.size))
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main()
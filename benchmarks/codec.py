@@ -0,0 +1,182 @@
+"""
+Codec benchmark: ns per frame and allocations of the protocol hot path.
+
+Times SackMessage.to_bytes and SackMessageDecoder with timeit. The frames
+are small, typical and maximum size, with ASCII and multibyte UTF-8 text,
+in v1 and v3. Decoding is timed both one frame per read and for a stream
+of frames fed at once, and it reads the text of every message, as a client
+does. tracemalloc counts the bytes allocated per frame at the peak, and the
+blocks and bytes the results keep. The pipeline runs write a stream of
+frames into one end of a socketpair and read it back through
+SackClient.receive_message and AsyncSackClient.receive_message. No server
+is started.
+
+    python benchmarks/codec.py --frames 2000 --repeat 5
+"""
+
+import socket
+import timeit
+import asyncio
+import threading
+import tracemalloc
+
+from typing import Any
+from argparse import ArgumentParser
+from functools import partial
+from collections.abc import Callable
+
+from sack.models import SackClient, SackMessage, AsyncSackClient
+from sack.models.protocol import MAX_FRAME_SIZE, SackMessageDecoder
+
+
+CLIENT_TEXT_TYPES = ("TEXT", "GETNICKNAMES", "JOIN", "LEAVE")
+# max size frames are only repeated until the stream is this large
+MAX_STREAM_BYTES = 32 * 1024 * 1024
+USERNAME = "benchmark-user"
+
+
+# the largest text of the given characters whose encoding fits in limit bytes
+def text_of(chars: str, limit: int) -> str:
+    text = chars * (limit // len(chars.encode()) + 1)
+    while len(text.encode()) > limit:
+        text = text[: -max(1, (len(text.encode()) - limit) // 4)]
+    return text
+
+
+def cases(version: int) -> list[tuple[str, str]]:
+    # v1 has a two byte text length, v2 and later a frame length limit
+    limit = 0xFFFF if version == 1 else MAX_FRAME_SIZE - len(USERNAME) - 16
+    return [
+        ("small ascii", "hi"),
+        ("small utf-8", "cześć 👋"),
+        ("typical ascii", text_of("the quick brown fox jumps over the lazy dog ", 200)),
+        ("typical utf-8", text_of("zażółć gęślą jaźń 🙂 ", 200)),
+        ("max ascii", text_of("x", limit)),
+        ("max utf-8", text_of("ż🙂", limit)),
+    ]
+
+
+def best(fn: Callable[[], Any], number: int, repeat: int) -> float:
+    return min(timeit.Timer(fn).repeat(repeat, number)) / number
+
+
+# peak bytes allocated while fn runs, and the blocks and bytes of what it returns
+def allocations(fn: Callable[[], Any]) -> tuple[int, int, int]:
+    tracemalloc.start()
+    try:
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        stats = snapshot.statistics("filename")
+        del result
+        return peak, sum(stat.count for stat in stats), sum(stat.size for stat in stats)
+    finally:
+        tracemalloc.stop()
+
+
+def encode(version: int, text: str, count: int = 1) -> list[bytes]:
+    return [SackMessage("TEXT", USERNAME, text).to_bytes(version) for _ in range(count)]
+
+
+# feeds the frames to one decoder count times, reading the text of every message
+def decode(version: int, frames: bytes, count: int = 1) -> list[SackMessage]:
+    decoder = SackMessageDecoder(text_types=CLIENT_TEXT_TYPES, version=version)
+    messages = []
+    for _ in range(count):
+        decoder.feed(frames)
+        messages += decoder.messages()
+    texts = [message.text for message in messages]
+    assert len(texts) == len(messages)
+    return messages
+
+
+def codec(version: int, frames: int, repeat: int) -> None:
+    print(f"v{version}{'':<28}{'ns/frame':>12}{'MB/s':>10}{'peak B/frame':>14}{'kept blocks':>13}{'kept B':>10}")
+    for name, text in cases(version):
+        frame = encode(version, text)[0]
+        count = max(1, min(frames, MAX_STREAM_BYTES // len(frame)))
+        runs = [
+            ("encode", partial(encode, version, text, count)),
+            ("decode", partial(decode, version, frame, count)),
+            ("decode stream", partial(decode, version, frame * count)),
+        ]
+        for run, fn in runs:
+            seconds = best(fn, 1, repeat) / count
+            peak, blocks, kept = allocations(fn)
+            print(
+                f"  {name + ' ' + run:<30}{seconds * 1e9:>12.0f}{len(frame) / seconds / 1e6:>10.1f}"
+                f"{peak / count:>14.0f}{blocks / count:>13.2f}{kept / count:>10.0f}"
+            )
+
+
+def write(sock: socket.socket, stream: bytes) -> threading.Thread:
+    writer = threading.Thread(target=sock.sendall, args=(stream,), daemon=True)
+    writer.start()
+    return writer
+
+
+def pipeline_sync(version: int, stream: bytes, count: int) -> float:
+    ours, theirs = socket.socketpair()
+    client = SackClient(host="", port=0)
+    client._socket.close()
+    client._socket = ours
+    client._decoder.version = version
+    started = timeit.default_timer()
+    writer = write(theirs, stream)
+    for _ in range(count):
+        assert client.receive_message().text
+    elapsed = timeit.default_timer() - started
+    writer.join()
+    ours.close()
+    theirs.close()
+    return elapsed
+
+
+async def pipeline_async(version: int, stream: bytes, count: int) -> float:
+    ours, theirs = socket.socketpair()
+    client = AsyncSackClient(host="", port=0)
+    client._reader, client._writer = await asyncio.open_connection(sock=ours, limit=client.buffer_limit)
+    client._decoder.version = version
+    started = timeit.default_timer()
+    writer = write(theirs, stream)
+    for _ in range(count):
+        assert (await client.receive_message()).text
+    elapsed = timeit.default_timer() - started
+    writer.join()
+    client._writer.close()
+    theirs.close()
+    return elapsed
+
+
+def run_async(version: int, stream: bytes, count: int) -> float:
+    return asyncio.run(pipeline_async(version, stream, count))
+
+
+def pipelines(version: int, frames: int, repeat: int) -> None:
+    print(f"v{version} socketpair pipeline{'':<12}{'ns/frame':>12}{'MB/s':>10}")
+    for name, text in cases(version):
+        frame = SackMessage("TEXT", USERNAME, text).to_bytes(version)
+        count = max(1, min(frames, MAX_STREAM_BYTES // len(frame)))
+        stream = frame * count
+        for client, run in (
+            ("SackClient", partial(pipeline_sync, version, stream, count)),
+            ("AsyncSackClient", partial(run_async, version, stream, count)),
+        ):
+            seconds = min(run() for _ in range(repeat)) / count
+            print(f"  {name + ' ' + client:<32}{seconds * 1e9:>12.0f}{len(frame) / seconds / 1e6:>10.1f}")
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--versions", type=int, nargs="+", default=[1, 3])
+    args = parser.parse_args()
+
+    for version in args.versions:
+        codec(version, args.frames, args.repeat)
+        pipelines(version, args.frames, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Compression benchmark: ratio and cpu cost of compressed TEXT frames.
+
+Compresses samples of chat lines, code pastes (the sack sources) and log
+pastes with the preset dictionary and without it, at a few sizes, and
+reports the ratio and the cpu time per frame. A broadcast compresses a
+frame once, so the cost per recipient is the cost per frame divided by
+the room size.
+
+    python benchmarks/compression.py --level 6 --sizes 128 512 2048 8192
+"""
+
+import zlib
+import random
+import pathlib
+
+from argparse import ArgumentParser
+
+from sack.models.compression import WBITS, Compressor, CompressionPolicy
+
+
+WORDS = "the and to of a in is it you that for on with was as have be at this but not hey ok lol thanks".split()
+
+
+def chat(size: int) -> bytes:
+    lines = []
+    while sum(len(line) + 1 for line in lines) < size:
+        lines.append(" ".join(random.choices(WORDS, k=random.randint(3, 12))))
+    return "\n".join(lines).encode()[:size]
+
+
+def code(size: int) -> bytes:
+    sources = b"".join(path.read_bytes() for path in sorted(pathlib.Path("src/sack").rglob("*.py")))
+    start = random.randrange(max(1, len(sources) - size))
+    return sources[start : start + size]
+
+
+def logs(size: int) -> bytes:
+    lines = []
+    while sum(len(line) + 1 for line in lines) < size:
+        level = random.choice(["INFO", "INFO", "DEBUG", "WARNING"])
+        lines.append(
+            f"2026-10-18 12:{random.randint(0, 59):02d}:{random.randint(0, 59):02d},{random.randint(0, 999):03d}"
+            f" | {level} | server: received message of type TEXT from 127.0.0.1:{random.randint(1024, 65535)}"
+        )
+    return "\n".join(lines).encode()[:size]
+
+
+def plain_zlib(text: bytes, level: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS)
+    return compressor.compress(text) + compressor.flush()
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--level", type=int, default=6)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[128, 512, 2048, 8192])
+    parser.add_argument("--samples", type=int, default=500)
+    args = parser.parse_args()
+
+    print(f"{'kind':>5} {'size':>6} {'ratio':>7} {'no dict':>8} {'us/frame':>9}")
+    for kind, sample in (("chat", chat), ("code", code), ("logs", logs)):
+        for size in args.sizes:
+            texts = [sample(size) for _ in range(args.samples)]
+            compressor = Compressor(CompressionPolicy(threshold=0, level=args.level))
+            for text in texts:
+                compressor.compress(text)
+            stats = compressor.stats
+            without = sum(len(plain_zlib(text, args.level)) for text in texts) / sum(len(text) for text in texts)
+            print(f"{kind:>5} {size:>6} {stats.ratio:>7.3f} {without:>8.3f} {stats.cpu_per_frame * 1e6:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Fanout benchmark: syscalls per delivered message and delivered messages/sec.
+
+Compares the old one-send-per-frame fanout with the vectored Outbox flush,
+where every pending frame of a connection goes out in one sendmsg call.
+Clients are simulated with socketpairs, so only the server side is measured.
+
+    python benchmarks/fanout.py --clients 100 1000 5000 --burst 16
+"""
+
+import time
+import socket
+
+from argparse import ArgumentParser
+
+from sack.models import Outbox, SackMessage
+
+
+class CountingSocket:
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.calls = 0
+
+    def send(self, data) -> int:
+        self.calls += 1
+        return self.sock.send(data)
+
+    def sendmsg(self, buffers) -> int:
+        self.calls += 1
+        return self.sock.sendmsg(buffers)
+
+
+def drain(readers: list[socket.socket]) -> None:
+    for reader in readers:
+        try:
+            while reader.recv(1 << 16):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def run(clients: int, messages: int, burst: int, size: int, strategy: str) -> tuple[float, float]:
+    pairs = [socket.socketpair() for _ in range(clients)]
+    for writer, reader in pairs:
+        writer.setblocking(False)
+        reader.setblocking(False)
+    writers = [CountingSocket(writer) for writer, _ in pairs]
+    readers = [reader for _, reader in pairs]
+    outboxes = [Outbox() for _ in range(clients)]
+    frames = [SackMessage("TEXT", "bench", "x" * size).to_bytes() for _ in range(burst)]
+
+    elapsed = 0.0
+    for _ in range(messages // burst):
+        start = time.perf_counter()
+        if strategy == "per-frame":
+            for frame in frames:
+                for writer, outbox in zip(writers, outboxes, strict=True):
+                    outbox.put(frame)
+                    outbox.send(writer)  # type: ignore
+        else:
+            for frame in frames:
+                for outbox in outboxes:
+                    outbox.put(frame)
+            for writer, outbox in zip(writers, outboxes, strict=True):
+                outbox.send(writer)  # type: ignore
+        elapsed += time.perf_counter() - start
+        drain(readers)
+
+    delivered = clients * (messages // burst) * burst
+    syscalls = sum(writer.calls for writer in writers)
+    for writer, reader in pairs:
+        writer.close()
+        reader.close()
+    return syscalls / delivered, delivered / elapsed
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--clients", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--messages", type=int, default=256)
+    parser.add_argument("--burst", type=int, default=16)
+    parser.add_argument("--size", type=int, default=64)
+    args = parser.parse_args()
+
+    print(f"{'clients':>8} {'strategy':>10} {'syscalls/msg':>13} {'msgs/sec':>12}")
+    for clients in args.clients:
+        for strategy in ("per-frame", "vectored"):
+            syscalls, rate = run(clients, args.messages, args.burst, args.size, strategy)
+            print(f"{clients:>8} {strategy:>10} {syscalls:>13.3f} {rate:>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
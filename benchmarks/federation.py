@@ -0,0 +1,87 @@
+"""
+Federation benchmark: cross-node delivery latency and inter-node bandwidth.
+
+Starts a full mesh of federated SackServer nodes on localhost, joins one
+client to the first node and one to the last, and sends timestamped TEXT
+messages between them.
+
+    python benchmarks/federation.py --nodes 3 --messages 2000
+"""
+
+import time
+import asyncio
+import threading
+import statistics
+
+from argparse import ArgumentParser
+
+from sack.models import SackServer, AsyncSackClient
+from sack.models.federation import Federation
+
+
+def start_nodes(nodes: int, port: int) -> list[tuple[SackServer, Federation]]:
+    started = []
+    for i in range(nodes):
+        peers = [("127.0.0.1", port + 100 + j) for j in range(i)]
+        federation = Federation(f"node-{i}", listen=("127.0.0.1", port + 100 + i), peers=peers)
+        server = SackServer("127.0.0.1", port + i, cluster=federation)
+        threading.Thread(target=server.serve, daemon=True).start()
+        started.append((server, federation))
+    return started
+
+
+async def run(nodes: int, messages: int, size: int, port: int) -> None:
+    started = start_nodes(nodes, port)
+    await asyncio.sleep(0.2)
+    for _, federation in started:
+        assert len(federation.linked_nodes) == nodes - 1, federation.linked_nodes
+
+    sender = AsyncSackClient(host="127.0.0.1", port=port, username="sender")
+    receiver = AsyncSackClient(host="127.0.0.1", port=port + nodes - 1, username="receiver")
+    for client in (sender, receiver):
+        await client.connect()
+        await client.join_request()
+
+    duplicate = AsyncSackClient(host="127.0.0.1", port=port + nodes - 1, username="sender")
+    await duplicate.connect()
+    try:
+        await duplicate.join_request()
+        print("username uniqueness: FAILED")
+    except Exception:
+        print("username uniqueness: ok")
+
+    bytes_before = sum(federation.bytes_sent for _, federation in started)
+    padding = "x" * size
+    latencies = []
+    for _ in range(messages):
+        await sender.send_text(f"{time.perf_counter()} {padding}")
+        while True:
+            msg = await receiver.receive_message()
+            if msg and msg.type == "TEXT" and msg.username == "sender":
+                assert msg.text
+                latencies.append(time.perf_counter() - float(msg.text.split(" ", 1)[0]))
+                break
+    bytes_sent = sum(federation.bytes_sent for _, federation in started) - bytes_before
+
+    latencies.sort()
+    print(f"nodes: {nodes}, messages: {messages}, text size: {size}")
+    print(f"latency p50: {statistics.median(latencies) * 1e6:.0f} us")
+    print(f"latency p99: {latencies[int(len(latencies) * 0.99)] * 1e6:.0f} us")
+    print(f"inter-node bytes per message: {bytes_sent / messages:.1f}")
+
+    for server, _ in started:
+        server.stop()
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--port", type=int, default=9500)
+    args = parser.parse_args()
+    asyncio.run(run(args.nodes, args.messages, args.size, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Logging benchmark: delivered messages/sec under each logging setup.
+
+Starts a SackServer in a separate process for each setup, with its log
+written to a temporary file, and has a bot send TEXT messages as fast as
+the server takes them to receivers in the same room. The setups are:
+- sync debug: what sack-dev used to do, every record formatted and
+  written on the serving thread.
+- queued debug: every record, formatted and written by the listener
+  thread of setup_logging.
+- queued sampled: as above, with per message records sampled.
+- queued info: per message records below the level.
+Reports delivered messages/sec and the size of the log.
+
+    python benchmarks/log_pipeline.py --receivers 20 --messages 20000
+"""
+
+import os
+import time
+import asyncio
+import logging
+import tempfile
+import multiprocessing
+
+from argparse import ArgumentParser
+
+from sack.models import SackServer, HistoryPolicy, AsyncSackClient
+from sack.models.logs import FORMAT, setup_logging
+
+
+SETUPS = ("sync debug", "queued debug", "queued sampled", "queued info")
+
+
+def serve(port: int, setup: str, path: str) -> None:
+    with open(path, "w") as stream:
+        if setup == "sync debug":
+            logging.basicConfig(level=logging.DEBUG, format=FORMAT, stream=stream, force=True)
+        else:
+            level = logging.INFO if setup == "queued info" else logging.DEBUG
+            setup_logging(level, stream=stream)
+        sample_rate = 5.0 if setup == "queued sampled" else None
+        with SackServer(
+            "127.0.0.1", port, history_policy=HistoryPolicy(replay=0), log_sample_rate=sample_rate
+        ) as server:
+            server.serve()
+
+
+async def run(port: int, receivers: int, messages: int, size: int) -> float:
+    clients = [AsyncSackClient(host="127.0.0.1", port=port, username=f"receiver-{i}") for i in range(receivers)]
+    for client in clients:
+        await client.connect()
+        await client.join_request()
+    bot = AsyncSackClient(host="127.0.0.1", port=port, username="bot")
+    await bot.connect()
+    await bot.join_request()
+
+    async def receive(client: AsyncSackClient) -> None:
+        received = 0
+        async for message in client.messages():
+            if message.type == "TEXT":
+                received += 1
+                if received == messages:
+                    return
+
+    started = time.perf_counter()
+    receiving = [asyncio.create_task(receive(client)) for client in clients]
+    await bot.send_many("x" * size for _ in range(messages))
+    await asyncio.gather(*receiving)
+    elapsed = time.perf_counter() - started
+    for client in (*clients, bot):
+        await client.disconnect()
+    return receivers * messages / elapsed
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--receivers", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=100)
+    parser.add_argument("--port", type=int, default=9100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for i, setup in enumerate(SETUPS):
+            path = os.path.join(directory, f"{i}.log")
+            port = args.port + i
+            server = multiprocessing.Process(target=serve, args=(port, setup, path), daemon=True)
+            server.start()
+            time.sleep(0.5)
+            delivered = asyncio.run(run(port, args.receivers, args.messages, args.size))
+            server.kill()
+            server.join()
+            print(f"{setup:<16}{delivered:>12.0f} delivered/s{os.path.getsize(path) / 1024:>12.0f} KiB of log")
+
+
+if __name__ == "__main__":
+    main()
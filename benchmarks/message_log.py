@@ -0,0 +1,99 @@
+"""
+Message log benchmark: append throughput and cold-start recovery.
+
+Appends TEXT frames spread over a few rooms until the log reaches the
+requested size, then measures how long reopening the log takes, both
+after a clean shutdown and after a torn tail write, and how long reading
+a page of history takes.
+
+    python benchmarks/message_log.py --gigabytes 2 --size 256
+"""
+
+import os
+import time
+import random
+import shutil
+import tempfile
+import statistics
+
+from argparse import ArgumentParser
+
+from sack.models import LogPolicy, MessageLog
+from sack.models.protocol import encode_frame
+
+
+def append(directory: str, policy: LogPolicy, total: int, size: int, rooms: list[str]) -> int:
+    frames = [encode_frame("TEXT", f"user{i}", os.urandom(size // 2).hex().encode(), version=2) for i in range(64)]
+    log = MessageLog(directory, policy)
+    seq = 0
+    written = 0
+    started = time.perf_counter()
+    while written < total:
+        seq += 1
+        frame = frames[seq % len(frames)]
+        log.append(seq, rooms[seq % len(rooms)], frame)
+        written += len(frame)
+    log.close()
+    elapsed = time.perf_counter() - started
+    print(f"appended {seq} frames ({written / 2**30:.2f} GiB) in {elapsed:.1f} s")
+    print(f"append throughput: {seq / elapsed:,.0f} frames/s, {written / elapsed / 2**20:.0f} MiB/s")
+    return seq
+
+
+def reopen(directory: str, policy: LogPolicy, label: str) -> MessageLog:
+    started = time.perf_counter()
+    log = MessageLog(directory, policy)
+    print(f"cold start ({label}): {(time.perf_counter() - started) * 1e3:.1f} ms, last seq {log.last_seq}")
+    return log
+
+
+def tear_tail(directory: str) -> None:
+    last = sorted(name for name in os.listdir(directory) if name.endswith(".log"))[-1]
+    with open(os.path.join(directory, last), "r+b") as f:
+        data = f.read()
+        end = len(data.rstrip(b"\0"))
+        # a record header promising more bytes than made it to disk
+        f.seek(end + 8)
+        f.write(b"\x00\x00\x01\x00torn")
+
+
+def read_pages(log: MessageLog, rooms: list[str], pages: int, limit: int) -> None:
+    latencies = []
+    for _ in range(pages):
+        before = random.randint(1, log.last_seq)
+        started = time.perf_counter()
+        log.read(random.choice(rooms), before, limit)
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    p50, p99 = statistics.median(latencies), latencies[int(pages * 0.99)]
+    print(f"page of {limit}: p50 {p50 * 1e6:.0f} us, p99 {p99 * 1e6:.0f} us")
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--gigabytes", type=float, default=2)
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--rooms", type=int, default=8)
+    parser.add_argument("--segment-bytes", type=int, default=64 * 1024 * 1024)
+    parser.add_argument("--fsync-interval", type=float, default=0.05)
+    parser.add_argument("--fsync-batch", type=int, default=1024)
+    parser.add_argument("--dir", default=None)
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp(prefix="sack-log-")
+    policy = LogPolicy(args.segment_bytes, sync_interval=args.fsync_interval, sync_batch=args.fsync_batch)
+    rooms = [f"room{i}" for i in range(args.rooms)]
+    try:
+        append(directory, policy, int(args.gigabytes * 2**30), args.size, rooms)
+        reopen(directory, policy, "clean").close()
+        tear_tail(directory)
+        log = reopen(directory, policy, "torn tail")
+        read_pages(log, rooms, 1000, 50)
+        log.close()
+    finally:
+        if not args.dir:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
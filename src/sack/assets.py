@@ -44,4 +44,11 @@ When the input field is focused, you can type and send messages
 to other users.
 
 When the message area is focused, you can use
-the available keybindings to scroll through messages."""
+the available keybindings to scroll through messages.
+
+Everyone starts in the 'general' room. Messages and the user list
+are scoped to the room you are in. Use ctrl+r to switch rooms,
+submit an empty name to leave the room and go back to 'general'.
+
+Recent messages of a room are shown when you join it,
+use ctrl+o to load older ones."""
@@ -0,0 +1,171 @@
+import time
+import uuid
+import socket
+import asyncio
+import logging
+import multiprocessing
+
+from typing import Any, Literal
+from dataclasses import asdict, dataclass
+
+from sack.models import SackClient, SackServer, HistoryPolicy, AsyncSackClient, AsyncSackServer
+
+
+@dataclass(frozen=True)
+class BenchConfig:
+    clients: int = 100
+    # messages per second sent by each client and the length of their text
+    rate: float = 1.0
+    size: int = 100
+    duration: float = 10.0
+    # connections being opened at the same time while joining
+    concurrency: int = 50
+    # how long to wait after the last send for messages still in flight
+    drain: float = 5.0
+
+
+def serve(engine: Literal["selectors", "asyncio"], host: str, port: int) -> None:
+    # replays would only slow the joins down, and per message logging the fanout
+    logging.getLogger().setLevel(logging.WARNING)
+    history_policy = HistoryPolicy(replay=0)
+    if engine == "asyncio":
+        asyncio.run(AsyncSackServer(host, port, history_policy=history_policy).serve())
+        return
+    with SackServer(host, port, history_policy=history_policy) as server:
+        server.serve()
+
+
+def start_server(engine: Literal["selectors", "asyncio"], host: str, port: int) -> multiprocessing.Process:
+    process = multiprocessing.Process(target=serve, args=(engine, host, port), daemon=True)
+    process.start()
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return process
+        except OSError:
+            if not process.is_alive() or time.monotonic() > deadline:
+                process.kill()
+                raise
+            time.sleep(0.05)
+
+
+def server_stats(host: str, port: int) -> dict[str, Any]:
+    client = SackClient(host=host, port=port)
+    client.connect()
+    try:
+        return client.request_stats()
+    finally:
+        client.disconnect()
+
+
+# the value below which a fraction q of the sorted samples fall
+def percentile(samples: list[float], q: float) -> float | None:
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+# every TEXT carries the run id and the time it was sent, so a delivery tells its own
+# fanout latency; sends are paced against a fixed schedule rather than after the
+# previous one, a server that falls behind gets the backlog and not a slower load
+async def run(host: str, port: int, config: BenchConfig) -> dict[str, Any]:
+    run_id = uuid.uuid4().hex[:8]
+    idle = await asyncio.to_thread(server_stats, host, port)
+
+    clients = [AsyncSackClient(host=host, port=port, username=f"bench-{run_id}-{i}") for i in range(config.clients)]
+    semaphore = asyncio.Semaphore(config.concurrency)
+
+    async def join(client: AsyncSackClient) -> None:
+        async with semaphore:
+            await client.connect(timeout=10)
+            await client.join_request()
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(join(client) for client in clients), return_exceptions=True)
+    join_seconds = time.perf_counter() - started
+    joined = [client for client, result in zip(clients, results, strict=True) if result is None]
+    if not joined:
+        raise SystemExit(f"no client could join: {results[0]!r}")
+    after_join = await asyncio.to_thread(server_stats, host, port)
+
+    latencies: list[float] = []
+    delivered = 0
+    last_delivery = 0.0
+
+    async def receive(client: AsyncSackClient) -> None:
+        nonlocal delivered, last_delivery
+        async for msg in client.messages():
+            if msg.type != "TEXT" or not msg.text or not msg.text.startswith(run_id):
+                continue
+            last_delivery = time.perf_counter()
+            delivered += 1
+            latencies.append(last_delivery - float(msg.text.split(" ", 2)[1]))
+
+    sent = 0
+    sending = time.perf_counter()
+
+    async def send(client: AsyncSackClient, offset: float) -> None:
+        nonlocal sent
+        due = sending + offset
+        while due < sending + config.duration:
+            await asyncio.sleep(due - time.perf_counter())
+            header = f"{run_id} {time.perf_counter():.6f} "
+            await client.send_text(header + "x" * max(0, config.size - len(header)))
+            sent += 1
+            due += 1 / config.rate
+
+    receivers = [asyncio.create_task(receive(client)) for client in joined]
+    # spread over one interval, so the clients do not all send at once
+    await asyncio.gather(*(send(client, i / len(joined) / config.rate) for i, client in enumerate(joined)))
+    deadline = time.perf_counter() + config.drain
+    while delivered < sent * len(joined) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+
+    end = await asyncio.to_thread(server_stats, host, port)
+    for receiver in receivers:
+        receiver.cancel()
+    await asyncio.gather(*(client.disconnect() for client in joined), return_exceptions=True)
+
+    latencies.sort()
+    delivering = (last_delivery or time.perf_counter()) - sending
+    return {
+        "target": f"{host}:{port}",
+        "config": asdict(config),
+        "joined": len(joined),
+        "failed": len(clients) - len(joined),
+        "join_seconds": join_seconds,
+        "joins_per_second": len(joined) / join_seconds,
+        "sent": sent,
+        "expected": sent * len(joined),
+        "delivered": delivered,
+        "delivered_per_second": delivered / delivering,
+        "latency": {
+            "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99),
+            "p999": percentile(latencies, 0.999),
+            "max": latencies[-1] if latencies else None,
+        },
+        "server": {
+            "rss_idle": idle["rss"],
+            "rss_joined": after_join["rss"],
+            "rss_end": end["rss"],
+            "fanout_latency": end["fanout_latency"],
+        },
+    }
+
+
+def render_summary(result: dict[str, Any]) -> str:
+    latency = {q: f"{value * 1000:.2f} ms" if value is not None else "-" for q, value in result["latency"].items()}
+    server = result["server"]
+    return "\n".join(
+        (
+            f"target     {result['target']} {result.get('engine') or ''}".rstrip(),
+            f"joined     {result['joined']} clients ({result['failed']} failed) "
+            f"in {result['join_seconds']:.2f} s, {result['joins_per_second']:.0f}/s",
+            f"delivered  {result['delivered']}/{result['expected']} messages, {result['delivered_per_second']:.0f}/s",
+            f"latency    p50 {latency['p50']}  p99 {latency['p99']}  p999 {latency['p999']}  max {latency['max']}",
+            f"server rss {server['rss_idle'] / 2**20:.1f} MiB idle, {server['rss_joined'] / 2**20:.1f} MiB joined, "
+            f"{server['rss_end'] / 2**20:.1f} MiB at the end",
+        )
+    )
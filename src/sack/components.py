@@ -1,13 +1,21 @@
-from typing import Any, Literal
-from datetime import datetime
+from bisect import bisect_right
+from typing import Any
+from itertools import accumulate
+from dataclasses import dataclass
 
 from textual import events
+from rich.text import Text
+from rich.style import Style
 from textual.app import ComposeResult
+from rich.segment import Segment
+from textual.cache import LRUCache
 from textual.color import Color
-from textual.widget import Widget
+from textual.strip import Strip
 from textual.binding import Binding
 from textual.widgets import Input, Label, Button, Static, TextArea
-from textual.containers import Right, Center, Container, VerticalScroll, HorizontalGroup
+from textual.geometry import Size
+from textual.containers import Right, Center, Container, HorizontalGroup
+from textual.scroll_view import ScrollView
 
 from sack import __version__
 from sack.assets import SACK_ASCII
@@ -32,29 +40,172 @@ class TextInput(TextArea):
         self._replace_via_keyboard("\n", start, end)
 
 
-class ChatMessage(Widget):
-    def __init__(
-        self,
-        orientation: Literal["left", "right"],
-        msg: str,
-        author: str,
-        color: Color | None = None,
-    ):
-        super().__init__()
-        self.orientation = orientation
-        self.msg = msg
-        self.author = author
-        self.add_class("msg-container")
-        self.add_class(self.orientation)
-        self.color = color
+# a line of the chat log, kept as it arrived and laid out when it is drawn
+@dataclass(frozen=True, slots=True)
+class ChatEntry:
+    text: str
+    # None for notifications
+    author: str | None = None
+    time: str = ""
+    own: bool = False
+    color: Color | None = None
 
-    def compose(self) -> ComposeResult:
-        container = Container(classes="msg")
-        if self.color:
-            setattr(container.styles, f"outline_{self.orientation}", ("solid", self.color))
-        with container:
-            yield Label(self.msg, classes="msg-text")
-            yield Label(f"{self.author} ({datetime.now().strftime('%H:%M')})", classes="msg-author")
+
+# draws only the lines in view: every entry is wrapped once per width and the
+# lines of the entries drawn lately are cached, so a redraw costs the same
+# however long the log is; past max_entries the oldest entries are dropped
+class ChatLog(ScrollView, can_focus=True):
+    COMPONENT_CLASSES = {"chat-log--notification", "chat-log--author", "chat-log--bar", "chat-log--own"}
+    BINDINGS = [
+        Binding("k", "scroll_up", "Scroll Up", show=False),
+        Binding("j", "scroll_down", "Scroll Down", show=False),
+        Binding("g", "scroll_home", "Scroll Home", show=False),
+        Binding("G", "scroll_end", "Scroll End", show=False),
+        Binding("u", "page_up", "Page Up", show=False),
+        Binding("d", "page_down", "Page Down", show=False),
+    ]
+
+    def __init__(self, *, max_entries: int = 5000, id: str | None = None) -> None:
+        super().__init__(id=id)
+        self.max_entries = max_entries
+        self.entries: list[ChatEntry] = []
+        # the height of every entry and the line it starts at, for the current width
+        self._heights: list[int] = []
+        self._starts: list[int] = []
+        self._width = 0
+        self._cache: LRUCache[tuple[ChatEntry, int], list[Strip]] = LRUCache(256)
+        # entries dropped off the front so far, an index taken before a drop
+        # is moved back by the difference
+        self.trimmed = 0
+        self._hold = False
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def write(self, entry: ChatEntry) -> None:
+        self.insert(len(self.entries), entry)
+
+    # entries inserted above the view push it down, so what is on screen stays put
+    def insert(self, index: int, entry: ChatEntry) -> None:
+        follow = self.is_vertical_scroll_end
+        index = min(index, len(self.entries))
+        self.entries.insert(index, entry)
+        height = len(self._render_entry(entry, self._width)) if self._width else 0
+        self._heights.insert(index, height)
+        if index == len(self._starts):
+            self._starts.append(self._starts[-1] + self._heights[-2] if self._starts else 0)
+        else:
+            self._starts.insert(index, self._starts[index])
+            for i in range(index + 1, len(self._starts)):
+                self._starts[i] += height
+        appended = index == len(self.entries) - 1
+        top = self.scroll_y
+        if not appended and self._starts[index] <= top:
+            top += height
+        # only appends trim; after an insert above, a page of history asked for,
+        # they wait until the log doubles, and what is in view is never dropped
+        self._hold = (self._hold or not appended) and len(self.entries) <= 2 * self.max_entries
+        # trimmed in steps, the starts are rebuilt once for many entries
+        if appended and not self._hold and len(self.entries) > self.max_entries + self.max_entries // 8:
+            above = len(self.entries) if follow else bisect_right(self._starts, top) - 1
+            dropped = min(len(self.entries) - self.max_entries, above)
+            top -= sum(self._heights[:dropped])
+            del self.entries[:dropped]
+            del self._heights[:dropped]
+            self.trimmed += dropped
+            self._update_starts()
+        self._update_size()
+        if follow:
+            self.scroll_end(animate=False, immediate=True, x_axis=False)
+        else:
+            self.scroll_to(y=max(0, top), animate=False, immediate=True)
+
+    def clear(self) -> None:
+        self._hold = False
+        self.entries.clear()
+        self._heights.clear()
+        self._starts.clear()
+        self._cache.clear()
+        self._update_size()
+        self.scroll_home(animate=False, immediate=True)
+
+    def notify_style_update(self) -> None:
+        super().notify_style_update()
+        self._cache.clear()
+
+    def on_resize(self) -> None:
+        width = self.scrollable_content_region.width
+        if width == self._width:
+            return
+        self._width = width
+        self._heights = [len(self._render_entry(entry, width)) for entry in self.entries]
+        self._update_starts()
+        self._update_size()
+
+    def render_line(self, y: int) -> Strip:
+        line = self.scroll_offset.y + y
+        width = self.scrollable_content_region.width
+        index = bisect_right(self._starts, line) - 1
+        if index < 0 or width != self._width:
+            return Strip.blank(width, self.rich_style)
+        lines = self._render_entry(self.entries[index], width)
+        offset = line - self._starts[index]
+        if offset >= len(lines):
+            return Strip.blank(width, self.rich_style)
+        return lines[offset].apply_offsets(0, line)
+
+    def _update_starts(self) -> None:
+        self._starts = list(accumulate(self._heights, initial=0))[:-1]
+
+    def _update_size(self) -> None:
+        height = self._starts[-1] + self._heights[-1] if self._starts else 0
+        self.virtual_size = Size(self._width, height)
+        self.refresh()
+
+    def _render_entry(self, entry: ChatEntry, width: int) -> list[Strip]:
+        key = (entry, width)
+        if (lines := self._cache.get(key)) is None:
+            lines = self._layout(entry, width)
+            self._cache[key] = lines
+        return lines
+
+    def _layout(self, entry: ChatEntry, width: int) -> list[Strip]:
+        console = self.app.console
+        base = self.rich_style
+        blank = Strip.blank(width, base)
+        if entry.author is None:
+            style = base + self.get_component_rich_style("chat-log--notification")
+            text = Text(entry.text, style=style, justify="center", overflow="fold")
+            return [
+                *(
+                    Strip(line.render(console)).extend_cell_length(width, base)
+                    for line in text.wrap(console, width, justify="center")
+                ),
+                blank,
+            ]
+
+        # a box of at most 70% of the width with a bar on the side of its author
+        inner = max(1, int(width * 0.7) - 4)
+        header = f"{entry.author} ({entry.time})" if entry.time else entry.author
+        author = Text(header, style=base + self.get_component_rich_style("chat-log--author"))
+        body = [*Text(entry.text, style=base, overflow="fold").wrap(console, inner), *author.wrap(console, inner)]
+        content = max(line.cell_len for line in body)
+        if entry.own:
+            bar_style = base + self.get_component_rich_style("chat-log--own")
+        elif entry.color:
+            bar_style = base + Style(color=entry.color.rich_color)
+        else:
+            bar_style = base + self.get_component_rich_style("chat-log--bar")
+        bar = Segment("\u258c", bar_style)
+        lines = []
+        for line in body:
+            segments = [*line.render(console), Segment(" " * (content - line.cell_len), base)]
+            if entry.own:
+                segments = [Segment(" " * (width - content - 3), base), *segments, Segment(" ", base), bar]
+            else:
+                segments = [bar, Segment(" ", base), *segments]
+            lines.append(Strip(segments).adjust_cell_length(width, base))
+        return [*lines, blank]
 
 
 class Options(Container):
@@ -77,17 +228,6 @@ class Option(HorizontalGroup):
         yield Button(id=self.option_key)
 
 
-class VimVerticalScroll(VerticalScroll):
-    BINDINGS = [
-        Binding("k", "scroll_up", "Scroll Up", show=False),
-        Binding("j", "scroll_down", "Scroll Down", show=False),
-        Binding("g", "scroll_home", "Scroll Home", show=False),
-        Binding("G", "scroll_end", "Scroll End", show=False),
-        Binding("u", "page_up", "Page Up", show=False),
-        Binding("d", "page_down", "Page Down", show=False),
-    ]
-
-
 class FormErrors(Center):
     def __init__(self):
         super().__init__()
@@ -182,12 +322,20 @@ class ChatSidebar(Container):
 
 
 class ChatHeader(HorizontalGroup):
-    def __init__(self, host: str, port: int) -> None:
+    def __init__(self, host: str, port: int, room: str) -> None:
         super().__init__()
         self.host = host
         self.port = port
+        self.room = room
 
     def compose(self) -> ComposeResult:
-        yield Label(f"[$secondary]server[/] {self.host}:{self.port}")
+        yield Label(self._server_info(), id="server-info")
         with Right(id="right"):
             yield Label(f"[$secondary]sack[/] v{__version__}  [$secondary]help[/] f1")
+
+    def set_room(self, room: str) -> None:
+        self.room = room
+        self.query_one("#server-info", Label).update(self._server_info())
+
+    def _server_info(self) -> str:
+        return f"[$secondary]server[/] {self.host}:{self.port}  [$secondary]room[/] {self.room}"
@@ -1,53 +1,307 @@
+import json
 import signal
+import socket
+import asyncio
 import logging
 import threading
 
-from typing import Protocol
+from typing import Literal, Protocol
 from argparse import ArgumentParser
+from functools import partial
 from collections.abc import Sequence
 
-from sack.models import SackClient, SackServer
+from sack.bench import BenchConfig, run, start_server, render_summary
+from sack.models import (
+    LogPolicy,
+    MessageLog,
+    SackClient,
+    SackServer,
+    BatchPolicy,
+    ResumePolicy,
+    HistoryPolicy,
+    AdmissionPolicy,
+    AsyncSackServer,
+    HeartbeatPolicy,
+    RateLimitPolicy,
+    ReconnectPolicy,
+    CompressionPolicy,
+    SlowConsumerPolicy,
+    SackClientServerError,
+)
+from sack.profiling import Profiler
+from sack.models.logs import setup_logging
+from sack.models.metrics import render_text
+from sack.models.workers import serve_workers
+from sack.models.federation import Federation
+from sack.models.compression import CompressionStats
 
 
 def main() -> None:
-    logging.basicConfig(level=logging.DEBUG, format="%(asctime)s | %(levelname)s | %(name)s: %(message)s")
     args = get_args()
-    args.func(args)
+    listener = setup_logging(args.log_level)
+    try:
+        args.func(args)
+    finally:
+        listener.stop()
 
 
 def get_args(args: Sequence[str] | None = None):
+    # per message records are logged at DEBUG, at most --log-sample-rate a second
+    # for each call site, 0 logs all of them
+    logging_parser = ArgumentParser(add_help=False)
+    logging_parser.add_argument(
+        "--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], required=False, default="INFO"
+    )
+    logging_parser.add_argument("--log-sample-rate", type=float, required=False, default=5.0)
+
     parser = ArgumentParser()
-    parser.set_defaults(func=main)
+    parser.set_defaults(func=main, log_level="INFO", log_sample_rate=5.0)
     subparsers = parser.add_subparsers()
 
-    server_subparser = subparsers.add_parser("server")
+    server_subparser = subparsers.add_parser("server", parents=[logging_parser])
     server_subparser.add_argument("-p", "--port", type=int, required=False, default=8080)
     server_subparser.add_argument("--host", required=False, default="localhost")
+    server_subparser.add_argument("--engine", choices=["selectors", "asyncio"], required=False, default="selectors")
+    server_subparser.add_argument(
+        "--slow-consumer", choices=["drop-oldest", "disconnect", "coalesce"], required=False, default="disconnect"
+    )
+    server_subparser.add_argument("--max-backlog", type=int, required=False, default=4 * 1024 * 1024)
+    server_subparser.add_argument("--max-lag", type=float, required=False, default=None)
+    # batching is off unless asked for, benchmarks/batching.py shows no gain over
+    # the single sendmsg the outbox already makes of every queued frame
+    server_subparser.add_argument("--batch-delay", type=float, required=False, default=None)
+    server_subparser.add_argument("--batch-bytes", type=int, required=False, default=64 * 1024)
+    server_subparser.add_argument("--compress-threshold", type=int, required=False, default=None)
+    server_subparser.add_argument("--compress-level", type=int, required=False, default=6)
+    server_subparser.add_argument("--history", type=int, required=False, default=1000)
+    server_subparser.add_argument("--history-bytes", type=int, required=False, default=1024 * 1024)
+    server_subparser.add_argument("--replay", type=int, required=False, default=50)
+    server_subparser.add_argument("--history-dir", required=False, default=None)
+    server_subparser.add_argument("--segment-bytes", type=int, required=False, default=64 * 1024 * 1024)
+    server_subparser.add_argument("--fsync-interval", type=float, required=False, default=0.05)
+    server_subparser.add_argument("--fsync-batch", type=int, required=False, default=1024)
+    server_subparser.add_argument("--resume-grace", type=float, required=False, default=30.0)
+    server_subparser.add_argument("--ping-interval", type=float, required=False, default=15.0)
+    server_subparser.add_argument("--ping-timeout", type=float, required=False, default=45.0)
+    server_subparser.add_argument("--max-connections", type=int, required=False, default=None)
+    server_subparser.add_argument("--max-per-ip", type=int, required=False, default=None)
+    server_subparser.add_argument("--accept-batch", type=int, required=False, default=64)
+    server_subparser.add_argument("--rate", type=float, required=False, default=None)
+    server_subparser.add_argument("--burst", type=int, required=False, default=40)
+    server_subparser.add_argument(
+        "--rate-action", choices=["drop", "delay", "disconnect"], required=False, default="drop"
+    )
+    server_subparser.add_argument("--stats-socket", required=False, default=None)
+    server_subparser.add_argument("--workers", type=int, required=False, default=1)
+    server_subparser.add_argument("--node-id", required=False, default=None)
+    server_subparser.add_argument("--peer-listen", type=address, required=False, default=None)
+    server_subparser.add_argument("--peer", type=address, action="append", required=False, default=[])
+    server_subparser.add_argument("--profile", required=False, default=None)
+    server_subparser.add_argument("--profiler", choices=["cprofile", "sample"], required=False, default="cprofile")
     server_subparser.set_defaults(func=server_controller)
 
-    client_subparser = subparsers.add_parser("client")
+    client_subparser = subparsers.add_parser("client", parents=[logging_parser])
     client_subparser.add_argument("-p", "--port", type=int, required=False, default=8080)
     client_subparser.add_argument("--host", required=False, default="localhost")
     client_subparser.add_argument("--username", required=True)
     client_subparser.set_defaults(func=client_controller)
 
+    stats_subparser = subparsers.add_parser("stats", parents=[logging_parser])
+    stats_subparser.add_argument("-p", "--port", type=int, required=False, default=8080)
+    stats_subparser.add_argument("--host", required=False, default="localhost")
+    # the stats socket only gives text
+    stats_output = stats_subparser.add_mutually_exclusive_group()
+    stats_output.add_argument("--socket", required=False, default=None)
+    stats_output.add_argument("--json", action="store_true")
+    stats_subparser.set_defaults(func=stats_controller)
+
+    bench_subparser = subparsers.add_parser("bench", parents=[logging_parser])
+    bench_subparser.add_argument("-p", "--port", type=int, required=False, default=8090)
+    bench_subparser.add_argument("--host", required=False, default="127.0.0.1")
+    bench_subparser.add_argument("--engine", choices=["selectors", "asyncio"], required=False, default="selectors")
+    bench_subparser.add_argument("--target", type=address, required=False, default=None)
+    bench_subparser.add_argument("--clients", type=int, required=False, default=100)
+    bench_subparser.add_argument("--rate", type=float, required=False, default=1.0)
+    bench_subparser.add_argument("--size", type=int, required=False, default=100)
+    bench_subparser.add_argument("--duration", type=float, required=False, default=10.0)
+    bench_subparser.add_argument("--concurrency", type=int, required=False, default=50)
+    bench_subparser.add_argument("--drain", type=float, required=False, default=5.0)
+    bench_subparser.add_argument("--output", required=False, default=None)
+    bench_subparser.set_defaults(func=bench_controller)
+
     arguments = parser.parse_args(args)
     return arguments
 
 
+def address(value: str) -> tuple[str, int]:
+    host, _, port = value.rpartition(":")
+    return host or "localhost", int(port)
+
+
 class ServerControllerArgs(Protocol):
     host: str
     port: int
+    engine: Literal["selectors", "asyncio"]
+    slow_consumer: Literal["drop-oldest", "disconnect", "coalesce"]
+    max_backlog: int
+    max_lag: float | None
+    batch_delay: float | None
+    batch_bytes: int
+    compress_threshold: int | None
+    compress_level: int
+    history: int
+    history_bytes: int
+    replay: int
+    history_dir: str | None
+    segment_bytes: int
+    fsync_interval: float
+    fsync_batch: int
+    resume_grace: float
+    ping_interval: float
+    ping_timeout: float
+    max_connections: int | None
+    max_per_ip: int | None
+    accept_batch: int
+    rate: float | None
+    burst: int
+    rate_action: Literal["drop", "delay", "disconnect"]
+    stats_socket: str | None
+    workers: int
+    node_id: str | None
+    peer_listen: tuple[str, int] | None
+    peer: list[tuple[str, int]]
+    profile: str | None
+    profiler: Literal["cprofile", "sample"]
+    log_sample_rate: float
 
 
+# --profile profiles from the start, SIGUSR1 starts and stops it at any time and SIGUSR2
+# snapshots allocations; whatever was profiled is written when the server stops
 def server_controller(args: ServerControllerArgs) -> None:
+    profiler = Profiler(args.profile, mode=args.profiler)
+    profiler.install()
+    if args.profile:
+        profiler.start()
+    try:
+        serve(args)
+    finally:
+        profiler.stop()
+
+
+# a forked worker does not carry on the profile of the parent, with --profile it
+# profiles itself into a file of its own, named with its pid
+def worker_profiler(path: str, mode: Literal["cprofile", "sample"]) -> Profiler:
+    profiler = Profiler(path, mode=mode)
+    profiler.install()
+    return profiler
+
+
+def serve(args: ServerControllerArgs) -> None:
+    policy = SlowConsumerPolicy(args.slow_consumer, args.max_backlog, args.max_lag)
+    history_policy = HistoryPolicy(args.history, args.history_bytes, args.replay)
+    resume_policy = ResumePolicy(args.resume_grace)
+    heartbeat_policy = HeartbeatPolicy(args.ping_interval, max(args.ping_timeout, args.ping_interval))
+    admission_policy = AdmissionPolicy(args.max_connections, args.max_per_ip, args.accept_batch)
+    rate_limit_policy = RateLimitPolicy(args.rate, args.burst, args.rate_action) if args.rate else None
+    batch_policy = BatchPolicy(args.batch_delay, args.batch_bytes) if args.batch_delay else None
+    compression_policy = None
+    if args.compress_threshold is not None:
+        compression_policy = CompressionPolicy(args.compress_threshold, args.compress_level)
+    federation = None
+    if args.peer_listen or args.peer:
+        node_id = args.node_id or f"{args.host}:{args.port}"
+        federation = Federation(node_id, listen=args.peer_listen, peers=args.peer)
+
+    if args.workers > 1:
+        if args.engine != "selectors" or federation or args.history_dir or args.stats_socket:
+            raise SystemExit(
+                "--workers is only supported by the selectors engine "
+                "without federation, --history-dir or --stats-socket"
+            )
+        # each worker keeps its own sessions and seqs, a resuming client lands on any of them
+        if args.resume_grace > 0:
+            raise SystemExit("--workers needs --resume-grace 0, sessions are not shared between workers")
+        serve_workers(
+            args.host,
+            args.port,
+            args.workers,
+            slow_consumer_policy=policy,
+            history_policy=history_policy,
+            resume_policy=resume_policy,
+            heartbeat_policy=heartbeat_policy,
+            admission_policy=admission_policy,
+            rate_limit_policy=rate_limit_policy,
+            batch_policy=batch_policy,
+            compression_policy=compression_policy,
+            log_sample_rate=args.log_sample_rate or None,
+            profiler=partial(worker_profiler, args.profile, args.profiler) if args.profile else None,
+        )
+        return
+
+    message_log = None
+    if args.history_dir:
+        log_policy = LogPolicy(args.segment_bytes, sync_interval=args.fsync_interval, sync_batch=args.fsync_batch)
+        message_log = MessageLog(args.history_dir, log_policy)
+
+    if args.engine == "asyncio":
+        if federation:
+            raise SystemExit("federation is only supported by the selectors engine")
+        async_server = AsyncSackServer(
+            args.host,
+            args.port,
+            slow_consumer_policy=policy,
+            history_policy=history_policy,
+            resume_policy=resume_policy,
+            heartbeat_policy=heartbeat_policy,
+            admission_policy=admission_policy,
+            rate_limit_policy=rate_limit_policy,
+            message_log=message_log,
+            stats_path=args.stats_socket,
+            batch_policy=batch_policy,
+            compression_policy=compression_policy,
+            log_sample_rate=args.log_sample_rate or None,
+        )
+        signal.signal(signal.SIGINT, lambda *_: async_server.stop())
+        asyncio.run(async_server.serve())
+        report_compression(async_server.get_compression_stats())
+        return
+
     def sigint_handler(*_):
         s.stop()
 
     signal.signal(signal.SIGINT, sigint_handler)
 
-    with SackServer(args.host, args.port) as s:
+    with SackServer(
+        args.host,
+        args.port,
+        slow_consumer_policy=policy,
+        history_policy=history_policy,
+        resume_policy=resume_policy,
+        heartbeat_policy=heartbeat_policy,
+        admission_policy=admission_policy,
+        rate_limit_policy=rate_limit_policy,
+        message_log=message_log,
+        stats_path=args.stats_socket,
+        batch_policy=batch_policy,
+        compression_policy=compression_policy,
+        cluster=federation,
+        log_sample_rate=args.log_sample_rate or None,
+    ) as s:
         s.serve()
+    report_compression(s.get_compression_stats())
+
+
+def report_compression(stats: CompressionStats | None) -> None:
+    if not stats or not stats.frames:
+        return
+    logging.getLogger("server").info(
+        "compressed %d frames, %d -> %d bytes (ratio %.2f), %.1f us cpu per frame",
+        stats.frames,
+        stats.bytes_in,
+        stats.bytes_out,
+        stats.ratio,
+        stats.cpu_per_frame * 1e6,
+    )
 
 
 class ClientControllerArgs(Protocol):
@@ -57,15 +311,12 @@ class ClientControllerArgs(Protocol):
 
 
 def client_controller(args: ClientControllerArgs) -> None:
-    client = SackClient(host=args.host, port=args.port, username=args.username)
+    client = SackClient(host=args.host, port=args.port, username=args.username, reconnect_policy=ReconnectPolicy())
     client.connect()
     client.join_request()
 
     def listen():
-        while True:
-            msg = client.receive_message()
-            if msg is None:
-                continue
+        for msg in client.messages():
             if msg.username == args.username:
                 continue
             if msg.type == "CONNECT":
@@ -82,4 +333,67 @@ def client_controller(args: ClientControllerArgs) -> None:
         text = input()
         if text == "q":
             exit()
-        client.send_text(text)
+        try:
+            client.send_text(text)
+        except SackClientServerError:
+            # the listener is reconnecting, or gave up
+            print("not connected, message not sent")
+
+
+class StatsControllerArgs(Protocol):
+    host: str
+    port: int
+    socket: str | None
+    json: bool
+
+
+# the Unix socket of a server started with --stats-socket gives the metrics as text,
+# without it they are asked for with STATS
+def stats_controller(args: StatsControllerArgs) -> None:
+    if args.socket:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(args.socket)
+            print(b"".join(iter(lambda: sock.recv(65536), b"")).decode(), end="")
+        return
+    client = SackClient(host=args.host, port=args.port)
+    client.connect()
+    stats = client.request_stats()
+    client.disconnect()
+    print(json.dumps(stats, indent=2) if args.json else render_text(stats), end="\n" if args.json else "")
+
+
+class BenchControllerArgs(Protocol):
+    host: str
+    port: int
+    engine: Literal["selectors", "asyncio"]
+    target: tuple[str, int] | None
+    clients: int
+    rate: float
+    size: int
+    duration: float
+    concurrency: int
+    drain: float
+    output: str | None
+
+
+# starts a server of the given engine, or loads the one at --target, and writes the
+# results as JSON to --output so runs can be compared across engines and releases
+def bench_controller(args: BenchControllerArgs) -> None:
+    logging.getLogger().setLevel(logging.WARNING)
+    config = BenchConfig(args.clients, args.rate, args.size, args.duration, args.concurrency, args.drain)
+    server = None
+    if args.target:
+        host, port = args.target
+    else:
+        host, port = args.host, args.port
+        server = start_server(args.engine, host, port)
+    try:
+        result = asyncio.run(run(host, port, config))
+    finally:
+        if server:
+            server.kill()
+    result["engine"] = None if args.target else args.engine
+    print(render_summary(result))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
@@ -35,6 +35,8 @@ CHAT_KB = [
     ("enter", "send message"),
     ("shift+enter", "new line"),
     ("ctrl+s", "toggle sidebar"),
+    ("ctrl+r", "switch room"),
+    ("ctrl+o", "older messages"),
     ("ctrl+t", "change theme"),
     ("ctrl+c", "exit"),
     ("esc", "menu"),
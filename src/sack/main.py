@@ -1,3 +1,4 @@
+from argparse import ArgumentParser
 from multiprocessing import Process
 
 from textual.app import App, ComposeResult
@@ -15,6 +16,7 @@ from sack.screens import (
     ClientPromptScreen,
     ServerPromptScreen,
 )
+from sack.profiling import Profiler
 from sack.components import Option, Options, SackHeader
 from sack.keybindings import WELCOME_KB
 
@@ -35,8 +37,10 @@ class SackApp(App):
     ]
     ENABLE_COMMAND_PALETTE = False
 
-    def __init__(self):
+    def __init__(self, scrollback: int = 5000):
         super().__init__()
+        # how many entries the chat log keeps
+        self.scrollback = scrollback
         self.HEADER_BREAKPOINT = 20
         self.server_process: Process | None = None
         self.client: AsyncSackClient | None = None
@@ -96,8 +100,22 @@ class SackApp(App):
 
 
 def main(*_):
-    app = SackApp()
-    app.run()
+    parser = ArgumentParser()
+    parser.add_argument("--profile", required=False, default=None)
+    parser.add_argument("--profiler", choices=["cprofile", "sample"], required=False, default="cprofile")
+    parser.add_argument("--scrollback", type=int, required=False, default=5000)
+    args = parser.parse_args()
+
+    # as in sack-dev server: SIGUSR1 starts and stops profiling, SIGUSR2 snapshots allocations
+    profiler = Profiler(args.profile, mode=args.profiler)
+    profiler.install()
+    if args.profile:
+        profiler.start()
+    app = SackApp(args.scrollback)
+    try:
+        app.run()
+    finally:
+        profiler.stop()
 
 
 if __name__ == "__main__":
@@ -1,12 +1,20 @@
 from .client import (
     SackClient,
     AsyncSackClient,
+    ReconnectPolicy,
     SackClientError,
     SackClientServerError,
     SackClientUsernameError,
 )
-from .server import SackServer
+from .fanout import Outbox, BatchPolicy, SlowConsumerPolicy
+from .server import SackServer, AsyncSackServer
+from .history import HistoryPolicy
 from .protocol import SackMessage
+from .sessions import ResumePolicy
+from .admission import AdmissionPolicy, RateLimitPolicy
+from .heartbeat import HeartbeatPolicy
+from .messagelog import LogPolicy, MessageLog
+from .compression import CompressionPolicy
 
 
 __all__ = [
@@ -15,6 +23,19 @@ __all__ = [
     "SackClientError",
     "SackClientServerError",
     "SackClientUsernameError",
+    "ReconnectPolicy",
     "SackServer",
+    "AsyncSackServer",
     "SackMessage",
+    "Outbox",
+    "SlowConsumerPolicy",
+    "BatchPolicy",
+    "HistoryPolicy",
+    "ResumePolicy",
+    "HeartbeatPolicy",
+    "AdmissionPolicy",
+    "RateLimitPolicy",
+    "MessageLog",
+    "LogPolicy",
+    "CompressionPolicy",
 ]
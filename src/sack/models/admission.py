@@ -0,0 +1,76 @@
+import time
+
+from typing import Literal
+from dataclasses import dataclass
+
+
+# messages that cost the server a broadcast or a lookup, CONNECT, RESUME,
+# DISCONNECT and heartbeats are never limited
+RATE_LIMITED = frozenset(("TEXT", "GETNICKNAMES", "HISTORY", "JOIN", "LEAVE", "STATS"))
+
+
+@dataclass(frozen=True)
+class AdmissionPolicy:
+    max_connections: int | None = None
+    max_per_ip: int | None = None
+    # connections taken from the backlog per wakeup of the listening socket
+    accept_batch: int = 64
+
+
+@dataclass(frozen=True)
+class RateLimitPolicy:
+    # messages per second, with bursts of up to burst messages
+    rate: float = 20.0
+    burst: int = 40
+    # what happens to a message over the rate: it is dropped, the client is
+    # not read from until it would fit, or the client is disconnected
+    action: Literal["drop", "delay", "disconnect"] = "drop"
+
+    def bucket(self) -> "TokenBucket":
+        return TokenBucket(self.rate, self.burst)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._time = time.monotonic()
+
+    # takes a token, or returns how long until there is one
+    def take(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._time) * self.rate)
+        self._time = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class Admission:
+    def __init__(self, policy: AdmissionPolicy | None = None) -> None:
+        self.policy = policy or AdmissionPolicy()
+        self.connections = 0
+        self._per_ip: dict[str, int] = {}
+
+    def admit(self, address: str) -> bool:
+        policy = self.policy
+        if policy.max_connections is not None and self.connections >= policy.max_connections:
+            return False
+        count = self._per_ip.get(address, 0)
+        if policy.max_per_ip is not None and count >= policy.max_per_ip:
+            return False
+        self._per_ip[address] = count + 1
+        self.connections += 1
+        return True
+
+    def release(self, address: str) -> None:
+        count = self._per_ip.get(address)
+        if count is None:
+            return
+        if count > 1:
+            self._per_ip[address] = count - 1
+        else:
+            del self._per_ip[address]
+        self.connections -= 1
@@ -0,0 +1,145 @@
+import socket
+import selectors
+
+from enum import IntEnum
+from typing import Protocol
+
+from sack.models.fanout import Outbox, SlowConsumerPolicy
+from sack.models.protocol import RECV_BUFFER_SIZE
+
+
+class BusOp(IntEnum):
+    CLAIM = 1
+    ACCEPT = 2
+    REJECT = 3
+    RELEASE = 4
+    JOINED = 5
+    LEFT = 6
+    RELAY = 7
+    HELLO = 8
+
+
+BUS_HEADER_SIZE = 5
+BUS_POLICY = SlowConsumerPolicy("disconnect", max_bytes=256 * 1024 * 1024)
+
+BusFrame = tuple[BusOp, bytes]
+
+
+def encode_bus_frame(op: BusOp, payload: bytes) -> bytes:
+    return op.to_bytes(1, "big") + len(payload).to_bytes(4, "big") + payload
+
+
+def encode_room_frame(room: str, frame: bytes) -> bytes:
+    room_bytes = room.encode()
+    return len(room_bytes).to_bytes(1, "big") + room_bytes + frame
+
+
+def decode_room_frame(payload: bytes) -> tuple[str, bytes]:
+    room_end = 1 + payload[0]
+    return payload[1:room_end].decode(), payload[room_end:]
+
+
+class Cluster(Protocol):
+    # claim answers True or False right away, or None when the answer
+    # arrives later as an ACCEPT or REJECT frame from handle_event or flush;
+    # published frames come back to the other nodes as RELAY frames tagged with the room
+    def attach(self, selector: selectors.BaseSelector) -> None: ...
+    def handle_event(self, key: selectors.SelectorKey, mask: int) -> list[BusFrame] | None: ...
+    def claim(self, username: str) -> bool | None: ...
+    def release(self, username: str) -> None: ...
+    def publish(self, room: str, frame: bytes) -> None: ...
+    def flush(self) -> list[BusFrame]: ...
+    # seconds until flush has work of its own to do, None when it has none
+    def timeout(self) -> float | None: ...
+    def close(self) -> None: ...
+
+
+class BusLink:
+    def __init__(self, sock: socket.socket) -> None:
+        sock.setblocking(False)
+        self.sock = sock
+        self.outbox = Outbox(BUS_POLICY)
+        self.bytes_sent = 0
+        self._buffer = bytearray()
+
+    def send(self, op: BusOp, payload: bytes) -> bool:
+        frame = encode_bus_frame(op, payload)
+        self.bytes_sent += len(frame)
+        return self.outbox.put(frame)
+
+    def receive(self) -> list[BusFrame] | None:
+        try:
+            data = self.sock.recv(RECV_BUFFER_SIZE)
+        except BlockingIOError:
+            return []
+        except ConnectionError:
+            data = b""
+        if not data:
+            return None
+        self._buffer += data
+        return self._frames()
+
+    def flush(self, selector: selectors.BaseSelector, data: object) -> bool:
+        try:
+            drained = self.outbox.send(self.sock)
+        except OSError:
+            return False
+        events = selectors.EVENT_READ if drained else selectors.EVENT_READ | selectors.EVENT_WRITE
+        selector.modify(self.sock, events, data)
+        return True
+
+    def needs_flush(self, selector: selectors.BaseSelector) -> bool:
+        return bool(self.outbox.depth) and not selector.get_key(self.sock).events & selectors.EVENT_WRITE
+
+    def _frames(self) -> list[BusFrame]:
+        buffer = self._buffer
+        frames = []
+        pos = 0
+        while len(buffer) - pos >= BUS_HEADER_SIZE:
+            end = pos + BUS_HEADER_SIZE + int.from_bytes(buffer[pos + 1 : pos + BUS_HEADER_SIZE], "big")
+            if end > len(buffer):
+                break
+            frames.append((BusOp(buffer[pos]), bytes(buffer[pos + BUS_HEADER_SIZE : end])))
+            pos = end
+        del buffer[:pos]
+        return frames
+
+
+class WorkerBus:
+    def __init__(self, sock: socket.socket) -> None:
+        self._link = BusLink(sock)
+        self._selector: selectors.BaseSelector | None = None
+
+    def attach(self, selector: selectors.BaseSelector) -> None:
+        self._selector = selector
+        selector.register(self._link.sock, selectors.EVENT_READ, self)
+
+    def handle_event(self, key: selectors.SelectorKey, mask: int) -> list[BusFrame] | None:
+        assert self._selector
+        if mask & selectors.EVENT_WRITE and not self._link.flush(self._selector, self):
+            return None
+        if mask & selectors.EVENT_READ:
+            return self._link.receive()
+        return []
+
+    def claim(self, username: str) -> bool | None:
+        self._link.send(BusOp.CLAIM, username.encode())
+        return None
+
+    def release(self, username: str) -> None:
+        self._link.send(BusOp.RELEASE, username.encode())
+
+    def publish(self, room: str, frame: bytes) -> None:
+        self._link.send(BusOp.RELAY, encode_room_frame(room, frame))
+
+    def flush(self) -> list[BusFrame]:
+        assert self._selector
+        if self._link.needs_flush(self._selector):
+            self._link.flush(self._selector, self)
+        return []
+
+    def timeout(self) -> float | None:
+        return None
+
+    def close(self) -> None:
+        self._link.sock.close()
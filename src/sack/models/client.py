@@ -1,7 +1,31 @@
+import json
+import time
+import random
 import socket
 import asyncio
+import threading
 
-from sack.models.protocol import SackMessage, receive_message
+from typing import Any
+from collections import deque
+from dataclasses import dataclass
+from collections.abc import Iterable, Iterator, AsyncIterator
+
+from sack.models.protocol import (
+    DEFAULT_ROOM,
+    FEATURE_PING,
+    FEATURE_ZLIB,
+    MAX_FRAME_SIZE,
+    PROTOCOL_VERSION,
+    RECV_BUFFER_SIZE,
+    SackMessage,
+    SackProtocolError,
+    SackMessageDecoder,
+    encode_frame,
+    encode_hello,
+    encode_resume_request,
+    encode_history_request,
+)
+from sack.models.compression import Compressor
 
 
 class SackClientError(Exception):
@@ -16,13 +40,88 @@ class SackClientUsernameError(SackClientError):
     pass
 
 
+@dataclass(frozen=True)
+class ReconnectPolicy:
+    initial_delay: float = 0.5
+    max_delay: float = 30.0
+    multiplier: float = 2.0
+    # the part of each delay that is random, so clients dropped together
+    # do not all come back at once
+    jitter: float = 0.5
+    max_attempts: int | None = 8
+
+    def delays(self) -> Iterator[float]:
+        delay = self.initial_delay
+        attempt = 0
+        while self.max_attempts is None or attempt < self.max_attempts:
+            attempt += 1
+            yield delay * (1 - self.jitter * random.random())
+            delay = min(delay * self.multiplier, self.max_delay)
+
+
+PONG = encode_frame("PONG", "", version=2)
+
+
+# what a client needs to come back: the resume token the server gave it,
+# the last sequence number it saw and the room it was in
+class ResumeState:
+    def __init__(self) -> None:
+        self.token = ""
+        self.seq = 0
+        self.room = DEFAULT_ROOM
+
+    # control frames are taken out of what the client hands out, the
+    # number of pings is returned for the client to answer
+    def track(self, username: str | None, messages: list[SackMessage]) -> tuple[list[SackMessage], int]:
+        tracked = []
+        pings = 0
+        for message in messages:
+            if message.type == "RESUME":
+                self.token = message.text or ""
+                continue
+            if message.type in ("PING", "PONG"):
+                pings += message.type == "PING"
+                continue
+            if message.seq > self.seq:
+                self.seq = message.seq
+            if message.type == "JOIN" and message.username == username and message.text:
+                self.room = message.text
+            tracked.append(message)
+        return tracked, pings
+
+
 # todo username setter
 class SackClient:
-    def __init__(self, *, host: str, port: int, username: str | None = None) -> None:
+    def __init__(
+        self,
+        *,
+        host: str,
+        port: int,
+        username: str | None = None,
+        protocol: int = PROTOCOL_VERSION,
+        compression: bool = True,
+        reconnect_policy: ReconnectPolicy | None = None,
+    ) -> None:
         self.host = host
         self.port = port
         self.username = username
+        self.protocol = protocol
+        self.compression = compression
+        # with a reconnect policy messages() reconnects and resumes the session
+        self.reconnect_policy = reconnect_policy
+        self.resume = ResumeState()
+        self._compressor: Compressor | None = None
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._decoder = SackMessageDecoder(text_types=("TEXT", "GETNICKNAMES", "JOIN", "LEAVE"), version=1)
+        self._pending: deque[SackMessage] = deque()
+        self._joined = False
+        # pings are answered by the thread reading messages
+        self._send_lock = threading.Lock()
+
+    # the negotiated protocol version, 1 until the server answers the hello
+    @property
+    def version(self) -> int:
+        return self._decoder.version or 1
 
     def connect(self) -> None:
         try:
@@ -31,91 +130,393 @@ class SackClient:
             raise SackClientServerError from e
 
     def join_request(self) -> None:
-        assert self.username
-        msg = SackMessage("CONNECT", self.username)
-        self._socket.sendall(msg.to_bytes())
-        ok_no = self._socket.recv(2).decode()
-        if ok_no == "NO":
-            self.disconnect()
-            raise SackClientUsernameError
+        self._join(resume=False)
+
+    def reconnect(self) -> None:
+        assert self.reconnect_policy
+        self._joined = False
+        self._socket.close()
+        for delay in self.reconnect_policy.delays():
+            time.sleep(delay)
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._decoder = SackMessageDecoder(text_types=("TEXT", "GETNICKNAMES", "JOIN", "LEAVE"), version=1)
+            try:
+                self.connect()
+                self._join(resume=True)
+                return
+            except SackClientError:
+                # NO too, the username may still be held by the dropped session
+                self._socket.close()
+        raise SackClientServerError("could not reconnect")
 
     def disconnect(self) -> None:
-        self._socket.shutdown(socket.SHUT_RDWR)
+        if self._joined:
+            self._joined = False
+            assert self.username
+            try:
+                self._socket.sendall(SackMessage("DISCONNECT", self.username).to_bytes(self.version))
+            except OSError:
+                pass
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self._socket.close()
 
     def send_text(self, text: str) -> None:
         assert self.username
         msg = SackMessage("TEXT", self.username, text)
-        self._socket.sendall(msg.to_bytes())
+        self._sendall(msg.to_bytes(self.version, self._compressor))
 
-    def receive_message(self) -> SackMessage | None:
-        def on_empty():
-            raise SackClientServerError
+    def send_many(self, texts: Iterable[str]) -> None:
+        assert self.username
+        version = self.version
+        self._sendall(
+            b"".join(SackMessage("TEXT", self.username, text).to_bytes(version, self._compressor) for text in texts)
+        )
 
-        return receive_message(self._socket, on_empty)
+    # the server metrics, a connected client that has not joined gets them too
+    def request_stats(self) -> dict[str, Any]:
+        if not self._joined:
+            self._hello()
+        if self.version < 2:
+            raise SackClientServerError("STATS needs protocol v2")
+        self._sendall(SackMessage("STATS", self.username or "").to_bytes(self.version))
+        while True:
+            messages = self._messages()
+            for i, message in enumerate(messages):
+                if message.type == "STATS":
+                    self._pending.extend(messages[:i] + messages[i + 1 :])
+                    return json.loads(message.text or "{}")
+            self._pending.extend(messages)
+            self._receive()
+
+    def _hello(self) -> None:
+        if self.protocol < 2 or self.version > 1:
+            return
+        self._sendall(encode_hello(self.protocol, FEATURE_PING | (FEATURE_ZLIB if self.compression else 0)))
+        while (hello := self._decoder.take(3)) is None:
+            self._receive()
+        self._decoder.version = hello[1]
+        self._compressor = Compressor() if hello[2] & FEATURE_ZLIB else None
+
+    def _join(self, *, resume: bool) -> None:
+        assert self.username
+        self._hello()
+        version = self.version
+        if resume and version > 2:
+            self._sendall(encode_resume_request(self.username, self.resume.token, self.resume.seq, self.resume.room))
+        else:
+            self._sendall(SackMessage("CONNECT", self.username).to_bytes(version))
+        while (ok_no := self._decoder.take(2)) is None:
+            self._receive()
+        if ok_no == b"NO":
+            self.disconnect()
+            raise SackClientUsernameError
+        self._joined = True
+        self._pending.extend(self._messages())
+
+    def _sendall(self, data: bytes) -> None:
+        try:
+            with self._send_lock:
+                self._socket.sendall(data)
+        except OSError as e:
+            raise SackClientServerError from e
+
+    def receive_message(self) -> SackMessage:
+        while not self._pending:
+            self._receive()
+            self._pending.extend(self._messages())
+        return self._pending.popleft()
+
+    def messages(self) -> Iterator[SackMessage]:
+        while True:
+            while self._pending:
+                yield self._pending.popleft()
+            try:
+                self._receive()
+            except SackClientServerError:
+                if self.reconnect_policy is None or not self._joined:
+                    raise
+                self.reconnect()
+                continue
+            self._pending.extend(self._messages())
+
+    def _messages(self) -> list[SackMessage]:
+        try:
+            messages, pings = self.resume.track(self.username, self._decoder.messages())
+        except SackProtocolError as e:
+            raise SackClientServerError from e
+        if pings:
+            self._sendall(PONG)
+        return messages
+
+    def _receive(self) -> None:
+        try:
+            data = self._socket.recv(RECV_BUFFER_SIZE)
+        except OSError as e:
+            raise SackClientServerError from e
+        if not data:
+            raise SackClientServerError
+        self._decoder.feed(data)
 
 
 class AsyncSackClient:
-    def __init__(self, *, host: str, port: int, username: str | None = None) -> None:
+    def __init__(
+        self,
+        *,
+        host: str,
+        port: int,
+        username: str | None = None,
+        protocol: int = PROTOCOL_VERSION,
+        compression: bool = True,
+        read_size: int = RECV_BUFFER_SIZE,
+        buffer_limit: int = 2 * MAX_FRAME_SIZE,
+        high_water: int = 64 * 1024,
+        reconnect_policy: ReconnectPolicy | None = None,
+    ) -> None:
         self.host = host
         self.port = port
         self.username = username
+        self.protocol = protocol
+        self.compression = compression
+        # with a reconnect policy messages() reconnects and resumes the
+        # session, sends made meanwhile are queued and go out once it is back
+        self.reconnect_policy = reconnect_policy
+        self.resume = ResumeState()
+        self._joined = False
+        self._reconnecting = False
+        # bytes taken from the stream per wakeup, and how much may sit in the
+        # stream and the decoder before reading stops or the server is dropped
+        self.read_size = read_size
+        self.buffer_limit = buffer_limit
+        self._compressor: Compressor | None = None
+        self._decoder = SackMessageDecoder(text_types=("TEXT", "GETNICKNAMES", "JOIN", "LEAVE"), version=1)
+        self._pending: deque[SackMessage] = deque()
+        self._closed = False
+        # sends are queued and written together by the flusher task once the
+        # sender yields; past the high water mark the sender waits for a drain
+        self.high_water = high_water
+        self._outgoing: list[bytes] = []
+        self._outgoing_size = 0
+        self._wakeup = asyncio.Event()
+        self._flusher: asyncio.Task | None = None
+        self._send_error: Exception | None = None
+
+    # the negotiated protocol version, 1 until the server answers the hello
+    @property
+    def version(self) -> int:
+        return self._decoder.version or 1
 
     async def connect(self, *, timeout: float | None = None) -> None:
         try:
             async with asyncio.timeout(timeout):
-                reader, writer = await asyncio.open_connection(self.host, self.port)
+                reader, writer = await asyncio.open_connection(self.host, self.port, limit=self.buffer_limit)
         except Exception as e:
             raise SackClientServerError from e
         self._reader, self._writer = reader, writer
+        self._closed = False
 
     async def join_request(self) -> None:
-        assert self.username
-        msg = SackMessage("CONNECT", self.username)
-        self._writer.write(msg.to_bytes())
-        await self._writer.drain()
-        ok_no = await self._reader.read(2)
-        ok_no = ok_no.decode()
-        if ok_no == "NO":
-            raise SackClientUsernameError
+        await self._join(resume=False)
 
+    async def reconnect(self) -> None:
+        assert self.reconnect_policy
+        self._joined = False
+        self._reconnecting = True
+        if self._flusher:
+            self._flusher.cancel()
+            self._flusher = None
+        self._writer.close()
+        try:
+            for delay in self.reconnect_policy.delays():
+                await asyncio.sleep(delay)
+                if self._closed:
+                    return
+                self._decoder = SackMessageDecoder(text_types=("TEXT", "GETNICKNAMES", "JOIN", "LEAVE"), version=1)
+                try:
+                    await self.connect()
+                    await self._join(resume=True)
+                    return
+                except SackClientError:
+                    # NO too, the username may still be held by the dropped session
+                    self._writer.close()
+            raise SackClientServerError("could not reconnect")
+        finally:
+            self._reconnecting = False
+
+    # queued frames are written out first; a messages() iterator running
+    # in another task ends instead of raising
     async def disconnect(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._flusher:
+            self._flusher.cancel()
+            self._flusher = None
+        if self._joined:
+            # a clean logout, the server does not hold the session for a resume
+            self._joined = False
+            assert self.username
+            self._outgoing.append(SackMessage("DISCONNECT", self.username).to_bytes(self.version))
+        self._write_outgoing()
         self._writer.close()
-        await self._writer.wait_closed()
+        try:
+            await self._writer.wait_closed()
+        except ConnectionError:
+            pass
 
     async def send_text(self, text: str) -> None:
         assert self.username
         msg = SackMessage("TEXT", self.username, text)
-        self._writer.write(msg.to_bytes())
-        await self._writer.drain()
+        await self._send(msg.to_bytes(self.version, self._compressor))
+
+    async def send_many(self, texts: Iterable[str]) -> None:
+        assert self.username
+        version = self.version
+        await self._send(
+            *(SackMessage("TEXT", self.username, text).to_bytes(version, self._compressor) for text in texts)
+        )
+
+    # writes out the queued frames and waits for the transport to drain
+    async def flush(self) -> None:
+        if self._reconnecting:
+            return
+        self._write_outgoing()
+        try:
+            await self._writer.drain()
+        except ConnectionError as e:
+            raise SackClientServerError from e
 
     async def request_nicknames(self) -> None:
         assert self.username
         msg = SackMessage("GETNICKNAMES", self.username)
-        self._writer.write(msg.to_bytes())
+        await self._send(msg.to_bytes(self.version))
+
+    # answered with a STATS message carrying the server metrics as JSON
+    async def request_stats(self) -> None:
+        assert self.username
+        msg = SackMessage("STATS", self.username)
+        await self._send(msg.to_bytes(self.version))
+
+    async def request_history(self, before: int | None = None, limit: int = 50) -> None:
+        assert self.username
+        await self._send(encode_history_request(self.username, before, limit, self.version))
+
+    async def join_room(self, room: str) -> None:
+        assert self.username
+        msg = SackMessage("JOIN", self.username, room)
+        await self._send(msg.to_bytes(self.version))
+
+    async def leave_room(self, room: str) -> None:
+        assert self.username
+        msg = SackMessage("LEAVE", self.username, room)
+        await self._send(msg.to_bytes(self.version))
+
+    async def _join(self, *, resume: bool) -> None:
+        assert self.username
+        if self.protocol > 1:
+            self._writer.write(encode_hello(self.protocol, FEATURE_PING | (FEATURE_ZLIB if self.compression else 0)))
+            await self._writer.drain()
+            while (hello := self._decoder.take(3)) is None:
+                await self._receive()
+            self._decoder.version = hello[1]
+            self._compressor = Compressor() if hello[2] & FEATURE_ZLIB else None
+        version = self.version
+        if resume and version > 2:
+            self._writer.write(
+                encode_resume_request(self.username, self.resume.token, self.resume.seq, self.resume.room)
+            )
+        else:
+            self._writer.write(SackMessage("CONNECT", self.username).to_bytes(version))
         await self._writer.drain()
+        while (ok_no := self._decoder.take(2)) is None:
+            await self._receive()
+        if ok_no == b"NO":
+            raise SackClientUsernameError
+        self._joined = True
+        self._pending.extend(self._messages())
+        self._send_error = None
+        self._flusher = asyncio.create_task(self._flush_outgoing())
+        if self._outgoing:
+            self._wakeup.set()
+
+    async def _send(self, *frames: bytes) -> None:
+        if self._send_error and not (self._reconnecting or self.reconnect_policy):
+            raise SackClientServerError from self._send_error
+        self._outgoing.extend(frames)
+        self._outgoing_size += sum(len(frame) for frame in frames)
+        if self._reconnecting:
+            return
+        if self._flusher is None or self._outgoing_size >= self.high_water:
+            await self.flush()
+        else:
+            self._wakeup.set()
+
+    def _write_outgoing(self) -> None:
+        if self._outgoing:
+            self._writer.writelines(self._outgoing)
+            self._outgoing = []
+            self._outgoing_size = 0
 
-    async def receive_message(self) -> SackMessage | None:
-        message_len = await self._reader.read(1)
-        if not message_len:
+    async def _flush_outgoing(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            self._write_outgoing()
+            if self._writer.transport.get_write_buffer_size() < self.high_water:
+                continue
+            try:
+                await self._writer.drain()
+            except ConnectionError as e:
+                self._send_error = e
+                return
+
+    async def receive_message(self) -> SackMessage:
+        while not self._pending:
+            await self._receive()
+            self._pending.extend(self._messages())
+        return self._pending.popleft()
+
+    # every read decodes all the frames it completes, they are handed out
+    # without waiting again; messages not taken yet stay queued when the
+    # consuming task is cancelled
+    async def messages(self) -> AsyncIterator[SackMessage]:
+        while True:
+            while self._pending:
+                yield self._pending.popleft()
+            if self._closed:
+                return
+            try:
+                await self._receive()
+            except SackClientServerError:
+                if self._closed:
+                    return
+                if self.reconnect_policy is None or not self._joined:
+                    raise
+                await self.reconnect()
+                continue
+            self._pending.extend(self._messages())
+
+    def _messages(self) -> list[SackMessage]:
+        try:
+            messages, pings = self.resume.track(self.username, self._decoder.messages())
+        except SackProtocolError as e:
+            raise SackClientServerError from e
+        if pings:
+            # goes out with the next flush, or on the next connection
+            self._outgoing.append(PONG)
+            self._outgoing_size += len(PONG)
+            self._wakeup.set()
+        if len(self._decoder) > self.buffer_limit:
+            raise SackClientServerError(f"more than {self.buffer_limit} bytes of an incomplete frame")
+        return messages
+
+    async def _receive(self) -> None:
+        try:
+            data = await self._reader.read(self.read_size)
+        except OSError as e:
+            raise SackClientServerError from e
+        if not data:
             raise SackClientServerError
-        message_len = int.from_bytes(message_len, "big")
-        raw_message = await self._reader.read(message_len)
-        raw_message = raw_message.decode()
-        message_parts = raw_message.split("\n")
-        if not len(message_parts) == 2:
-            return None
-        type = message_parts[0]
-        username = message_parts[1]
-        if type not in ("CONNECT", "TEXT", "DISCONNECT", "GETNICKNAMES"):
-            return None
-        if type not in ("TEXT", "GETNICKNAMES"):
-            return SackMessage(type, username)
-        sep = await self._reader.read(1)
-        if sep != b"\n":
-            return None
-        text_len = await self._reader.read(2)
-        text_len = int.from_bytes(text_len, "big")
-        text = await self._reader.read(text_len)
-        text = text.decode()
-        return SackMessage(type, username, text)
+        self._decoder.feed(data)
@@ -0,0 +1,77 @@
+import time
+import zlib
+
+from dataclasses import dataclass
+
+
+# raw deflate, the frame header already tells a compressed text apart
+WBITS = -15
+
+# preset dictionary for chat text: common words and phrases, and the bits of
+# code, logs and tracebacks that make up most long pastes; zlib finds matches
+# nearer the end cheaper, so the most common strings go last
+ZLIB_DICTIONARY = (
+    b'Traceback (most recent call last):\n  File "", line , in \n'
+    b"Error: Exception: TypeError: ValueError: KeyError: AttributeError: None\n"
+    b"INFO WARNING ERROR DEBUG | 2026-01-01 00:00:00,000 127.0.0.1 localhost http://https://www. .com/ .org/\n"
+    b"def class import from return self. if else: elif for in while try: except with as not and or is True False\n"
+    b"function const let var => { } ( ) [ ] ; == != <= >= += \"\" '' ``` \n\n    \n        \n"
+    b"thanks thank you please sorry hello hi hey yes no okay ok lol haha :) :D ;) <3 "
+    b"good morning good night see you later have a nice day what do you think about "
+    b"I don't know I think it's I'm not sure can you could you would you do you have "
+    b"there is there are this is that is what is how do I why does it doesn't work "
+    b"the and to of a in is it you that for on with was as have be at this but not "
+)
+
+
+@dataclass(frozen=True)
+class CompressionPolicy:
+    threshold: int = 512
+    level: int = 6
+
+
+@dataclass
+class CompressionStats:
+    frames: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    cpu_seconds: float = 0.0
+
+    @property
+    def ratio(self) -> float:
+        return self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+
+    @property
+    def cpu_per_frame(self) -> float:
+        return self.cpu_seconds / self.frames if self.frames else 0.0
+
+
+class Compressor:
+    def __init__(self, policy: CompressionPolicy | None = None) -> None:
+        self.policy = policy or CompressionPolicy()
+        self.stats = CompressionStats()
+
+    # returns None for text under the threshold, or that does not get smaller
+    def compress(self, text: bytes | memoryview) -> bytes | None:
+        if len(text) < self.policy.threshold:
+            return None
+        started = time.thread_time()
+        compressor = zlib.compressobj(self.policy.level, zlib.DEFLATED, WBITS, zdict=ZLIB_DICTIONARY)
+        compressed = compressor.compress(text) + compressor.flush()
+        stats = self.stats
+        stats.cpu_seconds += time.thread_time() - started
+        stats.frames += 1
+        stats.bytes_in += len(text)
+        stats.bytes_out += min(len(compressed), len(text))
+        return compressed if len(compressed) < len(text) else None
+
+
+def decompress(data: bytes | bytearray | memoryview, max_length: int) -> bytes | None:
+    decompressor = zlib.decompressobj(WBITS, zdict=ZLIB_DICTIONARY)
+    try:
+        text = decompressor.decompress(data, max_length)
+    except zlib.error:
+        return None
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        return None
+    return text
@@ -0,0 +1,219 @@
+import os
+import time
+import socket
+
+from typing import Literal
+from itertools import islice
+from collections import deque
+from dataclasses import dataclass
+from collections.abc import Callable, Hashable
+
+
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+SlowConsumerMode = Literal["drop-oldest", "disconnect", "coalesce"]
+# frames are bytes, or views into the message log when replaying history
+Buffer = bytes | memoryview
+# the key of pinned frames, they keep their place but are never dropped
+_PINNED = object()
+
+
+@dataclass(frozen=True)
+class SlowConsumerPolicy:
+    mode: SlowConsumerMode = "disconnect"
+    max_bytes: int = 4 * 1024 * 1024
+    max_delay: float | None = None
+
+
+# servers batch only when given a policy, the default is to write frames as they are
+@dataclass(frozen=True)
+class BatchPolicy:
+    max_delay: float = 0.005
+    max_bytes: int = 64 * 1024
+    idle_after: float = 0.05
+
+
+# how long frames are held before a flush: none after an idle period,
+# widened while flushes carry bursts, narrowed back once they stop
+class FlushWindow:
+    def __init__(self, policy: BatchPolicy) -> None:
+        self.policy = policy
+        self.delay = 0.0
+        self.deadline: float | None = None
+        self._closed = 0.0
+
+    def open(self) -> None:
+        if self.deadline is not None:
+            return
+        now = time.monotonic()
+        if now - self._closed > self.policy.idle_after:
+            self.delay = 0.0
+        self.deadline = now + self.delay
+
+    def expire(self) -> None:
+        self.deadline = 0.0
+
+    def timeout(self) -> float | None:
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def due(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def close(self, frames: int, connections: int) -> None:
+        self.deadline = None
+        self._closed = time.monotonic()
+        step = self.policy.max_delay / 16
+        if frames > connections:
+            self.delay = min(self.policy.max_delay, max(self.delay * 2, step))
+        else:
+            self.delay = self.delay / 2 if self.delay / 2 >= step else 0.0
+
+
+class Outbox:
+    def __init__(self, policy: SlowConsumerPolicy | None = None) -> None:
+        self.policy = policy or SlowConsumerPolicy()
+        self.size = 0
+        # bytes handed to the socket over the life of the outbox
+        self.sent = 0
+        self._frames: deque[tuple[Buffer, Hashable | None]] = deque()
+        self._keyed: dict[Hashable, Buffer] = {}
+        self._offset = 0
+        self._since = 0.0
+        # raw frames are handshake replies, they go ahead of everything but a
+        # partially sent frame; the first _raw frames are never packed or dropped
+        self._raw = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self._frames)
+
+    @property
+    def lag(self) -> float:
+        if not self._frames:
+            return 0.0
+        return time.monotonic() - self._since
+
+    def put(self, frame: Buffer, key: Hashable | None = None, *, raw: bool = False, pinned: bool = False) -> bool:
+        if not self._frames:
+            self._since = time.monotonic()
+        self.size += len(frame)
+        if raw:
+            self._raw = self._first() + 1
+            self._frames.insert(self._raw - 1, (frame, None))
+            return self._apply_policy()
+        if pinned:
+            self._frames.append((frame, _PINNED))
+            return self._apply_policy()
+        if key is not None and self.policy.mode == "coalesce":
+            self._discard(key)
+            self._keyed[key] = frame
+        self._frames.append((frame, key))
+        return self._apply_policy()
+
+    def send(self, sock: socket.socket) -> bool:
+        while self._frames:
+            buffers: list[Buffer] = [frame for frame, _ in islice(self._frames, IOV_MAX)]
+            if self._offset:
+                buffers[0] = memoryview(buffers[0])[self._offset :]
+            size = sum(len(buffer) for buffer in buffers)
+            try:
+                sent = sock.sendmsg(buffers) if HAS_SENDMSG else sock.send(b"".join(buffers))
+            except BlockingIOError:
+                return False
+            self._consume(sent)
+            if sent < size:
+                return False
+        return True
+
+    def take(self) -> list[Buffer]:
+        frames = [frame for frame, _ in self._frames]
+        if frames and self._offset:
+            frames[0] = frames[0][self._offset :]
+        self.sent += self.size
+        self._frames.clear()
+        self._keyed.clear()
+        self._offset = 0
+        self._raw = 0
+        self.size = 0
+        return frames
+
+    # replaces the frames waiting to be sent with frames made by wrap, each
+    # carrying up to max_bytes of them; the keys of wrapped frames are forgotten
+    def pack(self, wrap: Callable[[list[Buffer]], bytes], max_bytes: int) -> None:
+        first = self._first()
+        if len(self._frames) - first < 2:
+            return
+        packed = deque(islice(self._frames, first))
+        run: list[tuple[Buffer, Hashable | None]] = []
+        run_size = 0
+        for frame, key in islice(self._frames, first, None):
+            if run and run_size + len(frame) > max_bytes:
+                packed.append(_pack_run(wrap, run))
+                run, run_size = [], 0
+            run.append((frame, key))
+            run_size += len(frame)
+        packed.append(_pack_run(wrap, run))
+        self._frames = packed
+        self._keyed = {key: frame for frame, key in packed if key is not None and self._keyed.get(key) is frame}
+        self.size = sum(len(frame) for frame, _ in packed) - self._offset
+
+    def _apply_policy(self) -> bool:
+        policy = self.policy
+        if policy.mode == "disconnect":
+            if self.size > policy.max_bytes:
+                return False
+            return policy.max_delay is None or self.lag <= policy.max_delay
+        # pinned frames are stepped over, the newest frame is always kept
+        first = self._first()
+        while self.size > policy.max_bytes and len(self._frames) > first + 1:
+            frame, key = self._frames[first]
+            if key is _PINNED:
+                first += 1
+                continue
+            del self._frames[first]
+            self.size -= len(frame)
+            if key is not None and self._keyed.get(key) is frame:
+                del self._keyed[key]
+        return True
+
+    # the head frame may be partially written, dropping or packing it would corrupt the stream
+    def _first(self) -> int:
+        return max(self._raw, 1 if self._offset else 0)
+
+    def _discard(self, key: Hashable) -> None:
+        queued = self._keyed.pop(key, None)
+        if queued is None:
+            return
+        for i, (frame, _) in enumerate(self._frames):
+            if frame is not queued:
+                continue
+            if i == 0 and self._offset:
+                return
+            del self._frames[i]
+            self.size -= len(frame)
+            return
+
+    def _consume(self, sent: int) -> None:
+        self.sent += sent
+        self.size -= sent
+        sent += self._offset
+        frames = self._frames
+        while frames and sent >= len(frames[0][0]):
+            frame, key = frames.popleft()
+            sent -= len(frame)
+            self._raw = max(0, self._raw - 1)
+            if key is not None and self._keyed.get(key) is frame:
+                del self._keyed[key]
+        self._offset = sent
+
+
+# a run of pinned frames stays pinned once packed
+def _pack_run(
+    wrap: Callable[[list[Buffer]], bytes], run: list[tuple[Buffer, Hashable | None]]
+) -> tuple[Buffer, Hashable | None]:
+    if len(run) == 1:
+        return run[0]
+    return wrap([frame for frame, _ in run]), _PINNED if any(key is _PINNED for _, key in run) else None
@@ -0,0 +1,270 @@
+import time
+import errno
+import socket
+import logging
+import selectors
+
+from sack.models.bus import BusOp, BusLink, BusFrame, encode_room_frame
+
+
+log = logging.getLogger("federation")
+
+# seconds before a configured peer that could not be reached is dialed again,
+# doubled after every failed attempt up to the maximum
+REDIAL_MIN = 0.5
+REDIAL_MAX = 30.0
+
+
+class PeerLink(BusLink):
+    def __init__(self, sock: socket.socket, *, dialed: bool, address: tuple[str, int] | None = None) -> None:
+        super().__init__(sock)
+        self.dialed = dialed
+        self.address = address
+        self.node_id: str | None = None
+
+
+def encode_relay(origin: str, seq: int, frame: bytes) -> bytes:
+    origin_bytes = origin.encode()
+    return len(origin_bytes).to_bytes(1, "big") + origin_bytes + seq.to_bytes(8, "big") + frame
+
+
+def decode_relay(payload: bytes) -> tuple[str, int, bytes]:
+    origin_end = 1 + payload[0]
+    origin = payload[1:origin_end].decode()
+    seq = int.from_bytes(payload[origin_end : origin_end + 8], "big")
+    return origin, seq, payload[origin_end + 8 :]
+
+
+# Nodes form a full mesh: frames are relayed only by the node they originate
+# from, tagged with its id and a sequence number, so nothing is forwarded twice.
+# When two nodes dial each other, the link dialed by the smaller node id is kept.
+# A username is granted once every linked node accepts the claim. Configured
+# peers without a link are redialed from flush, with a growing backoff.
+class Federation:
+    def __init__(
+        self, node_id: str, *, listen: tuple[str, int] | None = None, peers: list[tuple[str, int]] | None = None
+    ) -> None:
+        self.node_id = node_id
+        self.listen = listen
+        self.peers = peers or []
+        self._selector: selectors.BaseSelector | None = None
+        self._listener: socket.socket | None = None
+        self._links: list[PeerLink] = []
+        self._active: dict[str, PeerLink] = {}
+        self._local: set[str] = set()
+        self._remote: dict[str, str] = {}
+        self._pending: dict[str, set[str]] = {}
+        self._seq = 0
+        self._last_seen: dict[str, int] = {}
+        self._events: list[BusFrame] = []
+        # configured peer address -> its link while dialing or linked, the node id
+        # last seen there, and when and after how long it is dialed again
+        self._dialed: dict[tuple[str, int], PeerLink] = {}
+        self._nodes: dict[tuple[str, int], str] = {}
+        self._redial_at: dict[tuple[str, int], float] = {}
+        self._backoff: dict[tuple[str, int], float] = {}
+
+    @property
+    def bytes_sent(self) -> int:
+        return sum(link.bytes_sent for link in self._links)
+
+    @property
+    def linked_nodes(self) -> list[str]:
+        return list(self._active)
+
+    def attach(self, selector: selectors.BaseSelector) -> None:
+        self._selector = selector
+        if self.listen:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(self.listen)
+            listener.listen()
+            listener.setblocking(False)
+            selector.register(listener, selectors.EVENT_READ, self)
+            self._listener = listener
+        self._redial()
+
+    def handle_event(self, key: selectors.SelectorKey, mask: int) -> list[BusFrame] | None:
+        assert self._selector
+        if self._listener and key.fileobj is self._listener:
+            sock, addr = self._listener.accept()
+            log.info("accepted peer link from %s", addr)
+            self._add_link(sock, dialed=False)
+            return []
+        link = next((link for link in self._links if link.sock is key.fileobj), None)
+        # dropped while handling an earlier event of the same select
+        if link is None:
+            return []
+        if mask & selectors.EVENT_WRITE and not link.flush(self._selector, self):
+            self._drop(link)
+        elif mask & selectors.EVENT_READ:
+            frames = link.receive()
+            if frames is None:
+                self._drop(link)
+            else:
+                for op, payload in frames:
+                    self._handle_frame(link, op, payload)
+        events, self._events = self._events, []
+        return events
+
+    def claim(self, username: str) -> bool | None:
+        if username in self._remote or username in self._local:
+            return False
+        if not self._active:
+            self._local.add(username)
+            return True
+        self._pending[username] = set(self._active)
+        for link in self._active.values():
+            link.send(BusOp.CLAIM, username.encode())
+        return None
+
+    def release(self, username: str) -> None:
+        self._local.discard(username)
+        self._send_all(BusOp.LEFT, username.encode())
+
+    def publish(self, room: str, frame: bytes) -> None:
+        self._seq += 1
+        self._send_all(BusOp.RELAY, encode_relay(self.node_id, self._seq, encode_room_frame(room, frame)))
+
+    def flush(self) -> list[BusFrame]:
+        assert self._selector
+        self._redial()
+        for link in list(self._links):
+            if link.needs_flush(self._selector) and not link.flush(self._selector, self):
+                self._drop(link)
+        events, self._events = self._events, []
+        return events
+
+    # seconds until the next configured peer is due to be dialed again
+    def timeout(self) -> float | None:
+        due = [self._redial_at.get(address, 0.0) for address in self.peers if self._unlinked(address)]
+        return max(0.0, min(due) - time.monotonic()) if due else None
+
+    def close(self) -> None:
+        for link in self._links:
+            link.sock.close()
+        if self._listener:
+            self._listener.close()
+
+    def _unlinked(self, address: tuple[str, int]) -> bool:
+        return address not in self._dialed and self._nodes.get(address) not in self._active
+
+    # the connect does not block, a refused one shows up as an error on the link
+    def _redial(self) -> None:
+        now = time.monotonic()
+        for address in self.peers:
+            if not self._unlinked(address) or self._redial_at.get(address, 0.0) > now:
+                continue
+            backoff = self._backoff.get(address, REDIAL_MIN)
+            self._backoff[address] = min(backoff * 2, REDIAL_MAX)
+            self._redial_at[address] = now + backoff
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            if sock.connect_ex(address) not in (0, errno.EINPROGRESS):
+                sock.close()
+                log.info("peer %s:%d is not reachable, dialing again in %.1f s", *address, backoff)
+                continue
+            self._dialed[address] = self._add_link(sock, dialed=True, address=address)
+
+    def _add_link(self, sock: socket.socket, *, dialed: bool, address: tuple[str, int] | None = None) -> PeerLink:
+        assert self._selector
+        link = PeerLink(sock, dialed=dialed, address=address)
+        self._links.append(link)
+        self._selector.register(sock, selectors.EVENT_READ, self)
+        link.send(BusOp.HELLO, self.node_id.encode())
+        return link
+
+    def _handle_frame(self, link: PeerLink, op: BusOp, payload: bytes) -> None:
+        if op == BusOp.HELLO:
+            self._handle_hello(link, payload.decode())
+            return
+        if link.node_id is None or self._active.get(link.node_id) is not link:
+            return
+        peer = link.node_id
+        if op == BusOp.RELAY:
+            origin, seq, frame = decode_relay(payload)
+            if origin == self.node_id or seq <= self._last_seen.get(origin, 0):
+                return
+            self._last_seen[origin] = seq
+            self._events.append((BusOp.RELAY, frame))
+        elif op == BusOp.CLAIM:
+            username = payload.decode()
+            taken = username in self._local or self._remote.get(username, peer) != peer
+            # concurrent claims for the same name are won by the smaller node id
+            contested = username in self._pending and self.node_id < peer
+            link.send(BusOp.REJECT if taken or contested else BusOp.ACCEPT, payload)
+        elif op == BusOp.ACCEPT:
+            username = payload.decode()
+            waiting = self._pending.get(username)
+            if waiting is not None:
+                waiting.discard(peer)
+                self._complete_claim(username)
+        elif op == BusOp.REJECT:
+            username = payload.decode()
+            if self._pending.pop(username, None) is not None:
+                self._events.append((BusOp.REJECT, payload))
+        elif op == BusOp.JOINED:
+            username = payload.decode()
+            self._remote[username] = peer
+            self._events.append((BusOp.JOINED, payload))
+        elif op == BusOp.LEFT:
+            username = payload.decode()
+            if self._remote.get(username) == peer:
+                del self._remote[username]
+                self._events.append((BusOp.LEFT, payload))
+
+    def _handle_hello(self, link: PeerLink, peer: str) -> None:
+        if peer == self.node_id:
+            log.warning("dropping peer link to self")
+            self._drop(link)
+            return
+        link.node_id = peer
+        if link.address:
+            self._nodes[link.address] = peer
+            self._backoff.pop(link.address, None)
+        current = self._active.get(peer)
+        if current is not None:
+            keep_dialed = self.node_id < peer
+            if current.dialed == keep_dialed:
+                self._drop(link)
+                return
+            del self._active[peer]
+            self._drop(current)
+        self._active[peer] = link
+        self._last_seen.pop(peer, None)
+        log.info("linked with node %s", peer)
+        for username in self._local:
+            link.send(BusOp.JOINED, username.encode())
+
+    def _complete_claim(self, username: str) -> None:
+        if self._pending.get(username):
+            return
+        del self._pending[username]
+        self._local.add(username)
+        self._send_all(BusOp.JOINED, username.encode())
+        self._events.append((BusOp.ACCEPT, username.encode()))
+
+    def _send_all(self, op: BusOp, payload: bytes) -> None:
+        for link in self._active.values():
+            link.send(op, payload)
+
+    def _drop(self, link: PeerLink) -> None:
+        assert self._selector
+        self._selector.unregister(link.sock)
+        self._links.remove(link)
+        link.sock.close()
+        if link.address and self._dialed.get(link.address) is link:
+            del self._dialed[link.address]
+            if link.node_id is None:
+                log.info("peer %s:%d is not reachable, dialing again later", *link.address)
+        peer = link.node_id
+        if peer is None or self._active.get(peer) is not link:
+            return
+        log.warning("lost peer link to node %s", peer)
+        del self._active[peer]
+        for username in [username for username, owner in self._remote.items() if owner == peer]:
+            del self._remote[username]
+            self._events.append((BusOp.LEFT, username.encode()))
+        for username, waiting in list(self._pending.items()):
+            waiting.discard(peer)
+            self._complete_claim(username)
@@ -0,0 +1,88 @@
+import math
+import time
+
+from typing import Generic, TypeVar
+from dataclasses import dataclass
+from collections.abc import Hashable
+
+
+@dataclass(frozen=True)
+class HeartbeatPolicy:
+    # a connection quiet for interval seconds is sent PING, one quiet for
+    # timeout seconds is dropped; an interval of 0 turns heartbeats off
+    interval: float = 15.0
+    timeout: float = 45.0
+    # the resolution of the idle timers and the number of ticks the wheel spans
+    tick: float = 1.0
+    slots: int = 64
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+
+K = TypeVar("K", bound=Hashable)
+
+
+# a hashed timer wheel: a timer goes in the slot of the tick it is due in, with
+# the number of turns of the wheel left before it fires, so scheduling and
+# cancelling are O(1) and a tick only looks at the timers of its own slot
+class TimerWheel(Generic[K]):
+    def __init__(self, tick: float = 1.0, slots: int = 64) -> None:
+        self.tick = tick
+        self._slots: list[dict[K, int]] = [{} for _ in range(slots)]
+        self._where: dict[K, int] = {}
+        self._cursor = 0
+        # when the current tick started
+        self._time = time.monotonic()
+
+    def schedule(self, key: K, delay: float) -> None:
+        self.cancel(key)
+        if not self._where:
+            # nothing ticked while the wheel was empty, catch up at once
+            self._skip(time.monotonic())
+        ticks = max(1, math.ceil(delay / self.tick))
+        slot = (self._cursor + ticks) % len(self._slots)
+        self._slots[slot][key] = (ticks - 1) // len(self._slots)
+        self._where[key] = slot
+
+    def cancel(self, key: K) -> None:
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            del self._slots[slot][key]
+
+    def timeout(self) -> float | None:
+        if not self._where:
+            return None
+        return max(0.0, self._time + self.tick - time.monotonic())
+
+    def advance(self) -> list[K]:
+        now = time.monotonic()
+        expired: list[K] = []
+        while self._where and self._time + self.tick <= now:
+            self._time += self.tick
+            self._cursor = (self._cursor + 1) % len(self._slots)
+            slot = self._slots[self._cursor]
+            if not slot:
+                continue
+            for key, turns in list(slot.items()):
+                if turns:
+                    slot[key] = turns - 1
+                else:
+                    del slot[key]
+                    del self._where[key]
+                    expired.append(key)
+        if not self._where:
+            self._skip(now)
+        return expired
+
+    def _skip(self, now: float) -> None:
+        ticks = int((now - self._time) / self.tick)
+        self._time += ticks * self.tick
+        self._cursor = (self._cursor + ticks) % len(self._slots)
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._where
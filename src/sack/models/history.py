@@ -0,0 +1,156 @@
+import logging
+
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+
+from sack.models.fanout import Buffer
+from sack.models.protocol import Frame, SackProtocolError, decode_frame, encode_history_marker
+from sack.models.messagelog import MessageLog
+from sack.models.compression import Compressor
+
+
+log = logging.getLogger("history")
+
+MAX_HISTORY_PAGE = 200
+# frames sent to a resumed session at most, older ones are left to paging
+MAX_BACKFILL = 1000
+
+
+@dataclass(frozen=True)
+class HistoryPolicy:
+    max_frames: int = 1000
+    max_bytes: int = 1024 * 1024
+    replay: int = 50
+
+
+class HistoryRing:
+    def __init__(self, policy: HistoryPolicy) -> None:
+        self.policy = policy
+        self.size = 0
+        self._seqs = [0] * policy.max_frames
+        self._frames: list[Frame | None] = [None] * policy.max_frames
+        self._start = 0
+        self._len = 0
+
+    def append(self, seq: int, frame: Frame) -> None:
+        if self._len == self.policy.max_frames:
+            self._pop()
+        end = (self._start + self._len) % self.policy.max_frames
+        self._seqs[end] = seq
+        self._frames[end] = frame
+        self._len += 1
+        self.size += len(frame.encode(2))
+        while self.size > self.policy.max_bytes and self._len > 1:
+            self._pop()
+
+    def page(self, before: int | None, limit: int, after: int = 0) -> tuple[int, list[Frame]]:
+        end = self._len if before is None else bisect_left(self, before)
+        start = max(bisect_right(self, after) if after else 0, end - limit)
+        if start >= end:
+            return 0, []
+        capacity = self.policy.max_frames
+        frames = [frame for i in range(start, end) if (frame := self._frames[(self._start + i) % capacity])]
+        # the cursor is 0 when the ring holds nothing older
+        return self[start] if start else 0, frames
+
+    def _pop(self) -> None:
+        frame = self._frames[self._start]
+        assert frame
+        self.size -= len(frame.encode(2))
+        self._frames[self._start] = None
+        self._start = (self._start + 1) % self.policy.max_frames
+        self._len -= 1
+
+    # indexes the sequence numbers, so the ring can be bisected
+    def __getitem__(self, index: int) -> int:
+        if not 0 <= index < self._len:
+            raise IndexError(index)
+        return self._seqs[(self._start + index) % self.policy.max_frames]
+
+    def __len__(self) -> int:
+        return self._len
+
+
+# the rings hold the recent frames of each room, with a message log
+# older frames are read from it, straight out of the mapped segments
+class History:
+    def __init__(self, policy: HistoryPolicy | None = None, log: MessageLog | None = None) -> None:
+        self.policy = policy or HistoryPolicy()
+        self.log = log
+        self.seq = log.last_seq if log else 0
+        self._rooms: dict[str, HistoryRing] = {}
+
+    def append(self, room: str, frame: Frame) -> int:
+        if not self.policy.max_frames and not self.log:
+            return 0
+        self.seq += 1
+        frame.seq = self.seq
+        if self.policy.max_frames:
+            ring = self._rooms.get(room)
+            if ring is None:
+                ring = self._rooms[room] = HistoryRing(self.policy)
+            ring.append(self.seq, frame)
+        # a frame too long for v2 is not logged, no client could be sent it
+        if self.log and (encoded := frame.encode(2)):
+            self.log.append(self.seq, room, encoded)
+        return self.seq
+
+    # frames go out encoded for the version of the client, behind a marker
+    # telling it the cursor to page further back from (0 when there is
+    # nothing older) and the frame count; v2 clients get the log records as they are
+    def page(
+        self, room: str, before: int | None, limit: int, version: int = 1, compressor: Compressor | None = None
+    ) -> list[Buffer]:
+        cursor, frames = self._read(room, before, min(limit, MAX_HISTORY_PAGE), 0, version, compressor)
+        return [encode_history_marker(cursor, len(frames), version), *frames]
+
+    def replay(self, room: str, version: int = 1, compressor: Compressor | None = None) -> list[Buffer] | None:
+        if not self.policy.replay:
+            return None
+        return self.page(room, None, self.policy.replay, version, compressor)
+
+    # the frames of the room newer than after, sent without a marker as they
+    # would have been sent live
+    def backfill(self, room: str, after: int, version: int = 1, compressor: Compressor | None = None) -> list[Buffer]:
+        return self._read(room, None, MAX_BACKFILL, after, version, compressor)[1]
+
+    def _read(
+        self, room: str, before: int | None, limit: int, after: int, version: int, compressor: Compressor | None
+    ) -> tuple[int, list[Buffer]]:
+        ring = self._rooms.get(room)
+        cursor, recent = ring.page(before, limit, after) if ring else (0, [])
+        frames: list[Buffer] = [frame.encode(version, compressor) for frame in recent]
+        if self.log and (not recent or recent[0].seq > after + 1):
+            # frames older than the ring are in the log
+            if len(frames) == limit:
+                return recent[0].seq, [frame for frame in frames if frame]
+            cursor, older = self.log.read(room, recent[0].seq if recent else before, limit - len(frames), after)
+            if version == 2:
+                frames[:0] = [frame for _, frame in older]
+            else:
+                frames[:0] = [_reencode(frame, seq, version) for seq, frame in older]
+        return cursor, [frame for frame in frames if frame]
+
+    def commit_timeout(self) -> float | None:
+        return self.log.commit_timeout() if self.log else None
+
+    def commit(self) -> None:
+        if self.log:
+            self.log.commit()
+
+    def close(self) -> None:
+        if self.log:
+            self.log.close()
+
+    @property
+    def size(self) -> int:
+        return sum(ring.size for ring in self._rooms.values())
+
+
+# a record that does not decode is left out of the page, not sent to the client
+def _reencode(frame: Buffer, seq: int, version: int) -> bytes:
+    try:
+        return decode_frame(frame, seq).encode(version)
+    except SackProtocolError:
+        log.warning("skipping log record %d, it does not decode", seq)
+        return b""
@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+import logging
+
+from queue import SimpleQueue
+from typing import TextIO
+from logging.handlers import QueueHandler, QueueListener
+
+
+FORMAT = "%(asctime)s | %(levelname)s | %(name)s: %(message)s"
+
+
+# a log call site hit for every frame, it gives at most rate records a second and
+# tells how many were left out in between; None lets every record through
+class SampledLog:
+    def __init__(self, logger: logging.Logger, level: int = logging.DEBUG, *, rate: float | None = 5.0) -> None:
+        self.logger = logger
+        self.level = level
+        self.rate = rate
+        self._next = 0.0
+        self._skipped = 0
+
+    def __call__(self, msg: str, *args: object) -> None:
+        if not self.logger.isEnabledFor(self.level):
+            return
+        if self.rate is not None:
+            now = time.monotonic()
+            if now < self._next:
+                self._skipped += 1
+                return
+            self._next = now + 1 / self.rate
+        if self._skipped:
+            msg, args = f"{msg} (%d more since)", (*args, self._skipped)
+            self._skipped = 0
+        self.logger.log(self.level, msg, *args)
+
+
+# the record goes on the queue as it is, the listener thread formats it; the stdlib
+# handler merges the arguments on the logging thread, the server only logs
+# immutable ones
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+# the handler on the root logger and the listener draining its queue
+_queued: tuple[DeferredQueueHandler, QueueListener] | None = None
+
+
+# log calls only put records on a queue, formatting and writing them happens on a
+# listener thread; a forked worker gets a listener and a queue of its own
+def setup_logging(level: int | str = logging.INFO, *, stream: TextIO | None = None) -> QueueListener:
+    global _queued
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    listener = QueueListener(SimpleQueue(), handler, respect_handler_level=True)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers.clear()
+    queue_handler = DeferredQueueHandler(listener.queue)
+    root.addHandler(queue_handler)
+    listener.start()
+    _queued = queue_handler, listener
+    return listener
+
+
+# writes what is still queued and stops the listener; a forked worker calls it
+# before it exits, its exit skips the stop done by the parent
+def stop_logging() -> None:
+    global _queued
+    if _queued is not None:
+        _queued[1].stop()
+        _queued = None
+
+
+# the listener thread of the parent does not exist in the child, and records the
+# parent had queued are left to it
+def _restart_in_child() -> None:
+    global _queued
+    if _queued is None:
+        return
+    queue_handler, inherited = _queued
+    listener = QueueListener(SimpleQueue(), *inherited.handlers, respect_handler_level=True)
+    queue_handler.queue = listener.queue
+    listener.start()
+    _queued = queue_handler, listener
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_in_child)
@@ -0,0 +1,278 @@
+import os
+import mmap
+import time
+import zlib
+import fcntl
+import struct
+import logging
+
+from dataclasses import dataclass
+from collections.abc import Iterator
+
+from sack.models.fanout import Buffer
+
+
+log = logging.getLogger("history")
+
+# record: payload length, crc32 of the payload | seq, room length, room, frame
+RECORD_HEADER = struct.Struct(">II")
+RECORD_PREFIX = struct.Struct(">QB")
+# sparse index entry: seq of the first record at or after each interval, its offset
+INDEX_ENTRY = struct.Struct(">QI")
+ZEROS = bytes(1024 * 1024)
+
+
+@dataclass(frozen=True)
+class LogPolicy:
+    segment_bytes: int = 64 * 1024 * 1024
+    index_interval: int = 64 * 1024
+    sync_interval: float = 0.05
+    sync_batch: int = 1024
+    max_scan_bytes: int = 8 * 1024 * 1024
+
+
+Record = tuple[int, memoryview, memoryview, int]
+
+
+class Segment:
+    def __init__(self, directory: str, base_seq: int, policy: LogPolicy, *, create: bool = False) -> None:
+        self.base_seq = base_seq
+        self.policy = policy
+        self.path = os.path.join(directory, f"{base_seq:020d}.log")
+        index_size = (policy.segment_bytes // policy.index_interval + 1) * INDEX_ENTRY.size
+        self._data = _map(self.path, policy.segment_bytes if create else None)
+        self._index = _map(self.path.removesuffix(".log") + ".idx", index_size if create else None)
+        self._view = memoryview(self._data)
+        self.size = len(self._data)
+        self.end = 0
+        self.last_seq = base_seq - 1
+        self._entries = self._count_entries()
+        self._synced = 0
+
+    def append(self, seq: int, room: bytes, frame: Buffer) -> bool:
+        body = self.end + RECORD_HEADER.size
+        end = body + RECORD_PREFIX.size + len(room) + len(frame)
+        if end > self.size:
+            return False
+        RECORD_PREFIX.pack_into(self._data, body, seq, len(room))
+        room_start = body + RECORD_PREFIX.size
+        self._data[room_start : room_start + len(room)] = room
+        self._data[room_start + len(room) : end] = frame
+        # the header goes last, a record is not there until its length is
+        RECORD_HEADER.pack_into(self._data, self.end, end - body, zlib.crc32(self._view[body:end]))
+        self._index_record(seq, self.end)
+        self.end = end
+        self.last_seq = seq
+        return True
+
+    def records(self, offset: int, before: int) -> Iterator[Record]:
+        while (record := self._read(offset)) is not None and record[0] < before:
+            yield record
+            offset = record[3]
+
+    # index windows holding records older than `before`, newest first:
+    # (offset of the first record, its seq, seq the window ends at)
+    def windows(self, before: int) -> Iterator[tuple[int, int, int]]:
+        end_seq = before
+        for i in range(self._find_entry(before - 1), -1, -1):
+            seq, offset = self._entry(i)
+            yield offset, seq, end_seq
+            end_seq = seq
+
+    def recover(self) -> None:
+        # index entries can reach the disk before the records they point at
+        while self._entries:
+            seq, offset = self._entry(self._entries - 1)
+            record = self._read(offset, verify=True)
+            if record is not None and record[0] == seq:
+                break
+            self._entries -= 1
+            INDEX_ENTRY.pack_into(self._index, self._entries * INDEX_ENTRY.size, 0, 0)
+        offset, last_seq = 0, self.base_seq - 1
+        if self._entries:
+            last_seq, offset = self._entry(self._entries - 1)
+            last_seq -= 1
+        # seqs are contiguous, so stale records past the tail do not pass as valid
+        while (record := self._read(offset, verify=True)) is not None and record[0] == last_seq + 1:
+            self._index_record(record[0], offset)
+            last_seq = record[0]
+            offset = record[3]
+        self.end = self._synced = offset
+        self.last_seq = last_seq
+        # a torn write, or pages that reached the disk out of order, could
+        # pass as records once new ones are written around them
+        torn = False
+        for start in range(offset, self.size, len(ZEROS)):
+            end = min(start + len(ZEROS), self.size)
+            if self._data[start:end] != ZEROS[: end - start]:
+                self._data[start:end] = ZEROS[: end - start]
+                torn = True
+        if torn:
+            log.warning("truncated torn tail of %s at offset %d", self.path, offset)
+            self._data.flush()
+            self._index.flush()
+
+    def sync(self) -> None:
+        start = self._synced - self._synced % mmap.PAGESIZE
+        self._data.flush(start, max(self.end, self._synced) - start)
+        self._index.flush()
+        self._synced = self.end
+
+    def close(self) -> None:
+        try:
+            self._view.release()
+            self._data.close()
+        except BufferError:
+            # frames read from the segment may still be queued for sending
+            pass
+        self._index.close()
+
+    def _read(self, offset: int, *, verify: bool = False) -> Record | None:
+        if offset + RECORD_HEADER.size > self.size:
+            return None
+        length, crc = RECORD_HEADER.unpack_from(self._data, offset)
+        body = offset + RECORD_HEADER.size
+        end = body + length
+        if not length or end > self.size or verify and zlib.crc32(self._view[body:end]) != crc:
+            return None
+        seq, room_length = RECORD_PREFIX.unpack_from(self._data, body)
+        room_start = body + RECORD_PREFIX.size
+        frame_start = room_start + room_length
+        return seq, self._view[room_start:frame_start], self._view[frame_start:end], end
+
+    def _entry(self, i: int) -> tuple[int, int]:
+        return INDEX_ENTRY.unpack_from(self._index, i * INDEX_ENTRY.size)
+
+    def _index_record(self, seq: int, offset: int) -> None:
+        if self._entries and offset - self._entry(self._entries - 1)[1] < self.policy.index_interval:
+            return
+        INDEX_ENTRY.pack_into(self._index, self._entries * INDEX_ENTRY.size, seq, offset)
+        self._entries += 1
+
+    def _count_entries(self) -> int:
+        low, high = 0, len(self._index) // INDEX_ENTRY.size
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[0]:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _find_entry(self, seq: int) -> int:
+        low, high = 0, self._entries
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[0] <= seq:
+                low = middle + 1
+            else:
+                high = middle
+        return low - 1
+
+
+class MessageLog:
+    def __init__(self, directory: str, policy: LogPolicy | None = None) -> None:
+        self.directory = directory
+        self.policy = policy or LogPolicy()
+        os.makedirs(directory, exist_ok=True)
+        self._lock = open(os.path.join(directory, "lock"), "w")
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock.close()
+            raise RuntimeError(f"message log {directory} is used by another server") from None
+
+        bases = sorted(int(name.removesuffix(".log")) for name in os.listdir(directory) if name.endswith(".log"))
+        self._segments = [Segment(directory, base, self.policy) for base in bases]
+        if self._segments:
+            self._segments[-1].recover()
+        self.last_seq = self._segments[-1].last_seq if self._segments else 0
+        self._pending = 0
+        self._pending_since = 0.0
+
+    def append(self, seq: int, room: str, frame: Buffer) -> None:
+        room_bytes = room.encode()
+        active = self._segments[-1] if self._segments else None
+        if active is None or not active.append(seq, room_bytes, frame):
+            if active:
+                active.sync()
+            active = Segment(self.directory, seq, self.policy, create=True)
+            self._segments.append(active)
+            _sync_directory(self.directory)
+            if not active.append(seq, room_bytes, frame):
+                raise ValueError("frame does not fit in a log segment")
+        self.last_seq = seq
+        if not self._pending:
+            self._pending_since = time.monotonic()
+        self._pending += 1
+        if self._pending >= self.policy.sync_batch:
+            self.sync()
+
+    # reads go backwards over index windows, so a page costs a scan of the
+    # windows it spans and not of the whole log; a page that scanned
+    # max_scan_bytes without filling up ends early with a cursor to continue
+    # from; frames up to after are not read
+    def read(
+        self, room: str, before: int | None, limit: int, after: int = 0
+    ) -> tuple[int, list[tuple[int, memoryview]]]:
+        room_bytes = room.encode()
+        before = before or self.last_seq + 1
+        found: list[tuple[int, memoryview]] = []
+        scanned = 0
+        for segment in reversed(self._segments):
+            if segment.base_seq >= before:
+                continue
+            for offset, first_seq, end_seq in segment.windows(before):
+                window = [
+                    (seq, frame)
+                    for seq, r, frame, _ in segment.records(offset, end_seq)
+                    if r == room_bytes and seq > after
+                ]
+                found[:0] = window
+                if len(found) >= limit:
+                    found = found[-limit:]
+                    return found[0][0], found
+                if first_seq <= after + 1:
+                    return 0, found
+                scanned += self.policy.index_interval
+                if scanned >= self.policy.max_scan_bytes and first_seq > self._segments[0].base_seq:
+                    return first_seq, found
+        return 0, found
+
+    def sync(self) -> None:
+        if self._pending:
+            self._segments[-1].sync()
+            self._pending = 0
+
+    def commit_timeout(self) -> float | None:
+        if not self._pending:
+            return None
+        return max(0.0, self._pending_since + self.policy.sync_interval - time.monotonic())
+
+    def commit(self) -> None:
+        if self.commit_timeout() == 0:
+            self.sync()
+
+    def close(self) -> None:
+        self.sync()
+        for segment in self._segments:
+            segment.close()
+        self._lock.close()
+
+
+def _map(path: str, size: int | None) -> mmap.mmap:
+    fd = os.open(path, os.O_RDWR | (os.O_CREAT if size else 0), 0o644)
+    try:
+        if size:
+            os.ftruncate(fd, size)
+        return mmap.mmap(fd, size or os.fstat(fd).st_size)
+    finally:
+        os.close(fd)
+
+
+def _sync_directory(directory: str) -> None:
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,148 @@
+import os
+import sys
+import math
+import time
+
+from bisect import bisect_left
+from typing import Any
+from collections import Counter
+
+
+# bucket bounds of the latency histograms, from 1 us to about 1 s
+LATENCY_BOUNDS = tuple(2**i / 1_000_000 for i in range(21))
+
+
+class Histogram:
+    def __init__(self, bounds: tuple[float, ...] = LATENCY_BOUNDS) -> None:
+        self.bounds = (*bounds, math.inf)
+        self.counts = [0] * len(self.bounds)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # the upper bound of the bucket the quantile falls in
+    def quantile(self, q: float) -> float:
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts, strict=True):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return 0.0
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": [
+                [bound if bound < math.inf else "+Inf", count]
+                for bound, count in zip(self.bounds, self.counts, strict=True)
+                if count
+            ],
+        }
+
+
+# events per second over the last window seconds, counted in one slot per second
+class RateMeter:
+    def __init__(self, window: int = 60) -> None:
+        self._slots = [0] * window
+        self._second = int(time.monotonic())
+
+    def mark(self) -> None:
+        self._advance()
+        self._slots[self._second % len(self._slots)] += 1
+
+    def rate(self) -> float:
+        self._advance()
+        return sum(self._slots) / len(self._slots)
+
+    def _advance(self) -> None:
+        second = int(time.monotonic())
+        if second == self._second:
+            return
+        for stale in range(self._second + 1, min(second, self._second + len(self._slots)) + 1):
+            self._slots[stale % len(self._slots)] = 0
+        self._second = second
+
+
+# the resident set size of this process in bytes, the peak one where /proc is missing
+def rss() -> int:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# the largest client backlogs in a snapshot, the queue depth counts them all
+MAX_BACKLOGS = 100
+
+
+# updated in place by the server loop, which is the only thread touching it;
+# gauges are taken from the server when a snapshot is made
+class Metrics:
+    def __init__(self) -> None:
+        self.started = time.monotonic()
+        self.frames_in: Counter[str] = Counter()
+        self.frames_out: Counter[str] = Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.accepted = 0
+        self.refused = 0
+        self.accepts = RateMeter()
+        self.fanout = Histogram()
+
+    def snapshot(self, connections: int, registered: int, queue_depth: int, backlogs: dict[str, int]) -> dict[str, Any]:
+        return {
+            "uptime": time.monotonic() - self.started,
+            "connections": connections,
+            "registered": registered,
+            "rss": rss(),
+            "frames_in": dict(self.frames_in),
+            "frames_out": dict(self.frames_out),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "accepted": self.accepted,
+            "refused": self.refused,
+            "accept_rate": self.accepts.rate(),
+            "queue_depth": queue_depth,
+            "backlogs": backlogs,
+            "fanout_latency": self.fanout.snapshot(),
+        }
+
+
+# one line per value, as plain text scrapers expect it
+def render_text(snapshot: dict[str, Any]) -> str:
+    lines = []
+    for name in ("uptime", "connections", "registered", "rss", "bytes_in", "bytes_out", "accepted", "refused"):
+        lines.append(f"sack_{name} {snapshot[name]}")
+    lines.append(f"sack_accept_rate {snapshot['accept_rate']:.3f}")
+    for direction in ("in", "out"):
+        for type, count in sorted(snapshot[f"frames_{direction}"].items()):
+            lines.append(f'sack_frames_{direction}{{type="{type}"}} {count}')
+    lines.append(f"sack_queue_depth {snapshot['queue_depth']}")
+    for username, depth in sorted(snapshot["backlogs"].items()):
+        lines.append(f'sack_backlog{{username="{username}"}} {depth}')
+    latency = snapshot["fanout_latency"]
+    total = 0
+    for bound, count in latency["buckets"]:
+        total += count
+        lines.append(f'sack_fanout_seconds_bucket{{le="{bound}"}} {total}')
+    lines.append(f"sack_fanout_seconds_count {latency['count']}")
+    lines.append(f"sack_fanout_seconds_sum {latency['sum']:.6f}")
+    lines.append(f"sack_fanout_seconds_p50 {latency['p50']}")
+    lines.append(f"sack_fanout_seconds_p99 {latency['p99']}")
+    return "\n".join(lines) + "\n"
@@ -1,57 +1,461 @@
-import socket
+from typing import Any, Literal, cast, overload
+from collections.abc import Collection
 
-from typing import Literal, overload
-from collections.abc import Callable
+from sack.models.fanout import Buffer
+from sack.models.compression import Compressor, decompress
 
 
+MESSAGE_TYPES = ("CONNECT", "TEXT", "DISCONNECT", "GETNICKNAMES", "JOIN", "LEAVE", "HISTORY")
+RECV_BUFFER_SIZE = 64 * 1024
+
+DEFAULT_ROOM = "general"
+MAX_ROOM_LENGTH = 32
+
+PROTOCOL_VERSION = 3
+MAX_FRAME_SIZE = 1024 * 1024
+# BATCH exists only in v2, decoders unpack it into the frames it carries;
+# RESUME only in v3, it carries the resume token of a session; PING and PONG
+# go only to clients that took FEATURE_PING in their hello; STATS is answered
+# with the server metrics as JSON, also before CONNECT
+FRAME_TYPES = (*MESSAGE_TYPES, "BATCH", "RESUME", "PING", "PONG", "STATS")
+TYPE_CODES = {type: code for code, type in enumerate(FRAME_TYPES, 1)}
+# the type and the username of any frame fit in the one byte v1 header
+MAX_USERNAME_BYTES = 0xFF - 1 - max(len(type) for type in FRAME_TYPES)
+FLAG_TEXT = 0x01
+FLAG_ZLIB = 0x02
+# v3 frames of messages kept in history carry their sequence number
+FLAG_SEQ = 0x04
+# features offered in the hello
+FEATURE_ZLIB = 0x01
+FEATURE_PING = 0x02
+
+
+class SackProtocolError(Exception):
+    pass
+
+
+# messages decoded off the wire keep the encoded text and decode it on first
+# access; servers relay TEXT without ever reading it
 class SackMessage:
-    type: Literal["CONNECT", "DISCONNECT", "TEXT", "GETNICKNAMES"]
+    __slots__ = ("type", "username", "seq", "frame", "flags", "_text", "_data", "_start")
+
+    type: Literal[
+        "CONNECT", "DISCONNECT", "TEXT", "GETNICKNAMES", "JOIN", "LEAVE", "HISTORY", "RESUME", "PING", "PONG", "STATS"
+    ]
     username: str
-    text: str | None
 
     @overload
-    def __init__(self, type: Literal["GETNICKNAMES"], username: str, text: str | None = None): ...
+    def __init__(self, type: Literal["GETNICKNAMES", "HISTORY", "STATS"], username: str, text: str | None = None): ...
     @overload
-    def __init__(self, type: Literal["CONNECT", "DISCONNECT"], username: str) -> None: ...
+    def __init__(self, type: Literal["CONNECT", "DISCONNECT", "PING", "PONG"], username: str) -> None: ...
     @overload
-    def __init__(self, type: Literal["TEXT"], username: str, text: str) -> None: ...
+    def __init__(self, type: Literal["TEXT", "JOIN", "LEAVE", "RESUME"], username: str, text: str) -> None: ...
 
     def __init__(self, type, username, text=None) -> None:
+        self.type = type
+        self.username = username
+        self.seq = 0
+        # the v2 frame as received, for messages with a text body
+        self.frame: bytes | None = None
+        self.flags = 0
+        self._text: str | None = text
+        self._data: bytes | None = None
+        self._start = 0
+
+    # for decoders, which only know that the type is one of FRAME_TYPES
+    @classmethod
+    def of(cls, type: str, username: str) -> "SackMessage":
+        return cls(cast(Any, type), username)
+
+    @classmethod
+    def decoded(
+        cls,
+        type: str,
+        username: str,
+        data: bytes,
+        start: int = 0,
+        frame: bytes | None = None,
+        flags: int = 0,
+        seq: int = 0,
+    ) -> "SackMessage":
+        message = cls.of(type, username)
+        message._data = data
+        message._start = start
+        message.frame = frame
+        message.flags = flags
+        message.seq = seq
+        return message
+
+    @property
+    def text(self) -> str | None:
+        if self._text is None and self._data is not None:
+            # the server does not validate what it relays
+            self._text = str(memoryview(self._data)[self._start :], "utf-8", "replace")
+        return self._text
+
+    @text.setter
+    def text(self, text: str | None) -> None:
+        self._text = text
+        self._data = self.frame = None
+        self.flags = 0
+
+    @property
+    def payload(self) -> Buffer | None:
+        if self._data is not None:
+            return memoryview(self._data)[self._start :] if self._start else self._data
+        return None if self._text is None else self._text.encode()
+
+    def to_bytes(self, version: int = 1, compressor: Compressor | None = None) -> bytes:
+        return encode_frame(self.type, self.username, self.payload, version=version, compressor=compressor)
+
+
+# a frame as the server passes it around, encoded once for each protocol
+# version its recipients speak, with the text compressed once for all of
+# them; relays and the message log carry plain v2
+class Frame:
+    __slots__ = ("type", "username", "text", "seq", "_encoded", "_compressed", "_deflated")
+
+    def __init__(self, type: str, username: str, text: Buffer | None = None, seq: int = 0) -> None:
         self.type = type
         self.username = username
         self.text = text
+        # set once the frame is kept in history
+        self.seq = seq
+        self._encoded: list[bytes | None] = [None] * PROTOCOL_VERSION
+        self._compressed: list[bytes | None] = [None] * PROTOCOL_VERSION
+        self._deflated: bytes | None = None
+
+    # a frame received from a v2 client goes out to v2 clients as it came in,
+    # unless it carries a seq of its own, only history sets those
+    @classmethod
+    def from_message(cls, message: SackMessage) -> "Frame":
+        frame = cls(message.type, message.username, message.payload)
+        if message.frame is not None and not message.flags & FLAG_SEQ:
+            if message.flags & FLAG_ZLIB:
+                frame._compressed[1] = message.frame
+            else:
+                frame._encoded[1] = message.frame
+        return frame
+
+    def encode(self, version: int, compressor: Compressor | None = None) -> bytes:
+        if compressor is not None and version > 1 and self.text is not None:
+            compressed = self._compressed[version - 1]
+            if compressed is None:
+                compressed = self._compressed[version - 1] = self._encode_compressed(version, compressor)
+            return compressed
+        encoded = self._encoded[version - 1]
+        if encoded is None:
+            try:
+                encoded = encode_frame(self.type, self.username, self.text, version=version, seq=self.seq)
+            except OverflowError:
+                # too long for the length fields of the version, its clients skip it
+                encoded = b""
+            self._encoded[version - 1] = encoded
+        return encoded
 
-    def to_bytes(self) -> bytes:
-        message = f"{self.type}\n{self.username}".encode()
-        message = len(message).to_bytes(1, "big") + message
-        if self.text is None:
-            return message
+    def _encode_compressed(self, version: int, compressor: Compressor) -> bytes:
         assert self.text is not None
-        text = self.text.encode()
-        message += b"\n" + len(text).to_bytes(2, "big") + text
+        if self._deflated is None:
+            self._deflated = compressor.compress(self.text) or b""
+        if not self._deflated:
+            return self.encode(version)
+        try:
+            return _encode_frame_v2(
+                self.type, self.username, self._deflated, FLAG_TEXT | FLAG_ZLIB, self.seq if version > 2 else 0
+            )
+        except OverflowError:
+            return b""
+
+
+# v1: header length (1 byte) | TYPE\nusername | [\n | text length (2 bytes) | text]
+# v2: frame length (varint) | type code | flags | username length (varint) | username | [text]
+# v3: as v2, with | seq (varint) | after the username when FLAG_SEQ is set
+def encode_frame(
+    type: str,
+    username: str,
+    text: Buffer | None = None,
+    *,
+    version: int = 1,
+    compressor: Compressor | None = None,
+    seq: int = 0,
+) -> bytes:
+    if version > 1:
+        seq = seq if version > 2 else 0
+        if text is None:
+            return _encode_frame_v2(type, username, None, 0, seq)
+        if compressor and (compressed := compressor.compress(text)) is not None:
+            return _encode_frame_v2(type, username, compressed, FLAG_TEXT | FLAG_ZLIB, seq)
+        return _encode_frame_v2(type, username, text, FLAG_TEXT, seq)
+    message = f"{type}\n{username}".encode()
+    message = len(message).to_bytes(1, "big") + message
+    if text is None:
         return message
+    return message + b"\n" + len(text).to_bytes(2, "big") + text
+
+
+def _encode_frame_v2(type: str, username: str, text: Buffer | None, flags: int, seq: int = 0) -> bytes:
+    name = username.encode()
+    header = bytes((TYPE_CODES[type], flags | (FLAG_SEQ if seq else 0))) + encode_varint(len(name)) + name
+    if seq:
+        header += encode_varint(seq)
+    length = len(header) + (0 if text is None else len(text))
+    if length > MAX_FRAME_SIZE:
+        raise OverflowError(f"frame of {length} bytes")
+    if text is None:
+        return encode_varint(length) + header
+    return b"".join((encode_varint(length), header, text))
 
 
-def receive_message(socket: socket.socket, on_empty: Callable) -> SackMessage | None:
-    message_len = socket.recv(1)  # ConnectionResetError
-    if not message_len:
-        return on_empty()
-    message_len = int.from_bytes(message_len, "big")
-    raw_message = socket.recv(message_len)
-    raw_message = raw_message.decode()
-    message_parts = raw_message.split("\n")
-    if not len(message_parts) == 2:
+# relays and the message log carry plain v2, the log keeps the sequence number apart
+# and a seq inside the frame is not trusted
+def decode_frame(frame: Buffer, seq: int = 0) -> Frame:
+    length, start = decode_varint(frame, 0) or (0, 0)
+    parsed = _parse_body(frame, start, start + length) if start and start + length <= len(frame) else None
+    if parsed is None:
+        raise SackProtocolError("malformed frame")
+    type, username, text_start, flags, frame_seq = parsed
+    if flags & FLAG_ZLIB:
+        if (text := decompress(frame[text_start : start + length], MAX_FRAME_SIZE)) is None:
+            raise SackProtocolError("malformed frame text")
+        return Frame(type, username, text, seq)
+    encoded = bytes(frame)
+    text = memoryview(encoded)[text_start : start + length] if flags & FLAG_TEXT else None
+    decoded = Frame(type, username, text, seq)
+    if not frame_seq:
+        decoded._encoded[1] = encoded
+    return decoded
+
+
+def encode_varint(value: int) -> bytes:
+    if value < 0x80:
+        return bytes((value,))
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def decode_varint(buffer: Buffer, pos: int) -> tuple[int, int] | None:
+    value = shift = 0
+    for i in range(pos, len(buffer)):
+        byte = buffer[i]
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, i + 1
+        shift += 7
+        if shift > 28:
+            raise SackProtocolError("varint too long")
+    return None
+
+
+def _parse_body(buffer: Buffer, start: int, end: int) -> tuple[str, str, int, int, int] | None:
+    if end - start < 3:
         return None
-    type = message_parts[0]
-    username = message_parts[1]
-    if type not in ("CONNECT", "TEXT", "DISCONNECT", "GETNICKNAMES"):
+    code, flags = buffer[start], buffer[start + 1]
+    if not 0 < code <= len(FRAME_TYPES) or flags & ~(FLAG_TEXT | FLAG_ZLIB | FLAG_SEQ):
         return None
-    if type != "TEXT":
-        return SackMessage(type, username)
-    sep = socket.recv(1)
-    if sep != b"\n":
+    name_length, name_start = buffer[start + 2], start + 3
+    if name_length & 0x80:
+        name_length, name_start = decode_varint(buffer, start + 2) or (end, end)
+    name_end = name_start + name_length
+    if name_end > end:
         return None
-    text_len = socket.recv(2)
-    text_len = int.from_bytes(text_len, "big")
-    text = socket.recv(text_len).decode()
-    return SackMessage(type, username, text)
+    try:
+        username = str(buffer[name_start:name_end], "utf-8")
+    except UnicodeDecodeError:
+        return None
+    seq = 0
+    if flags & FLAG_SEQ:
+        seq, name_end = decode_varint(buffer, name_end) or (0, end + 1)
+        if name_end > end:
+            return None
+    return FRAME_TYPES[code - 1], username, name_end, flags, seq
+
+
+# decodes the whole frames between pos and end, returns where the last one ends;
+# messages with text keep a copy of their frame, the buffer is reused
+def _unpack(buffer: memoryview, pos: int, end: int, messages: list[SackMessage], *, batched: bool = False) -> int:
+    while pos < end:
+        length, start = buffer[pos], pos + 1
+        if length & 0x80:
+            if (varint := decode_varint(buffer, pos)) is None:
+                break
+            length, start = varint
+            if length > MAX_FRAME_SIZE:
+                raise SackProtocolError(f"frame of {length} bytes")
+        frame_start, frame_end = pos, start + length
+        if frame_end > end:
+            break
+        pos = frame_end
+        # unknown types and flags are skipped whole
+        if (parsed := _parse_body(buffer, start, frame_end)) is None:
+            continue
+        type, username, text_start, flags, seq = parsed
+        if type == "BATCH":
+            if flags == FLAG_TEXT and not batched:
+                _unpack(buffer, text_start, frame_end, messages, batched=True)
+            continue
+        if not flags & FLAG_TEXT:
+            message = SackMessage.of(type, username)
+            message.seq = seq
+            messages.append(message)
+            continue
+        frame = bytes(buffer[frame_start:frame_end])
+        if not flags & FLAG_ZLIB:
+            messages.append(SackMessage.decoded(type, username, frame, text_start - frame_start, frame, flags, seq))
+        # text that does not inflate, or inflates past the frame size limit
+        elif (text := decompress(buffer[text_start:frame_end], MAX_FRAME_SIZE)) is None:
+            raise SackProtocolError("malformed frame text")
+        else:
+            messages.append(SackMessage.decoded(type, username, text, 0, frame, flags, seq))
+    return pos
+
+
+def encode_batch(frames: list[Buffer]) -> bytes:
+    header = bytes((TYPE_CODES["BATCH"], FLAG_TEXT, 0))
+    return b"".join((encode_varint(len(header) + sum(len(frame) for frame in frames)), header, *frames))
+
+
+# a v2 client opens with a hello, a zero byte that cannot start a v1 frame
+# followed by the highest version it speaks and the features it takes; the
+# server answers the same way with what both sides use, then CONNECT goes as usual
+def encode_hello(version: int, features: int = 0) -> bytes:
+    return bytes((0, version, features))
+
+
+# the server sends HISTORY without a text body, so clients that do not know it
+# skip it; the cursor goes in place of the username
+def encode_history_marker(oldest: int, count: int, version: int = 1) -> bytes:
+    return encode_frame("HISTORY", f"{oldest} {count}", version=version)
+
+
+def decode_history_marker(message: SackMessage) -> tuple[int, int]:
+    oldest, count = message.username.split(" ")
+    return int(oldest), int(count)
+
+
+def encode_history_request(username: str, before: int | None, limit: int, version: int = 1) -> bytes:
+    return encode_frame("HISTORY", username, f"{before or 0} {limit}".encode(), version=version)
+
+
+def decode_history_request(message: SackMessage) -> tuple[int | None, int] | None:
+    try:
+        before, limit = map(int, (message.text or "").split(" "))
+    except ValueError:
+        return None
+    return before or None, limit
+
+
+# a v3 client coming back sends RESUME in place of CONNECT, with the token it was
+# given, the last sequence number it saw and its room; the server answers
+# OK or NO as to CONNECT, then RESUME with the token of the new session
+def encode_resume_request(username: str, token: str, seq: int, room: str, version: int = 3) -> bytes:
+    return encode_frame("RESUME", username, f"{token}\n{seq}\n{room}".encode(), version=version)
+
+
+def decode_resume_request(message: SackMessage) -> tuple[str, int, str] | None:
+    try:
+        token, seq, room = (message.text or "").split("\n")
+        return token, int(seq), room
+    except ValueError:
+        return None
+
+
+def is_valid_room(room: str | None) -> bool:
+    return room is not None and 0 < len(room) <= MAX_ROOM_LENGTH and "\n" not in room
+
+
+def is_valid_username(username: str) -> bool:
+    return 0 < len(username.encode()) <= MAX_USERNAME_BYTES and "\n" not in username
+
+
+class SackMessageDecoder:
+    # whether a v1 frame carries text depends on the direction of the stream:
+    # GETNICKNAMES has a text body only when it is sent by the server,
+    # HISTORY only when it is sent by a client; v2 frames flag it
+    def __init__(
+        self, *, text_types: Collection[str] = ("TEXT", "JOIN", "LEAVE", "HISTORY"), version: int | None = None
+    ) -> None:
+        self._buffer = bytearray()
+        self._text_types = text_types
+        # None until the server sees the first bytes of a connection
+        self.version = version
+
+    def feed(self, data: bytes | bytearray | memoryview) -> None:
+        self._buffer += data
+
+    def take(self, size: int) -> bytes | None:
+        if len(self._buffer) < size:
+            return None
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    # returns the version and the features offered by a hello,
+    # v1 clients send none and get no answer
+    def negotiate(self) -> tuple[int, int] | None:
+        if self.version is not None or not self._buffer:
+            return None
+        if self._buffer[0]:
+            self.version = 1
+            return None
+        if len(self._buffer) < 3:
+            return None
+        self.version = max(1, min(self._buffer[1], PROTOCOL_VERSION))
+        features = self._buffer[2]
+        del self._buffer[:3]
+        return self.version, features
+
+    def messages(self) -> list[SackMessage]:
+        if self.version and self.version > 1:
+            return self._messages_v2()
+        if self.version == 1:
+            return self._messages_v1()
+        return []
+
+    def _messages_v1(self) -> list[SackMessage]:
+        buffer = self._buffer
+        end = len(buffer)
+        messages = []
+        pos = 0
+        while pos < end:
+            header_end = pos + 1 + buffer[pos]
+            if header_end > end:
+                break
+            try:
+                type, username = buffer[pos + 1 : header_end].decode().split("\n")
+            except ValueError:
+                pos = header_end
+                continue
+            if type not in MESSAGE_TYPES:
+                pos = header_end
+                continue
+            if type not in self._text_types:
+                messages.append(SackMessage.of(type, username))
+                pos = header_end
+                continue
+            if header_end + 3 > end:
+                break
+            if buffer[header_end] != ord("\n"):
+                pos = header_end + 1
+                continue
+            text_start = header_end + 3
+            text_end = text_start + int.from_bytes(buffer[header_end + 1 : text_start], "big")
+            if text_end > end:
+                break
+            pos = text_end
+            messages.append(SackMessage.decoded(type, username, bytes(buffer[text_start:text_end])))
+        del buffer[:pos]
+        return messages
+
+    def _messages_v2(self) -> list[SackMessage]:
+        messages: list[SackMessage] = []
+        with memoryview(self._buffer) as buffer:
+            pos = _unpack(buffer, 0, len(buffer), messages)
+        del self._buffer[:pos]
+        return messages
+
+    def __len__(self) -> int:
+        return len(self._buffer)
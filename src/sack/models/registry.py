@@ -0,0 +1,155 @@
+from typing import Generic, TypeVar
+from dataclasses import field, dataclass
+from collections.abc import Hashable, KeysView, ItemsView
+
+from sack.models.fanout import Outbox
+from sack.models.protocol import DEFAULT_ROOM, SackMessage, SackMessageDecoder
+from sack.models.admission import TokenBucket
+from sack.models.compression import Compressor
+
+
+@dataclass
+class ClientData:
+    username: str | None = None
+    decoder: SackMessageDecoder = field(default_factory=SackMessageDecoder)
+    outbox: Outbox = field(default_factory=Outbox)
+    room: str = DEFAULT_ROOM
+    # set once the client sends JOIN or LEAVE, until then room changes
+    # of other users are sent to it as CONNECT and DISCONNECT
+    follows_rooms: bool = False
+    # set when the client takes compressed frames
+    compressor: Compressor | None = None
+    # the resume token of a v3 client, and the last sequence number it saw
+    # when it came back without a session to resume
+    token: str | None = None
+    resume_seq: int | None = None
+    # when the client was last heard from, for the idle timers of the server
+    last_seen: float = 0.0
+    # the peer address the connection counts against, and its rate limit
+    address: str = ""
+    bucket: TokenBucket | None = None
+    # messages held back by a rate limit, the client is not read from meanwhile
+    held: list[SackMessage] = field(default_factory=list)
+
+    @property
+    def is_registered(self) -> bool:
+        return self.username is not None
+
+
+C = TypeVar("C", bound=Hashable)
+D = TypeVar("D", bound=ClientData)
+
+
+class Registry(Generic[C, D]):
+    def __init__(self) -> None:
+        self._connections: dict[C, D] = {}
+        self._registered: dict[C, D] = {}
+        self._usernames: dict[str, C] = {}
+        self._rooms: dict[str, dict[C, D]] = {}
+        self._reserved: dict[str, str] = {}
+        self._reserved_rooms: dict[str, set[str]] = {}
+        self._nicknames: dict[str, bytes] = {}
+
+    def add(self, conn: C, client_data: D) -> None:
+        self._connections[conn] = client_data
+
+    def remove(self, conn: C) -> D | None:
+        client_data = self._connections.pop(conn, None)
+        if client_data is None or not client_data.is_registered:
+            return client_data
+        assert client_data.username
+        del self._registered[conn]
+        del self._usernames[client_data.username]
+        self._leave(conn, client_data.room)
+        return client_data
+
+    def register(self, conn: C, username: str) -> bool:
+        if not self.is_available(username):
+            return False
+        client_data = self._connections[conn]
+        assert not client_data.is_registered
+        client_data.username = username
+        self._registered[conn] = client_data
+        self._usernames[username] = conn
+        self._rooms.setdefault(client_data.room, {})[conn] = client_data
+        self._nicknames.pop(client_data.room, None)
+        return True
+
+    def move(self, conn: C, room: str) -> str:
+        client_data = self._registered[conn]
+        previous = client_data.room
+        self._leave(conn, previous)
+        client_data.room = room
+        self._rooms.setdefault(room, {})[conn] = client_data
+        self._nicknames.pop(room, None)
+        return previous
+
+    def is_available(self, username: str) -> bool:
+        return username not in self._usernames and username not in self._reserved
+
+    # reserved usernames belong to users of other nodes, the room is kept
+    # up to date from relayed JOIN frames, or to sessions waiting to be resumed
+    def reserve(self, username: str, room: str = DEFAULT_ROOM) -> None:
+        self.release(username)
+        self._reserved[username] = room
+        self._reserved_rooms.setdefault(room, set()).add(username)
+        self._nicknames.pop(room, None)
+
+    def release(self, username: str) -> str | None:
+        room = self._reserved.pop(username, None)
+        if room is None:
+            return None
+        names = self._reserved_rooms[room]
+        names.discard(username)
+        if not names:
+            del self._reserved_rooms[room]
+        self._nicknames.pop(room, None)
+        return room
+
+    def get(self, conn: C) -> D | None:
+        return self._connections.get(conn)
+
+    def lookup(self, username: str) -> C | None:
+        return self._usernames.get(username)
+
+    def members(self, room: str) -> ItemsView[C, D]:
+        return self._rooms.get(room, {}).items()
+
+    def nicknames(self, room: str) -> bytes:
+        nicknames = self._nicknames.get(room)
+        if nicknames is None:
+            usernames = [
+                username for client_data in self._rooms.get(room, {}).values() if (username := client_data.username)
+            ]
+            nicknames = "\n".join([*usernames, *self._reserved_rooms.get(room, ())]).encode()
+            self._nicknames[room] = nicknames
+        return nicknames
+
+    @property
+    def connections(self) -> ItemsView[C, D]:
+        return self._connections.items()
+
+    @property
+    def registered(self) -> ItemsView[C, D]:
+        return self._registered.items()
+
+    @property
+    def usernames(self) -> KeysView[str]:
+        return self._usernames.keys()
+
+    @property
+    def rooms(self) -> KeysView[str]:
+        return self._rooms.keys()
+
+    def _leave(self, conn: C, room: str) -> None:
+        members = self._rooms[room]
+        del members[conn]
+        if not members:
+            del self._rooms[room]
+        self._nicknames.pop(room, None)
+
+    def __len__(self) -> int:
+        return len(self._connections)
+
+    def __contains__(self, conn: object) -> bool:
+        return conn in self._connections
@@ -1,37 +1,484 @@
 import os
-import queue
+import json
+import time
+import heapq
 import socket
+import asyncio
 import logging
 import selectors
-import threading
-
-from typing import cast
-from dataclasses import dataclass
-from collections.abc import Callable
-
-from sack.models.protocol import SackMessage, receive_message
+import contextlib
+
+from typing import Any, Generic, TypeVar
+from dataclasses import field, dataclass
+from collections.abc import Hashable
+
+from sack.models.bus import BusOp, Cluster, BusFrame, decode_room_frame
+from sack.models.logs import SampledLog
+from sack.models.fanout import Buffer, Outbox, BatchPolicy, FlushWindow, SlowConsumerPolicy
+from sack.models.history import History, HistoryPolicy
+from sack.models.metrics import MAX_BACKLOGS, Metrics, render_text
+from sack.models.protocol import (
+    DEFAULT_ROOM,
+    FEATURE_PING,
+    FEATURE_ZLIB,
+    RECV_BUFFER_SIZE,
+    Frame,
+    SackMessage,
+    SackProtocolError,
+    decode_frame,
+    encode_batch,
+    encode_hello,
+    is_valid_room,
+    is_valid_username,
+    decode_resume_request,
+    decode_history_request,
+)
+from sack.models.registry import Registry, ClientData
+from sack.models.sessions import Session, Sessions, ResumePolicy
+from sack.models.admission import RATE_LIMITED, Admission, AdmissionPolicy, RateLimitPolicy
+from sack.models.heartbeat import TimerWheel, HeartbeatPolicy
+from sack.models.messagelog import MessageLog
+from sack.models.compression import Compressor, CompressionStats, CompressionPolicy
 
 
 log = logging.getLogger("server")
 blog = logging.getLogger("broadcaster")
+# logged for every frame, so sampled
 
 
 @dataclass
-class ClientData:
-    username: str | None = None
-
-    @property
-    def is_registered(self) -> bool:
-        return self.username is not None
-
-
-class SackServer:
-    def __init__(self, host: str, port: int) -> None:
+class AsyncClientData(ClientData):
+    wakeup: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+def presence_key(type: str, username: str) -> Hashable | None:
+    if type in ("CONNECT", "DISCONNECT", "JOIN", "LEAVE"):
+        return ("presence", username)
+    return None
+
+
+# clients that never sent JOIN or LEAVE see other users changing rooms as presence
+def presence_fallback(type: str, username: str) -> Frame | None:
+    if type == "JOIN":
+        return Frame("CONNECT", username)
+    if type == "LEAVE":
+        return Frame("DISCONNECT", username)
+    return None
+
+
+# a stale socket file left by a server that was killed is replaced
+def bind_unix(path: str) -> socket.socket:
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen()
+    sock.setblocking(False)
+    return sock
+
+
+def snapshot(metrics: Metrics, registry: Registry) -> dict[str, Any]:
+    depths = [
+        (client_data.outbox.depth, client_data.username or client_data.address)
+        for _, client_data in registry.connections
+    ]
+    largest = heapq.nlargest(MAX_BACKLOGS, (depth for depth in depths if depth[0]))
+    backlogs = {name: depth for depth, name in largest}
+    return metrics.snapshot(len(registry), len(registry.registered), sum(depth for depth, _ in depths), backlogs)
+
+
+C = TypeVar("C", bound=Hashable)
+D = TypeVar("D", bound=ClientData)
+
+
+# protocol and state handling shared by both engines, which only read from and
+# write to the connections; frames are queued with _send and the engine is
+# woken to write them with _wake, connections are closed with _close
+class ServerCore(Generic[C, D]):
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        *,
+        slow_consumer_policy: SlowConsumerPolicy | None = None,
+        history_policy: HistoryPolicy | None = None,
+        message_log: MessageLog | None = None,
+        batch_policy: BatchPolicy | None = None,
+        compression_policy: CompressionPolicy | None = None,
+        resume_policy: ResumePolicy | None = None,
+        heartbeat_policy: HeartbeatPolicy | None = None,
+        admission_policy: AdmissionPolicy | None = None,
+        rate_limit_policy: RateLimitPolicy | None = None,
+        stats_path: str | None = None,
+        log_sample_rate: float | None = 5.0,
+    ) -> None:
         self.host = host
         self.port = port
+        # per message records, at most log_sample_rate a second from each site
+        self._received_log = SampledLog(log, rate=log_sample_rate)
+        self._broadcast_log = SampledLog(blog, rate=log_sample_rate)
+        self.slow_consumer_policy = slow_consumer_policy or SlowConsumerPolicy()
+        self.batch_policy = batch_policy
+        self._registry: Registry[C, D] = Registry()
+        self._lagging: dict[C, D] = {}
+        self._history = History(history_policy, message_log)
+        # large texts are compressed once per frame for every client that took zlib in its hello
+        self._compressor = Compressor(compression_policy) if compression_policy else None
+        self._sessions = Sessions(resume_policy)
+        # clients that took FEATURE_PING have an idle timer, v1 clients are never pinged
+        self.heartbeat_policy = heartbeat_policy or HeartbeatPolicy()
+        self._idle: TimerWheel[C] = TimerWheel(self.heartbeat_policy.tick, self.heartbeat_policy.slots)
+        # connections over the caps are closed as they are accepted; with a rate
+        # limit every client gets a token bucket for the messages it sends
+        self._admission = Admission(admission_policy)
+        self.rate_limit_policy = rate_limit_policy
+        # metrics are answered to STATS and written as text to whoever connects to stats_path
+        self.metrics = Metrics()
+        self.stats_path = stats_path
+        # when clustered, usernames are claimed from the cluster before the client gets OK
+        self._cluster: Cluster | None = None
+        self._claims: dict[str, C] = {}
+
+    def get_queue_depths(self) -> dict[str, int]:
+        return {
+            username: client_data.outbox.depth
+            for _, client_data in self._registry.registered
+            if (username := client_data.username)
+        }
+
+    def get_compression_stats(self) -> CompressionStats | None:
+        return self._compressor.stats if self._compressor else None
+
+    def get_stats(self) -> dict[str, Any]:
+        return snapshot(self.metrics, self._registry)
+
+    # the engine has something queued for the connection to write
+    def _wake(self, conn: C, client_data: D) -> None:
+        raise NotImplementedError
+
+    # closes a connection still open, and tells whether it was
+    def _close(self, conn: C) -> bool:
+        raise NotImplementedError
+
+    def _admit(self, address: str, peer: Any) -> bool:
+        if not self._admission.admit(address):
+            log.info("Refused connection from %s", peer)
+            self.metrics.refused += 1
+            return False
+        self.metrics.accepted += 1
+        self.metrics.accepts.mark()
+        return True
+
+    def _add_client(self, conn: C, client_data: D, peer: Any) -> None:
+        if self.rate_limit_policy:
+            client_data.bucket = self.rate_limit_policy.bucket()
+        self._registry.add(conn, client_data)
+        log.info("Accepted connection from %s", peer)
+
+    def _receive(self, conn: C, client_data: D, data: Buffer) -> list[SackMessage]:
+        self.metrics.bytes_in += len(data)
+        client_data.last_seen = time.monotonic()
+        client_data.decoder.feed(data)
+        if hello := client_data.decoder.negotiate():
+            self._accept_hello(conn, client_data, *hello)
+        try:
+            return client_data.decoder.messages()
+        except SackProtocolError as e:
+            log.warning("dropping client: %s", e)
+            # a misbehaving client does not get its session kept
+            client_data.token = None
+            return [SackMessage("DISCONNECT", "")]
+
+    def _accept_hello(self, conn: C, client_data: D, version: int, features: int) -> None:
+        features &= (FEATURE_ZLIB if self._compressor else 0) | (FEATURE_PING if self.heartbeat_policy.enabled else 0)
+        if features & FEATURE_ZLIB:
+            client_data.compressor = self._compressor
+        self._send(conn, client_data, encode_hello(version, features), raw=True)
+        if features & FEATURE_PING:
+            self._idle.schedule(conn, self.heartbeat_policy.interval)
+
+    def _handle_message(self, conn: C, client_data: D, message: SackMessage) -> None:
+        if message.type == "DISCONNECT":
+            if not self._close(conn) or not client_data.is_registered:
+                return
+            assert client_data.username
+            # the connection dropped, the client did not send DISCONNECT
+            if not message.username and client_data.token:
+                self._away(client_data)
+                return
+            message.username = client_data.username
+            log.info("client disconnects")
+            # relayed before the username is released, so other nodes
+            # can tell a clean disconnect from a lost node
+            self._broadcast(
+                client_data.room, Frame.from_message(message), key=presence_key(message.type, message.username)
+            )
+            if self._cluster:
+                self._cluster.release(message.username)
+            return
+        if message.type in ("PING", "PONG"):
+            # any frame counts as a sign of life, a PING is answered
+            if message.type == "PING":
+                self._send_frame(conn, client_data, Frame("PONG", ""))
+            return
+        if message.type == "STATS":
+            stats = json.dumps(self.get_stats()).encode()
+            self._send_frame(conn, client_data, Frame("STATS", client_data.username or "", stats))
+            return
+        if message.type == "RESUME":
+            self._resume(conn, client_data, message)
+            return
+        if message.type == "CONNECT":
+            if client_data.is_registered:
+                return
+            # a name v1 peers could not be sent, RESUME lands here too without a session
+            if not is_valid_username(message.username):
+                self._send(conn, client_data, b"NO", raw=True)
+                return
+            if self._cluster:
+                if not self._registry.is_available(message.username) or message.username in self._claims:
+                    self._send(conn, client_data, b"NO", raw=True)
+                    return
+                claimed = self._cluster.claim(message.username)
+                if claimed is None:
+                    self._claims[message.username] = conn
+                    return
+                if not claimed:
+                    self._send(conn, client_data, b"NO", raw=True)
+                    return
+            self._register(conn, client_data, message.username)
+            return
+        if not client_data.is_registered:
+            return
+        assert client_data.username
+        if message.type == "GETNICKNAMES":
+            frame = Frame("GETNICKNAMES", client_data.username, self._registry.nicknames(client_data.room))
+            self._send_frame(conn, client_data, frame, key="nicknames")
+        elif message.type == "HISTORY":
+            if cursor := decode_history_request(message):
+                version = client_data.decoder.version or 1
+                frames = self._history.page(client_data.room, *cursor, version, client_data.compressor)
+                self._send_history(conn, client_data, frames)
+        elif message.type in ("JOIN", "LEAVE"):
+            self._change_room(conn, client_data, message)
+        else:
+            frame = Frame.from_message(message)
+            self._append(client_data.room, frame)
+            self._broadcast(client_data.room, frame)
+
+    def _register(self, conn: C, client_data: D, username: str) -> None:
+        if not self._registry.register(conn, username):
+            self._send(conn, client_data, b"NO", raw=True)
+            return
+        self._send(conn, client_data, b"OK", raw=True)
+        self._welcome(conn, client_data)
+        self._broadcast(client_data.room, Frame("CONNECT", username), key=presence_key("CONNECT", username))
+
+    def _append(self, room: str, frame: Frame) -> None:
+        self._history.append(room, frame)
+
+    def _change_room(self, conn: C, client_data: D, message: SackMessage) -> None:
+        assert client_data.username
+        client_data.follows_rooms = True
+        if message.type == "LEAVE" and message.text != client_data.room:
+            return
+        room = message.text if message.type == "JOIN" else DEFAULT_ROOM
+        if not is_valid_room(room):
+            return
+        assert room
+        username = client_data.username
+        frame = Frame("JOIN", username, room.encode())
+        if room == client_data.room:
+            self._send_frame(conn, client_data, frame)
+            return
+        previous = self._registry.move(conn, room)
+        log.info("%s moves from %s to %s", username, previous, room)
+        left = Frame("LEAVE", username, previous.encode())
+        key = presence_key("JOIN", username)
+        self._broadcast(previous, left, key, presence_fallback("LEAVE", username))
+        self._broadcast(room, frame, key, presence_fallback("JOIN", username))
+        self._replay(conn, client_data)
+
+    def _replay(self, conn: C, client_data: D) -> None:
+        replay = self._history.replay(client_data.room, client_data.decoder.version or 1, client_data.compressor)
+        self._send_history(conn, client_data, replay or [])
+
+    # frames of history pages, replays and backfills are counted as HISTORY; they
+    # are pinned, a client counting the frames of a page must get all of them
+    def _send_history(self, conn: C, client_data: D, frames: list[Buffer]) -> None:
+        self.metrics.frames_out["HISTORY"] += len(frames)
+        for frame in frames:
+            self._send(conn, client_data, frame, pinned=True)
+
+    # a client that came back gets what it missed in place of the replay
+    def _welcome(self, conn: C, client_data: D) -> None:
+        version = client_data.decoder.version or 1
+        if version < 3:
+            self._replay(conn, client_data)
+            return
+        assert client_data.username
+        client_data.token = self._sessions.issue()
+        if client_data.token:
+            self._send_frame(conn, client_data, Frame("RESUME", client_data.username, client_data.token.encode()))
+        if client_data.resume_seq is None:
+            self._replay(conn, client_data)
+            return
+        frames = self._history.backfill(client_data.room, client_data.resume_seq, version, client_data.compressor)
+        self._send_history(conn, client_data, frames)
+        client_data.resume_seq = None
+
+    def _resume(self, conn: C, client_data: D, message: SackMessage) -> None:
+        request = decode_resume_request(message)
+        if client_data.is_registered or request is None or (client_data.decoder.version or 1) < 3:
+            return
+        token, client_data.resume_seq, room = request
+        username = message.username
+        session = self._sessions.resume(token, username)
+        if session is None and (previous_conn := self._registry.lookup(username)) is not None:
+            previous = self._registry.get(previous_conn)
+            # the previous connection has not been seen dropping yet
+            if previous and previous.token == token:
+                session = Session(token, username, previous.room, previous.follows_rooms)
+                self._close(previous_conn)
+        if session is None:
+            # nothing to resume, after a restart or the grace period, the client
+            # connects again and catches up on its room
+            client_data.room = room if is_valid_room(room) else DEFAULT_ROOM
+            client_data.follows_rooms = client_data.room != DEFAULT_ROOM
+            self._handle_message(conn, client_data, SackMessage("CONNECT", username))
+            return
+        self._registry.release(username)
+        client_data.room, client_data.follows_rooms = session.room, session.follows_rooms
+        self._registry.register(conn, username)
+        log.info("%s resumes its session", username)
+        self._send(conn, client_data, b"OK", raw=True)
+        self._welcome(conn, client_data)
+
+    def _away(self, client_data: D) -> None:
+        assert client_data.username and client_data.token
+        log.info("%s dropped, keeping the session for %.0f s", client_data.username, self._sessions.policy.grace)
+        self._sessions.away(client_data.token, client_data.username, client_data.room, client_data.follows_rooms)
+        self._registry.reserve(client_data.username, client_data.room)
+
+    def _expire_sessions(self) -> None:
+        for session in self._sessions.expired():
+            if self._registry.release(session.username) is None:
+                continue
+            log.info("session of %s expired", session.username)
+            frame = Frame("DISCONNECT", session.username)
+            self._broadcast(session.room, frame, key=presence_key("DISCONNECT", session.username))
+            if self._cluster:
+                self._cluster.release(session.username)
+
+    # an idle client is pinged once its timer fires, and dropped if it is still
+    # quiet when the next one does; timers of clients heard from meanwhile
+    # are set again from when they were last seen
+    def _reap_idle(self) -> None:
+        policy = self.heartbeat_policy
+        now = time.monotonic()
+        for conn in self._idle.advance():
+            client_data = self._registry.get(conn)
+            if client_data is None:
+                continue
+            idle = now - client_data.last_seen
+            if idle >= policy.timeout:
+                log.info("dropping %s, idle for %.0f s", client_data.username, idle)
+                self._handle_message(conn, client_data, SackMessage("DISCONNECT", ""))
+            elif idle >= policy.interval:
+                self._send_frame(conn, client_data, Frame("PING", ""))
+                self._idle.schedule(conn, policy.timeout - idle)
+            else:
+                self._idle.schedule(conn, policy.interval - idle)
+
+    def _handle_cluster_frames(self, frames: list[BusFrame]) -> None:
+        assert self._cluster
+        for op, payload in frames:
+            if op == BusOp.RELAY:
+                room, encoded = decode_room_frame(payload)
+                frame = decode_frame(encoded)
+                if frame.type == "JOIN":
+                    self._registry.reserve(frame.username, room)
+                elif frame.type == "DISCONNECT":
+                    self._registry.release(frame.username)
+                elif frame.type == "TEXT":
+                    self._append(room, frame)
+                key = presence_key(frame.type, frame.username)
+                self._fanout(room, frame, key, presence_fallback(frame.type, frame.username))
+            elif op == BusOp.JOINED:
+                self._registry.reserve(payload.decode())
+            elif op == BusOp.LEFT:
+                username = payload.decode()
+                room = self._registry.release(username)
+                if room is not None:
+                    # the node of the user went away without relaying a DISCONNECT
+                    self._fanout(room, Frame("DISCONNECT", username), presence_key("DISCONNECT", username))
+            elif op in (BusOp.ACCEPT, BusOp.REJECT):
+                username = payload.decode()
+                conn = self._claims.pop(username)
+                client_data = self._registry.get(conn)
+                if client_data is None:
+                    if op == BusOp.ACCEPT:
+                        self._cluster.release(username)
+                elif op == BusOp.REJECT:
+                    self._send(conn, client_data, b"NO", raw=True)
+                else:
+                    self._register(conn, client_data, username)
+
+    def _broadcast(self, room: str, frame: Frame, key: Hashable | None = None, fallback: Frame | None = None) -> None:
+        self._fanout(room, frame, key, fallback)
+        if self._cluster:
+            self._cluster.publish(room, frame.encode(2))
+
+    def _fanout(self, room: str, frame: Frame, key: Hashable | None = None, fallback: Frame | None = None) -> None:
+        started = time.perf_counter()
+        members = self._registry.members(room)
+        self._broadcast_log("broadcasting message to %d clients in %s", len(members), room)
+        for conn, client_data in members:
+            if fallback is not None and not client_data.follows_rooms:
+                self._send_frame(conn, client_data, fallback, key=key)
+            else:
+                self._send_frame(conn, client_data, frame, key=key)
+        self.metrics.fanout.observe(time.perf_counter() - started)
+
+    def _send_frame(self, conn: C, client_data: D, frame: Frame, key: Hashable | None = None) -> None:
+        if encoded := frame.encode(client_data.decoder.version or 1, client_data.compressor):
+            self.metrics.frames_out[frame.type] += 1
+            self._send(conn, client_data, encoded, key)
+
+    def _send(
+        self,
+        conn: C,
+        client_data: D,
+        frame: Buffer,
+        key: Hashable | None = None,
+        *,
+        raw: bool = False,
+        pinned: bool = False,
+    ) -> None:
+        if client_data.outbox.put(frame, key, raw=raw, pinned=pinned):
+            self._wake(conn, client_data)
+        else:
+            self._lagging[conn] = client_data
+
+    def _drop_lagging(self) -> None:
+        while self._lagging:
+            conn, client_data = self._lagging.popitem()
+            if conn not in self._registry:
+                continue
+            log.warning("dropping slow consumer %s (%d bytes queued)", client_data.username, client_data.outbox.size)
+            self._handle_message(conn, client_data, SackMessage("DISCONNECT", ""))
+
+
+class SackServer(ServerCore[socket.socket, ClientData]):
+    def __init__(
+        self, host: str, port: int, *, reuse_port: bool = False, cluster: Cluster | None = None, **kwargs: Any
+    ) -> None:
+        super().__init__(host, port, **kwargs)
 
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         s.bind((host, port))
         self._socket = s
 
@@ -39,125 +486,420 @@ class SackServer:
         self._STOP = sock_read
         self._stop_controller = sock_write
 
-        self._registry = selectors.DefaultSelector()
-        self._registry.register(self._socket, selectors.EVENT_READ)
-        self._registry.register(self._STOP, selectors.EVENT_READ)
-
-        def get_connections() -> list[socket.socket]:
-            return cast(list[socket.socket], [key.fileobj for key in self._get_client_keys()])
-
-        self._broadcaster = Broadcaster(connections_getter=get_connections)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._socket, selectors.EVENT_READ)
+        self._selector.register(self._STOP, selectors.EVENT_READ)
+        self._recv_buffer = memoryview(bytearray(RECV_BUFFER_SIZE))
+        self._unflushed: dict[socket.socket, ClientData] = {}
+        # with a batch policy, frames for v2 clients are held for the flush window
+        # and go out packed in BATCH frames
+        self._window = FlushWindow(self.batch_policy) if self.batch_policy else None
+        self._held: TimerWheel[socket.socket] = TimerWheel(0.01, 256)
+        self._stats_socket: socket.socket | None = None
+        if self.stats_path:
+            self._stats_socket = bind_unix(self.stats_path)
+            self._selector.register(self._stats_socket, selectors.EVENT_READ)
+
+        self._cluster = cluster
+        if self._cluster:
+            self._cluster.attach(self._selector)
 
     def serve(self):
         self._socket.setblocking(False)
         self._socket.listen()
-        self._broadcaster.run()
 
         log.info("Started at %s:%d", self.host, self.port)
         log.debug("PID: %d", os.getpid())
 
         while True:
-            events = self._registry.select()
+            events = self._selector.select(self._timeout())
             for key, mask in events:
                 assert isinstance(key.fileobj, socket.socket)
 
                 if key.fileobj is self._socket:
-                    self._accept_connection()
+                    self._accept_connections()
+
+                elif key.fileobj is self._stats_socket:
+                    self._serve_stats()
 
                 elif key.fileobj is self._STOP:
                     self._STOP.recv(1)
                     log.info("stopping server")
                     return
 
-                else:
-                    assert mask == selectors.EVENT_READ
-                    message = self._receive_client_message(key.fileobj)
-                    if message is None:
-                        continue
-                    log.info("received message of type %s", message.type)
-                    client_data: ClientData = key.data
-                    if message.type != "CONNECT" and not client_data.is_registered:
-                        continue
-                    if message.type == "DISCONNECT":
-                        message.username = key.data.username
-                        log.info("client disconnects")
-                        self._unregister(key.fileobj)
-                    if message.type == "CONNECT":
-                        username = message.username
-                        if username in self._get_usernames():
-                            key.fileobj.sendall(b"NO")
-                            continue
-                        else:
-                            key.fileobj.sendall(b"OK")
-                            key.data.username = message.username
-                    if message.type == "GETNICKNAMES":
-                        ret = "\n".join(self._get_usernames())
-                        msg = SackMessage("GETNICKNAMES", key.data.username, ret)
-                        key.fileobj.sendall(msg.to_bytes())
-                        continue
+                elif self._cluster and key.data is self._cluster:
+                    frames = self._cluster.handle_event(key, mask)
+                    if frames is None:
+                        log.info("cluster closed, stopping server")
+                        return
+                    self._handle_cluster_frames(frames)
 
-                    self._broadcaster.broadcast(message.to_bytes())
+                else:
+                    if mask & selectors.EVENT_WRITE:
+                        self._flush(key.fileobj, key.data)
+                    if mask & selectors.EVENT_READ:
+                        messages = self._receive_client_messages(key.fileobj, key.data)
+                        self._handle_messages(key.fileobj, key.data, messages)
+
+            self._release_held()
+            self._reap_idle()
+            self._expire_sessions()
+            self._flush_all()
+            self._history.commit()
 
     def stop(self):
         self._stop_controller.send(b"\0")
 
-    def _accept_connection(self):
-        conn, addr = self._socket.accept()
-        conn.setblocking(False)
-        self._registry.register(conn, selectors.EVENT_READ, ClientData())
-        log.info("Accepted connection from %s", addr)
-
-    def _unregister(self, sock: socket.socket):
-        sock.close()
-        self._registry.unregister(sock)
-
-    def _receive_client_message(self, socket: socket.socket) -> SackMessage | None:
-        def on_empty():
-            return SackMessage("DISCONNECT", "")
-
-        return receive_message(socket, on_empty)
-
-    def _get_usernames(self) -> list[str]:
-        return [username for key in self._get_client_keys() if (username := key.data.username)]
-
-    def _get_client_keys(self):
-        for key in self._registry.get_map().values():
-            if isinstance(key.data, ClientData):
-                yield key
+    def _serve_stats(self) -> None:
+        assert self._stats_socket
+        conn, _ = self._stats_socket.accept()
+        conn.settimeout(1.0)
+        with conn:
+            try:
+                conn.sendall(render_text(self.get_stats()).encode())
+            except OSError:
+                pass
+
+    def _timeout(self) -> float | None:
+        timeouts = [
+            self._history.commit_timeout(),
+            self._sessions.timeout(),
+            self._idle.timeout(),
+            self._held.timeout(),
+        ]
+        if self._window is not None and self._unflushed:
+            timeouts.append(self._window.timeout())
+        if self._cluster:
+            timeouts.append(self._cluster.timeout())
+        return min((timeout for timeout in timeouts if timeout is not None), default=None)
+
+    # the backlog is drained in batches, a wakeup takes every connection waiting
+    def _accept_connections(self):
+        for _ in range(self._admission.policy.accept_batch):
+            try:
+                conn, addr = self._socket.accept()
+            except BlockingIOError:
+                return
+            if not self._admit(addr[0], addr):
+                conn.close()
+                continue
+            conn.setblocking(False)
+            client_data = ClientData(outbox=Outbox(self.slow_consumer_policy), address=addr[0])
+            self._selector.register(conn, selectors.EVENT_READ, client_data)
+            self._add_client(conn, client_data, addr)
+
+    def _close(self, conn: socket.socket) -> bool:
+        if conn in self._selector.get_map():
+            self._selector.unregister(conn)
+        if client_data := self._registry.remove(conn):
+            self._admission.release(client_data.address)
+        self._idle.cancel(conn)
+        self._held.cancel(conn)
+        conn.close()
+        return client_data is not None
+
+    # read events are off while a client has messages held back
+    def _watch(self, sock: socket.socket, client_data: ClientData, write: bool) -> None:
+        events = (0 if client_data.held else selectors.EVENT_READ) | (selectors.EVENT_WRITE if write else 0)
+        registered = sock in self._selector.get_map()
+        if not events:
+            if registered:
+                self._selector.unregister(sock)
+        elif registered:
+            self._selector.modify(sock, events, client_data)
+        else:
+            self._selector.register(sock, events, client_data)
+
+    def _handle_messages(self, sock: socket.socket, client_data: ClientData, messages: list[SackMessage]) -> None:
+        for i, message in enumerate(messages):
+            self.metrics.frames_in[message.type] += 1
+            if client_data.bucket and message.type in RATE_LIMITED and (wait := client_data.bucket.take()):
+                assert self.rate_limit_policy
+                action = self.rate_limit_policy.action
+                if action == "drop":
+                    continue
+                if action == "delay":
+                    client_data.held = messages[i:]
+                    key = self._selector.get_map().get(sock)
+                    self._watch(sock, client_data, bool(key and key.events & selectors.EVENT_WRITE))
+                    self._held.schedule(sock, wait)
+                    return
+                log.warning("dropping %s, over its message rate", client_data.username)
+                client_data.token = None
+                message = SackMessage("DISCONNECT", "")
+            self._received_log("received message of type %s", message.type)
+            self._handle_message(sock, client_data, message)
+            if message.type == "DISCONNECT":
+                return
+
+    def _release_held(self) -> None:
+        for sock in self._held.advance():
+            client_data = self._registry.get(sock)
+            if client_data is None:
+                continue
+            messages, client_data.held = client_data.held, []
+            key = self._selector.get_map().get(sock)
+            self._watch(sock, client_data, bool(key and key.events & selectors.EVENT_WRITE))
+            self._handle_messages(sock, client_data, messages)
+
+    def _receive_client_messages(self, sock: socket.socket, client_data: ClientData) -> list[SackMessage]:
+        try:
+            size = sock.recv_into(self._recv_buffer)
+        except BlockingIOError:
+            return []
+        except ConnectionError:
+            size = 0
+        if not size:
+            return [SackMessage("DISCONNECT", "")]
+        return self._receive(sock, client_data, self._recv_buffer[:size])
+
+    def _wake(self, conn: socket.socket, client_data: ClientData) -> None:
+        self._unflushed[conn] = client_data
+        if self._window:
+            self._window.open()
+            if client_data.outbox.size >= self._window.policy.max_bytes:
+                self._window.expire()
+
+    def _flush(self, sock: socket.socket, client_data: ClientData) -> None:
+        if self._window and (client_data.decoder.version or 1) > 1:
+            client_data.outbox.pack(encode_batch, self._window.policy.max_bytes)
+        sent = client_data.outbox.sent
+        try:
+            drained = client_data.outbox.send(sock)
+        except OSError:
+            self._lagging[sock] = client_data
+            return
+        finally:
+            self.metrics.bytes_out += client_data.outbox.sent - sent
+        self._watch(sock, client_data, not drained)
+
+    def _flush_all(self) -> None:
+        while True:
+            while self._lagging or self._unflushed and (self._window is None or self._window.due()):
+                self._drop_lagging()
+                self._flush_unflushed()
+            frames = self._cluster.flush() if self._cluster else None
+            if not frames:
+                return
+            self._handle_cluster_frames(frames)
+
+    def _flush_unflushed(self) -> None:
+        unflushed, self._unflushed = self._unflushed, {}
+        if self._window and unflushed:
+            self._window.close(sum(client_data.outbox.depth for client_data in unflushed.values()), len(unflushed))
+        for sock, client_data in unflushed.items():
+            if sock.fileno() == -1:
+                continue
+            key = self._selector.get_map().get(sock)
+            if key and key.events & selectors.EVENT_WRITE:
+                continue
+            self._flush(sock, client_data)
 
     def __enter__(self):
         return self
 
     def __exit__(self, *_):
-        self._broadcaster.shutdown()
         self._socket.close()
-        self._registry.close()
-
+        if self._stats_socket:
+            self._stats_socket.close()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.stats_path or "")
+        self._selector.close()
+        self._history.close()
+        if self._cluster:
+            self._cluster.close()
+
+
+class AsyncSackServer(ServerCore[asyncio.StreamWriter, AsyncClientData]):
+    def __init__(self, host: str, port: int, **kwargs: Any) -> None:
+        super().__init__(host, port, **kwargs)
+        self._expiry: asyncio.TimerHandle | None = None
+        self._tick: asyncio.TimerHandle | None = None
+        self._handlers: set[asyncio.Task] = set()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._stopped: asyncio.Event | None = None
+        self._commit: asyncio.TimerHandle | None = None
+
+    async def serve(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        server = await asyncio.start_server(self._handle_connection, self.host, self.port, reuse_address=True)
+        stats_server = None
+        if self.stats_path:
+            stats_server = await asyncio.start_unix_server(self._serve_stats, sock=bind_unix(self.stats_path))
 
-class Broadcaster:
-    def __init__(self, connections_getter: Callable[[], list[socket.socket]]) -> None:
-        self._msg_queue = queue.Queue()
-        self._worker = threading.Thread(target=self._broadcast_worker)
-        self._STOP = object()
-        self._get_connections = connections_getter
-
-    def run(self):
-        self._worker.start()
-
-    def shutdown(self):
-        self._msg_queue.put(self._STOP)
-
-    def broadcast(self, message: bytes):
-        self._msg_queue.put(message)
+        log.info("Started at %s:%d", self.host, self.port)
+        log.debug("PID: %d", os.getpid())
 
-    def _broadcast_worker(self):
+        async with server:
+            await self._stopped.wait()
+            log.info("stopping server")
+            if stats_server:
+                stats_server.close()
+            for writer, _ in self._registry.connections:
+                writer.close()
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+            if self._commit:
+                self._commit.cancel()
+            if self._expiry:
+                self._expiry.cancel()
+            if self._tick:
+                self._tick.cancel()
+            self._history.close()
+
+    def stop(self) -> None:
+        if self._loop is None or self._stopped is None:
+            return
+        self._loop.call_soon_threadsafe(self._stopped.set)
+
+    async def _serve_stats(self, _: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        writer.write(render_text(self.get_stats()).encode())
+        with contextlib.suppress(ConnectionError):
+            await writer.drain()
+        writer.close()
+
+    # the event loop drains the backlog itself, up to 100 connections per wakeup
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peer = writer.get_extra_info("peername")
+        address = peer[0] if peer else ""
+        if not self._admit(address, peer):
+            writer.close()
+            return
+        client_data = AsyncClientData(outbox=Outbox(self.slow_consumer_policy), address=address)
+        self._add_client(writer, client_data, peer)
+        flusher = asyncio.create_task(self._flush_outbox(writer, client_data))
+        handler = asyncio.current_task()
+        assert handler
+        self._handlers.add(handler)
+        try:
+            while True:
+                for message in await self._receive_client_messages(reader, writer, client_data):
+                    self.metrics.frames_in[message.type] += 1
+                    if client_data.bucket and message.type in RATE_LIMITED:
+                        if (limited := await self._throttle(writer, client_data, message)) is None:
+                            continue
+                        message = limited
+                    self._received_log("received message of type %s", message.type)
+                    self._handle_message(writer, client_data, message)
+                    self._drop_lagging()
+                    if message.type == "DISCONNECT":
+                        return
+        finally:
+            flusher.cancel()
+            self._handlers.discard(handler)
+            self._registry.remove(writer)
+            self._idle.cancel(writer)
+            self._admission.release(address)
+            writer.close()
+
+    # with the delay action the client is not read from until the message fits
+    async def _throttle(
+        self, writer: asyncio.StreamWriter, client_data: AsyncClientData, message: SackMessage
+    ) -> SackMessage | None:
+        assert client_data.bucket and self.rate_limit_policy
+        while wait := client_data.bucket.take():
+            action = self.rate_limit_policy.action
+            if action == "drop":
+                return None
+            if action == "disconnect":
+                log.warning("dropping %s, over its message rate", client_data.username)
+                client_data.token = None
+                return SackMessage("DISCONNECT", "")
+            await asyncio.sleep(wait)
+            if writer not in self._registry:
+                return None
+        return message
+
+    async def _flush_outbox(self, writer: asyncio.StreamWriter, client_data: AsyncClientData) -> None:
+        # every connection has its own flush window, the loop has no common flush point
+        window = FlushWindow(self.batch_policy) if self.batch_policy else None
         while True:
-            msg = self._msg_queue.get()
-            if msg is self._STOP:
-                self._msg_queue.task_done()
-                break
-            connections = self._get_connections()
-            blog.info("broadcasting message to %d clients", len(connections))
-            for conn in connections:
-                conn.sendall(msg)
-            self._msg_queue.task_done()
+            await client_data.wakeup.wait()
+            if window:
+                window.open()
+                if timeout := window.timeout():
+                    await asyncio.sleep(timeout)
+                window.close(client_data.outbox.depth, 1)
+                if (client_data.decoder.version or 1) > 1:
+                    client_data.outbox.pack(encode_batch, window.policy.max_bytes)
+            client_data.wakeup.clear()
+            sent = client_data.outbox.sent
+            writer.writelines(client_data.outbox.take())
+            self.metrics.bytes_out += client_data.outbox.sent - sent
+            try:
+                await writer.drain()
+            except ConnectionError:
+                return
+
+    async def _receive_client_messages(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, client_data: AsyncClientData
+    ) -> list[SackMessage]:
+        try:
+            data = await reader.read(RECV_BUFFER_SIZE)
+        except ConnectionError:
+            data = b""
+        if not data:
+            return [SackMessage("DISCONNECT", "")]
+        return self._receive(writer, client_data, data)
+
+    def _wake(self, conn: asyncio.StreamWriter, client_data: AsyncClientData) -> None:
+        client_data.wakeup.set()
+
+    def _close(self, conn: asyncio.StreamWriter) -> bool:
+        if self._registry.remove(conn) is None:
+            return False
+        conn.close()
+        return True
+
+    # the timers of the core run from call_later handles, set again after each run
+    def _accept_hello(
+        self, conn: asyncio.StreamWriter, client_data: AsyncClientData, version: int, features: int
+    ) -> None:
+        super()._accept_hello(conn, client_data, version, features)
+        self._schedule_tick()
+
+    def _append(self, room: str, frame: Frame) -> None:
+        super()._append(room, frame)
+        self._schedule_commit()
+
+    def _schedule_commit(self) -> None:
+        timeout = self._history.commit_timeout()
+        if timeout is None or self._commit is not None:
+            return
+        assert self._loop
+        self._commit = self._loop.call_later(timeout, self._run_commit)
+
+    def _run_commit(self) -> None:
+        self._commit = None
+        self._history.commit()
+        self._schedule_commit()
+
+    def _away(self, client_data: AsyncClientData) -> None:
+        super()._away(client_data)
+        self._schedule_expiry()
+
+    def _schedule_expiry(self) -> None:
+        timeout = self._sessions.timeout()
+        if timeout is None or self._expiry is not None:
+            return
+        assert self._loop
+        self._expiry = self._loop.call_later(timeout, self._expire_sessions)
+
+    def _expire_sessions(self) -> None:
+        self._expiry = None
+        super()._expire_sessions()
+        self._drop_lagging()
+        self._schedule_expiry()
+
+    def _schedule_tick(self) -> None:
+        timeout = self._idle.timeout()
+        if timeout is None or self._tick is not None:
+            return
+        assert self._loop
+        self._tick = self._loop.call_later(timeout, self._reap_idle)
+
+    def _reap_idle(self) -> None:
+        self._tick = None
+        super()._reap_idle()
+        self._drop_lagging()
+        self._schedule_tick()
@@ -0,0 +1,62 @@
+import time
+import secrets
+
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class ResumePolicy:
+    grace: float = 30.0
+
+
+@dataclass
+class Session:
+    token: str
+    username: str
+    room: str
+    follows_rooms: bool
+    expires: float = 0.0
+
+
+# sessions of v3 clients whose connection dropped without a DISCONNECT, their
+# usernames stay reserved until the client resumes or the grace period ends
+class Sessions:
+    def __init__(self, policy: ResumePolicy | None = None) -> None:
+        self.policy = policy or ResumePolicy()
+        # the grace period is the same for every session, so insertion order is expiry order
+        self._away: dict[str, Session] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.policy.grace > 0
+
+    def issue(self) -> str | None:
+        return secrets.token_urlsafe(16) if self.enabled else None
+
+    def away(self, token: str, username: str, room: str, follows_rooms: bool) -> None:
+        self._away[token] = Session(token, username, room, follows_rooms, time.monotonic() + self.policy.grace)
+
+    def resume(self, token: str, username: str) -> Session | None:
+        session = self._away.get(token)
+        if session is None or session.username != username:
+            return None
+        return self._away.pop(token)
+
+    def timeout(self) -> float | None:
+        for session in self._away.values():
+            return max(0.0, session.expires - time.monotonic())
+        return None
+
+    def expired(self) -> list[Session]:
+        now = time.monotonic()
+        expired = []
+        for session in self._away.values():
+            if session.expires > now:
+                break
+            expired.append(session)
+        for session in expired:
+            del self._away[session.token]
+        return expired
+
+    def __len__(self) -> int:
+        return len(self._away)
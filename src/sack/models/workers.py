@@ -0,0 +1,157 @@
+import signal
+import socket
+import logging
+import selectors
+import multiprocessing
+
+from typing import Any
+from contextlib import AbstractContextManager, nullcontext
+from collections.abc import Callable
+
+from sack.models.bus import BusOp, BusLink, WorkerBus
+from sack.models.logs import stop_logging
+from sack.models.server import SackServer
+from sack.models.sessions import ResumePolicy
+
+
+log = logging.getLogger("bus")
+
+
+class BusHub:
+    def __init__(self, links: list[socket.socket]) -> None:
+        sock_read, sock_write = socket.socketpair()
+        self._STOP = sock_read
+        self._stop_controller = sock_write
+
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._STOP, selectors.EVENT_READ)
+        self._links = [BusLink(sock) for sock in links]
+        for link in self._links:
+            self._selector.register(link.sock, selectors.EVENT_READ, link)
+        self._owners: dict[str, BusLink] = {}
+
+    def serve(self) -> None:
+        while self._links:
+            for key, mask in self._selector.select():
+                if key.fileobj is self._STOP:
+                    self._STOP.recv(1)
+                    return
+                link: BusLink = key.data
+                if mask & selectors.EVENT_WRITE and not link.flush(self._selector, link):
+                    self._drop(link)
+                    continue
+                if mask & selectors.EVENT_READ:
+                    frames = link.receive()
+                    if frames is None:
+                        self._drop(link)
+                        continue
+                    for op, payload in frames:
+                        self._handle_frame(link, op, payload)
+            for link in list(self._links):
+                if link.needs_flush(self._selector) and not link.flush(self._selector, link):
+                    self._drop(link)
+
+    def stop(self) -> None:
+        self._stop_controller.send(b"\0")
+
+    def close(self) -> None:
+        for link in self._links:
+            link.sock.close()
+        self._selector.close()
+
+    def _handle_frame(self, link: BusLink, op: BusOp, payload: bytes) -> None:
+        if op == BusOp.RELAY:
+            self._publish(link, op, payload)
+        elif op == BusOp.CLAIM:
+            username = payload.decode()
+            if username in self._owners:
+                link.send(BusOp.REJECT, payload)
+                return
+            self._owners[username] = link
+            link.send(BusOp.ACCEPT, payload)
+            self._publish(link, BusOp.JOINED, payload)
+        elif op == BusOp.RELEASE:
+            username = payload.decode()
+            if self._owners.get(username) is link:
+                del self._owners[username]
+                self._publish(link, BusOp.LEFT, payload)
+
+    def _publish(self, origin: BusLink, op: BusOp, payload: bytes) -> None:
+        for link in self._links:
+            if link is not origin:
+                link.send(op, payload)
+
+    def _drop(self, link: BusLink) -> None:
+        log.warning("worker bus link closed")
+        self._selector.unregister(link.sock)
+        self._links.remove(link)
+        link.sock.close()
+        for username in [username for username, owner in self._owners.items() if owner is link]:
+            del self._owners[username]
+            self._publish(link, BusOp.LEFT, username.encode())
+
+
+# profiler makes what each worker runs its server under, e.g. to profile itself;
+# sessions and history seqs are kept by each worker, and a client that comes
+# back lands on any of them, so workers run without resume
+def serve_workers(
+    host: str,
+    port: int,
+    workers: int,
+    *,
+    profiler: Callable[[], AbstractContextManager[Any]] | None = None,
+    **server_kwargs: Any,
+) -> None:
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+    if (server_kwargs.get("resume_policy") or ResumePolicy()).grace > 0:
+        raise ValueError("workers do not share sessions, resume_policy must have a grace of 0")
+
+    hub_ends: list[socket.socket] = []
+    processes = []
+    for i in range(workers):
+        hub_end, worker_end = socket.socketpair()
+        hub_ends.append(hub_end)
+        process = multiprocessing.Process(
+            target=_worker,
+            args=(host, port, worker_end, hub_ends, profiler, server_kwargs),
+            name=f"sack-worker-{i}",
+        )
+        process.start()
+        worker_end.close()
+        processes.append(process)
+
+    hub = BusHub(hub_ends)
+    signal.signal(signal.SIGINT, lambda *_: hub.stop())
+    log.info("Started %d workers at %s:%d", workers, host, port)
+    try:
+        hub.serve()
+    finally:
+        hub.close()
+        for process in processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+
+
+def _worker(
+    host: str,
+    port: int,
+    bus: socket.socket,
+    hub_ends: list[socket.socket],
+    profiler: Callable[[], AbstractContextManager[Any]] | None,
+    server_kwargs: dict[str, Any],
+) -> None:
+    # the parent stops workers by closing the bus, which only shows up as EOF
+    # once no other process holds a copy of the hub end
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for hub_end in hub_ends:
+        hub_end.close()
+    try:
+        with (
+            profiler() if profiler else nullcontext(),
+            SackServer(host, port, reuse_port=True, cluster=WorkerBus(bus), **server_kwargs) as server,
+        ):
+            server.serve()
+    finally:
+        stop_logging()
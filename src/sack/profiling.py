@@ -0,0 +1,152 @@
+import os
+import sys
+import time
+import signal
+import logging
+import cProfile
+import threading
+import tracemalloc
+
+from typing import Literal
+from weakref import WeakSet
+from collections import Counter
+
+
+log = logging.getLogger("profiler")
+
+
+# profiles the thread that starts it, with cProfile into a pstats file or by sampling
+# its stack into a collapsed stack file for flame graphs; the signal handlers cost
+# nothing until a signal comes, so nothing is slowed down while profiling is off
+class Profiler:
+    def __init__(
+        self,
+        path: str | None = None,
+        *,
+        mode: Literal["cprofile", "sample"] = "cprofile",
+        interval: float = 0.005,
+        top: int = 25,
+    ) -> None:
+        # the pid goes in the name of the file when it is written, see file_path
+        self.path = path or f"sack.{'pstats' if mode == 'cprofile' else 'collapsed'}"
+        self.mode = mode
+        self.interval = interval
+        self.top = top
+        self._profile: cProfile.Profile | None = None
+        self._stacks: Counter[str] = Counter()
+        self._sampler: threading.Thread | None = None
+        self._sampling = threading.Event()
+        self._snapshots = 0
+        _profilers.add(self)
+
+    @property
+    def running(self) -> bool:
+        return self._profile is not None or self._sampler is not None
+
+    def start(self) -> None:
+        if self.running:
+            return
+        if self.mode == "cprofile":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._sampling.set()
+            self._sampler = threading.Thread(target=self._sample, args=(threading.get_ident(),), daemon=True)
+            self._sampler.start()
+        log.info("profiling started")
+
+    # writes what was gathered since the last start
+    def stop(self) -> None:
+        if not self.running:
+            return
+        path = self.file_path()
+        if self._profile:
+            self._profile.disable()
+            self._profile.dump_stats(path)
+            self._profile = None
+        if self._sampler:
+            self._sampling.clear()
+            self._sampler.join()
+            self._sampler = None
+            with open(path, "w") as file:
+                file.writelines(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+            self._stacks.clear()
+        log.info("profile written to %s", path)
+
+    # the pid replaces {pid} in the path, or goes before its suffix, so a parent
+    # and its forked workers never write the same file
+    def file_path(self) -> str:
+        pid = str(os.getpid())
+        if "{pid}" in self.path:
+            return self.path.replace("{pid}", pid)
+        root, suffix = os.path.splitext(self.path)
+        return f"{root}-{pid}{suffix}"
+
+    def __enter__(self) -> "Profiler":
+        self.start()
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.stop()
+
+    def toggle(self) -> None:
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    # the first call starts tracing allocations, the next ones write the top lines
+    def snapshot_memory(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            log.info("tracing allocations, signal again for a snapshot")
+            return
+        self._snapshots += 1
+        path = f"{os.path.splitext(self.file_path())[0]}-memory-{self._snapshots}.txt"
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        stats = snapshot.statistics("lineno")
+        with open(path, "w") as file:
+            file.write(f"{sum(stat.size for stat in stats)} bytes in {sum(stat.count for stat in stats)} blocks\n")
+            file.writelines(f"{stat}\n" for stat in stats[: self.top])
+        log.info("allocation snapshot written to %s", path)
+
+    # SIGUSR1 starts or stops profiling, SIGUSR2 takes an allocation snapshot
+    def install(self) -> None:
+        if not hasattr(signal, "SIGUSR1"):
+            return
+        signal.signal(signal.SIGUSR1, lambda *_: self.toggle())
+        signal.signal(signal.SIGUSR2, lambda *_: self.snapshot_memory())
+
+    # a forked child inherits a running profile but not the sampler thread; what
+    # the parent gathered is left to the parent, the child starts afresh
+    def _forget(self) -> None:
+        if self._profile:
+            self._profile.disable()
+            self._profile = None
+        self._sampler = None
+        self._sampling.clear()
+        self._stacks.clear()
+
+    def _sample(self, ident: int) -> None:
+        while self._sampling.is_set():
+            frame = sys._current_frames().get(ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_filename}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self._stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+
+_profilers: WeakSet[Profiler] = WeakSet()
+
+
+def _forget_all() -> None:
+    for profiler in _profilers:
+        profiler._forget()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_all)
@@ -2,6 +2,7 @@ import socket
 import multiprocessing
 
 from typing import TYPE_CHECKING
+from datetime import datetime
 from contextlib import suppress
 
 from textual import on
@@ -14,22 +15,30 @@ from textual.containers import Center, Container, VerticalScroll, HorizontalGrou
 
 from sack.util import ColorsManager, get_sidebar_user, get_common_footer, get_id_from_color, make_keybinding_text
 from sack.assets import CHAT_HELP, JOIN_HELP, SACK_ABOUT, SERVER_HELP, WELCOME_HELP
-from sack.models import SackServer, SackMessage, AsyncSackClient, SackClientServerError, SackClientUsernameError
+from sack.models import (
+    SackServer,
+    SackMessage,
+    AsyncSackClient,
+    ReconnectPolicy,
+    SackClientServerError,
+    SackClientUsernameError,
+)
 from sack.components import (
     Option,
+    ChatLog,
     HelpTab,
     Options,
+    ChatEntry,
     FormField,
     TextInput,
     ChatHeader,
     FormButton,
     FormErrors,
-    ChatMessage,
     ChatSidebar,
     HelpKeybinding,
-    VimVerticalScroll,
 )
 from sack.keybindings import CHAT_KB, HELP_KB, ABOUT_KB, FORMS_KB, WELCOME_KB
+from sack.models.protocol import DEFAULT_ROOM, MAX_ROOM_LENGTH, decode_history_marker
 
 
 if TYPE_CHECKING:
@@ -89,7 +98,7 @@ class ServerPromptScreen(Screen):
             return
 
         form_error.reset()
-        client = AsyncSackClient(host=host, port=port)
+        client = AsyncSackClient(host=host, port=port, reconnect_policy=ReconnectPolicy())
         await client.connect()
         self.app.client = client
         self.app.push_screen(NicknamePromtScreen(form_title="Create server", button_label="Create"))
@@ -133,7 +142,7 @@ class ClientPromptScreen(Screen):
         port = int(port)
         assert isinstance(host, str)
 
-        client = AsyncSackClient(host=host, port=port)
+        client = AsyncSackClient(host=host, port=port, reconnect_policy=ReconnectPolicy())
 
         try:
             await client.connect(timeout=0.1)
@@ -200,11 +209,31 @@ class ChatScreen(Screen):
         Binding("ctrl+j", "app.focus_next", priority=True),
         Binding("ctrl+k", "app.focus_previous", priority=True),
         Binding("ctrl+s", "toggle_sidebar"),
+        Binding("ctrl+r", "switch_room"),
+        Binding("ctrl+o", "load_history"),
     ]
 
     def action_toggle_sidebar(self) -> None:
         self.query_one(ChatSidebar).toggle_class("hidden")
 
+    def action_switch_room(self) -> None:
+        self.app.push_screen(RoomPromptScreen(self.room), self.switch_room)
+
+    async def switch_room(self, room: str | None) -> None:
+        if room is None:
+            return
+        room = room or DEFAULT_ROOM
+        if room == self.room:
+            return
+        if room == DEFAULT_ROOM:
+            await self.client.leave_room(self.room)
+        else:
+            await self.client.join_room(room)
+
+    async def action_load_history(self) -> None:
+        if self.history_cursor:
+            await self.client.request_history(self.history_cursor)
+
     class MessageReceived(Message):
         def __init__(self, msg: SackMessage) -> None:
             super().__init__()
@@ -218,13 +247,20 @@ class ChatScreen(Screen):
         assert self.app.client
         self.client = self.app.client
         self.username = self.app.client.username
+        self.room = DEFAULT_ROOM
         self.colors_manager = ColorsManager()
+        # messages following a HISTORY marker are older ones and go
+        # above what is already on screen; history_index is where the next
+        # one goes, counted with ChatLog.trimmed so trims do not move it
+        self.history_cursor = 0
+        self.history_left = 0
+        self.history_index = 0
 
     def compose(self) -> ComposeResult:
         yield ChatSidebar()
         with Container(id="chat"):
-            yield ChatHeader(self.client.host, self.client.port)
-            yield VimVerticalScroll(id="messages")
+            yield ChatHeader(self.client.host, self.client.port, self.room)
+            yield ChatLog(id="messages", max_entries=self.app.scrollback)
             with HorizontalGroup(id="input-wrapper"):
                 yield Label("[bold]>[/]", id="prompt-char")
                 yield TextInput(compact=True)
@@ -252,15 +288,11 @@ class ChatScreen(Screen):
         await self.client.request_nicknames()
 
     async def update_messages(self):
-        while True:
-            try:
-                msg = await self.client.receive_message()
-            except SackClientServerError:
-                self.post_message(self.ServerDown())
-                break
-            if msg is None:
-                continue
-            self.post_message(self.MessageReceived(msg))
+        try:
+            async for msg in self.client.messages():
+                self.post_message(self.MessageReceived(msg))
+        except SackClientServerError:
+            self.post_message(self.ServerDown())
 
     @on(ServerDown)
     async def on_server_down(self):
@@ -269,43 +301,84 @@ class ChatScreen(Screen):
         self.app.push_screen(ServerDownScreen())
 
     @on(MessageReceived)
-    def on_message_received(self, event: MessageReceived):
+    async def on_message_received(self, event: MessageReceived):
         msg = event.msg
-        messages = self.query_one("#messages", VimVerticalScroll)
+        messages = self.query_one("#messages", ChatLog)
         users = self.query_one("#sidebar-users", Container)
         if msg.type == "CONNECT":
             if msg.username == self.client.username:
                 return
-            notif = Label(f"{msg.username} joined", classes="notification")
             user = get_sidebar_user(msg.username, self.colors_manager.get(msg.username))
-            messages.mount(notif)
+            messages.write(ChatEntry(f"{msg.username} joined"))
             users.mount(user)
-            notif.scroll_visible()
         if msg.type == "DISCONNECT":
-            notif = Label(f"{msg.username} disconnected", classes="notification")
-            messages.mount(notif)
-            notif.scroll_visible()
+            messages.write(ChatEntry(f"{msg.username} disconnected"))
+            color = self.colors_manager.get(msg.username)
+            with suppress(Exception):
+                user = users.query_one(f"#{get_id_from_color(color)}")
+                user.remove()
+        if msg.type == "JOIN":
+            assert msg.text
+            if msg.username == self.client.username:
+                self.room = msg.text
+                self.query_one(ChatHeader).set_room(msg.text)
+                messages.clear()
+                await users.remove_children()
+                messages.write(ChatEntry(f"you joined {msg.text}"))
+                await self.client.request_nicknames()
+                return
+            user = get_sidebar_user(msg.username, self.colors_manager.get(msg.username))
+            messages.write(ChatEntry(f"{msg.username} joined {msg.text}"))
+            users.mount(user)
+        if msg.type == "LEAVE":
+            messages.write(ChatEntry(f"{msg.username} left {msg.text}"))
             color = self.colors_manager.get(msg.username)
             with suppress(Exception):
                 user = users.query_one(f"#{get_id_from_color(color)}")
                 user.remove()
         if msg.type == "TEXT":
             assert msg.text
-            if msg.username == self.username:
-                orientation = "right"
-                color = None
+            own = msg.username == self.username
+            color = None if own else self.colors_manager.get(msg.username)
+            if self.history_left:
+                # frames carry no time they were sent at, history goes without one
+                entry = ChatEntry(msg.text, msg.username, "", own, color)
+                self.history_left -= 1
+                index = max(0, self.history_index - messages.trimmed)
+                at_end = index >= len(messages)
+                self.history_index = messages.trimmed + index + 1
+                messages.insert(index, entry)
+                if not self.history_left and at_end:
+                    messages.scroll_end(animate=False)
             else:
-                orientation = "left"
-                color = self.colors_manager.get(msg.username)
-            new_msg = ChatMessage(orientation=orientation, msg=msg.text, author=msg.username, color=color)
-            messages.mount(new_msg)
-            new_msg.scroll_visible()
+                messages.write(ChatEntry(msg.text, msg.username, datetime.now().strftime("%H:%M"), own, color))
+        if msg.type == "HISTORY":
+            self.history_cursor, self.history_left = decode_history_marker(msg)
+            self.history_index = messages.trimmed
         if msg.type == "GETNICKNAMES":
             assert msg.text
             for u in msg.text.split("\n"):
                 users.mount(get_sidebar_user(u, self.colors_manager.get(u), is_you=u == self.client.username))
 
 
+class RoomPromptScreen(ModalScreen[str]):
+    BINDINGS = [Binding("escape", "app.pop_screen")]
+
+    def __init__(self, room: str) -> None:
+        super().__init__()
+        self.room = room
+
+    def compose(self) -> ComposeResult:
+        placeholder = "room name" if self.room == DEFAULT_ROOM else f"empty to leave {self.room}"
+        with Container(classes="modal"):
+            with Center():
+                yield Label("Switch room", classes="modal-title")
+            yield FormField("room", "Room:", placeholder=placeholder, max_length=MAX_ROOM_LENGTH)
+
+    def on_input_submitted(self, e: Input.Submitted) -> None:
+        self.dismiss(e.value.strip())
+
+
 class HelpScreen(ModalScreen):
     BINDINGS = [
         Binding("escape", "app.pop_screen"),